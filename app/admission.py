@@ -0,0 +1,120 @@
+import math
+import threading
+import time
+from functools import wraps
+from flask import current_app, request
+from flask_jwt_extended import get_jwt_identity
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from app.identifiers import normalize_identifier
+
+
+class RouteBusy(Exception):
+    """Raised when a route already runs as many requests as its concurrency cap allows"""
+
+    def __init__(self, route, retry_after):
+        super().__init__(route)
+        self.route = route
+        self.retry_after = retry_after
+
+
+def user_key():
+    """Rate limit key of the signed in user; only for views under timed_jwt_required"""
+    return f"user:{get_jwt_identity()}"
+
+
+def login_identifier_key():
+    """Rate limit key of the account a login is trying, however the identifier is written"""
+    data = request.get_json(silent=True) or {}
+    return f"login:{normalize_identifier(data.get('identifier', ''))}"
+
+
+def config_limit(name):
+    """A limit string read from app config per request, so tests and deployments can change it"""
+    return lambda: current_app.config[name]
+
+
+# sliding windows over the in-memory store configured by RATELIMIT_STORAGE_URI and RATELIMIT_STRATEGY
+limiter = Limiter(key_func=get_remote_address)
+
+
+def rate_limit_retry_after():
+    """Whole seconds until the limit the current request broke lets another request through"""
+    breached = limiter.current_limit
+    if breached is None:
+        return 1
+    # flask-limiter rounds reset_at up by as much as a second; no wait is longer than the window itself
+    return max(1, min(math.ceil(breached.reset_at - time.time()), breached.limit.get_expiry()))
+
+
+class ConcurrencyCaps:
+    """
+    Per-process caps on how many requests an expensive route runs at once.
+
+    A request over its route's cap waits at most ADMISSION_WAIT seconds for
+    a slot and then fails fast with RouteBusy, answered as a 503 with
+    Retry-After, rather than queueing on the worker until gunicorn times it
+    out while cheap routes wait behind it. A streamed response keeps its
+    slot until the body has been sent. Caps are read from ROUTE_CONCURRENCY;
+    a route missing there, or capped at 0, is not limited.
+    """
+
+    def __init__(self):
+        self.caps = {}
+        self.wait = 0.05
+        self.retry_after = 1
+        self.rejected = {}
+        self._slots = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.caps = dict(app.config['ROUTE_CONCURRENCY'])
+        self.wait = app.config['ADMISSION_WAIT']
+        self.retry_after = app.config['ADMISSION_RETRY_AFTER']
+        with self._lock:
+            self._slots = {route: threading.BoundedSemaphore(cap) for route, cap in self.caps.items() if cap > 0}
+            self._running = {route: 0 for route in self._slots}
+            self.rejected = {route: 0 for route in self._slots}
+
+    def capped(self, route, methods=None):
+        """Admits the view's requests, or just those with one of `methods`, under the cap named `route`"""
+        def wrapper(fn):
+            @wraps(fn)
+            def decorator(*args, **kwargs):
+                slots = self._slots.get(route)
+                if slots is None or (methods and request.method not in methods):
+                    return fn(*args, **kwargs)
+                if not slots.acquire(timeout=self.wait):
+                    with self._lock:
+                        self.rejected[route] += 1
+                    raise RouteBusy(route, self.retry_after)
+
+                with self._lock:
+                    self._running[route] += 1
+                release = lambda: self._release(route, slots)
+                try:
+                    response = current_app.make_response(fn(*args, **kwargs))
+                except BaseException:
+                    release()
+                    raise
+                if response.is_streamed:
+                    response.call_on_close(release)
+                else:
+                    release()
+                return response
+            return decorator
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            return {route: {"cap": self.caps[route], "running": self._running[route], "rejected": self.rejected[route]}
+                    for route in self._slots}
+
+    def _release(self, route, slots):
+        with self._lock:
+            self._running[route] -= 1
+        slots.release()
+
+
+concurrency_caps = ConcurrencyCaps()
@@ -0,0 +1,128 @@
+from datetime import datetime
+from sqlalchemy import select, delete, func, union_all
+from app.models import db, Product, ProductDailySales
+from app.database import upsert_insert
+from app.archive import HOT, ARCHIVE
+
+
+def parse_sales_args(args):
+    """
+    The date range of a sales query: `since` inclusive and `until` exclusive,
+    as ISO 8601 dates. Raises ValueError on a malformed date.
+    """
+    since = args.get('since')
+    until = args.get('until')
+    return {
+        "product_id": args.get('product_id', type=int),
+        "since": datetime.fromisoformat(since).date() if since else None,
+        "until": datetime.fromisoformat(until).date() if until else None
+    }
+
+
+def _upsert():
+    statement = upsert_insert(ProductDailySales, db.session)
+    return statement.on_conflict_do_update(
+        index_elements=[ProductDailySales.farmer_id, ProductDailySales.product_id, ProductDailySales.day],
+        set_={"units_sold": ProductDailySales.units_sold + statement.excluded.units_sold,
+              "revenue": ProductDailySales.revenue + statement.excluded.revenue}
+    )
+
+
+def record_sales(day, sales):
+    """
+    Adds sold units and revenue to the day's rollup rows in the caller's
+    transaction. `sales` maps (farmer_id, product_id) to (units, revenue).
+    """
+    if not sales:
+        return
+    db.session.execute(_upsert(), [
+        {"farmer_id": farmer_id, "product_id": product_id, "day": day, "units_sold": units, "revenue": revenue}
+        for (farmer_id, product_id), (units, revenue) in sales.items()
+    ])
+
+
+def add_sale(sales, farmer_id, product_id, units, revenue):
+    if farmer_id is None:
+        return
+    soldUnits, soldRevenue = sales.get((farmer_id, product_id), (0, 0))
+    sales[(farmer_id, product_id)] = (soldUnits + units, soldRevenue + revenue)
+
+
+def rebuild_sales(since=None):
+    """Recomputes the rollup from the order history, archive included, from `since` on or entirely; the caller commits"""
+    tiers = []
+    for orders, items in (HOT, ARCHIVE):
+        lines = (
+            select(Product.farmer_id, items.product_id, func.date(orders.order_date).label('day'),
+                   items.quantity_ordered, items.total_price)
+            .join(orders, orders.id == items.order_id)
+            .join(Product, Product.id == items.product_id)
+            .where(Product.farmer_id.is_not(None))
+        )
+        if since is not None:
+            lines = lines.where(orders.order_date >= since)
+        tiers.append(lines)
+    lines = union_all(*tiers).subquery()
+    history = (
+        select(lines.c.farmer_id, lines.c.product_id, lines.c.day,
+               func.sum(lines.c.quantity_ordered), func.sum(lines.c.total_price))
+        .group_by(lines.c.farmer_id, lines.c.product_id, lines.c.day)
+    )
+    clear = delete(ProductDailySales)
+    if since is not None:
+        clear = clear.where(ProductDailySales.day >= since)
+
+    db.session.execute(clear)
+    result = db.session.execute(
+        ProductDailySales.__table__.insert().from_select(
+            ['farmer_id', 'product_id', 'day', 'units_sold', 'revenue'], history
+        )
+    )
+    return result.rowcount
+
+
+def _range(query, product_id, since, until):
+    if product_id is not None:
+        query = query.where(ProductDailySales.product_id == product_id)
+    if since is not None:
+        query = query.where(ProductDailySales.day >= since)
+    if until is not None:
+        query = query.where(ProductDailySales.day < until)
+    return query
+
+
+def farmer_sales(farmer_id, product_id=None, since=None, until=None):
+    """
+    A farmer's units sold and revenue over a date range, per product and per
+    day. Both come from the rollup, so the cost grows with the days and
+    products in the range rather than with the orders behind them.
+    """
+    units = func.sum(ProductDailySales.units_sold).label('units_sold')
+    revenue = func.sum(ProductDailySales.revenue).label('revenue')
+
+    byProduct = db.session.execute(_range(
+        select(ProductDailySales.product_id, Product.name, units, revenue)
+        .join(Product, Product.id == ProductDailySales.product_id)
+        .where(ProductDailySales.farmer_id == farmer_id)
+        .group_by(ProductDailySales.product_id, Product.name)
+        .order_by(ProductDailySales.product_id),
+        product_id, since, until
+    )).all()
+    byDay = db.session.execute(_range(
+        select(ProductDailySales.day, units, revenue)
+        .where(ProductDailySales.farmer_id == farmer_id)
+        .group_by(ProductDailySales.day)
+        .order_by(ProductDailySales.day),
+        product_id, since, until
+    )).all()
+
+    return {
+        "since": since.isoformat() if since else None,
+        "until": until.isoformat() if until else None,
+        "units_sold": sum(row.units_sold for row in byDay),
+        "revenue": sum(row.revenue for row in byDay),
+        "products": [{"product_id": row.product_id, "name": row.name,
+                      "units_sold": row.units_sold, "revenue": row.revenue} for row in byProduct],
+        "days": [{"day": row.day.isoformat(), "units_sold": row.units_sold, "revenue": row.revenue}
+                 for row in byDay]
+    }
@@ -1,35 +1,201 @@
-from flask import Flask, request, jsonify, make_response, render_template
-from flask_migrate import Migrate
+from flask import Flask, Blueprint, current_app, request, jsonify, make_response, render_template, url_for
+from flask.cli import with_appcontext
 from dotenv import load_dotenv
-from app.models import *
+import click
 import os
+from app.models import db, User, Farmer, Grocer, Product, LoginSession
 from app.config import config
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from datetime import timedelta
-from .templates import *
+from flask_jwt_extended import JWTManager, create_access_token, get_jwt
+import uuid
+from app.catalog import parse_catalog_args, fetch_catalog_page, stream_catalog
+from app.history import (parse_history_args, farmer_order_history, grocer_order_history,
+                         stream_farmer_orders, stream_grocer_orders)
+from app.streaming import NDJSON_MIMETYPE, wants_ndjson, ndjson_response
+from app.importer import CSV_MIMETYPE, csv_records, ndjson_records, import_products
+from app.inventory import ReservationError, order_lines, place_order
+from app.intake import order_intake
+from app.database import read_replica
+from app.analytics import parse_sales_args, farmer_sales, rebuild_sales
+from app.changes import catalog_versioning, parse_changes_args, catalog_changes
+from app.hub import EVENT_STREAM_MIMETYPE, StreamFull, stock_hub
+from app.sourcing import price_index, shopping_list
+from app.search import parse_search_args, search_products, search_available, rebuild_search_index
+from app.idempotency import idempotency_store, idempotent
+from app.archive import history_archive
+from app.admission import (limiter, concurrency_caps, RouteBusy, user_key, login_identifier_key, config_limit,
+                           rate_limit_retry_after)
+from flask_limiter.errors import RateLimitExceeded
+from app.serialization import JSON_PROVIDERS
+from app.compression import compression
+from app.cache import catalog_cache
+from app.instrumentation import instrumentation, timed_jwt_required, internal_only
+from app.hashing import password_hasher, HashingBusy
+from app.revocation import revocation_store
+from app.identity import identity_cache, identity_claims
+from app.identifiers import login_identifiers
 
 load_dotenv()
 
-app = Flask(__name__)
-config_name = os.getenv("FLASK_CONFIG", "prod")
-app.config.from_object(config[config_name])
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
 
-db.init_app(app)
-migrate = Migrate(app, db)
-jwt = JWTManager(app)
+jwt = JWTManager()
+api = Blueprint('api', __name__)
 
 
-#db.configure_mappers()
+def create_app(config_name=None):
+    """
+    Builds the app for `config_name`, or FLASK_CONFIG when not given. Nothing
+    here touches the database: tables are created with `flask create-db` and
+    migrated with `flask db upgrade`.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config[config_name or os.getenv("FLASK_CONFIG", "prod")])
 
-#initializing the database
-with app.app_context():
+    app.json = JSON_PROVIDERS[app.config['JSON_PROVIDER']](app)
+
+    db.init_app(app)
+    read_replica.init_app(app)
+    jwt.init_app(app)
+    catalog_cache.init_app(app)
+    catalog_versioning.init_app(app)
+    instrumentation.init_app(app)
+    password_hasher.init_app(app)
+    revocation_store.init_app(app)
+    identity_cache.init_app(app)
+    login_identifiers.init_app(app)
+    order_intake.init_app(app)
+    stock_hub.init_app(app)
+    price_index.init_app(app)
+    idempotency_store.init_app(app)
+    history_archive.init_app(app)
+    limiter.init_app(app)
+    concurrency_caps.init_app(app)
+    compression.init_app(app)
+
+    # alembic is only needed by the flask command, so web workers never import it
+    if click.get_current_context(silent=True) is not None:
+        init_migrations(app)
+
+    app.register_blueprint(api)
+    app.cli.add_command(createDb)
+    app.cli.add_command(drainOrders)
+    app.cli.add_command(rebuildSalesRollup)
+    app.cli.add_command(archiveHistory)
+    app.cli.add_command(rebuildSearchIndex)
+    app.cli.add_command(rebuildLoginIdentifiers)
+    return app
+
+
+def init_migrations(app):
+    from flask_migrate import Migrate
+    Migrate(app, db, directory=MIGRATIONS_DIR)
+
+
+@click.command('create-db')
+@click.option('--drop', is_flag=True, help="drop every table first")
+@with_appcontext
+def createDb(drop):
+    """Creates any missing tables"""
+    if drop:
+        db.drop_all()
     db.create_all()
+    click.echo("database ready")
+
+
+@click.command('drain-orders')
+@with_appcontext
+def drainOrders():
+    """Places every queued order ticket, for running the intake outside the web workers"""
+    settled = 0
+    while True:
+        batch = order_intake.drain()
+        settled += batch
+        if batch < order_intake.batch_size:
+            break
+    click.echo(f"{settled} tickets settled")
+
+
+@click.command('rebuild-sales-rollup')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help="only rebuild days from this date on")
+@with_appcontext
+def rebuildSalesRollup(since):
+    """Recomputes the daily product sales rollup from the order history"""
+    rows = rebuild_sales(since.date() if since else None)
+    db.session.commit()
+    click.echo(f"{rows} rollup rows written")
+
+
+@click.command('archive-history')
+@click.option('--batch-size', type=int, help="rows moved per transaction, ARCHIVE_BATCH_SIZE by default")
+@with_appcontext
+def archiveHistory(batch_size):
+    """Moves old delivered orders and closed login sessions to the archive tables; safe to interrupt and rerun"""
+    if batch_size:
+        history_archive.batch_size = batch_size
+    orders = history_archive.archive_orders()
+    sessions = history_archive.archive_sessions()
+    click.echo(f"{orders} orders and {sessions} login sessions archived")
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuildSearchIndex():
+    """Creates the product search index if it is missing and reindexes every product"""
+    if not search_available():
+        raise click.ClickException("product search needs SQLite with FTS5")
+    rebuild_search_index()
+    db.session.commit()
+    click.echo("search index rebuilt")
+
+
+@click.command('rebuild-login-identifiers')
+@with_appcontext
+def rebuildLoginIdentifiers():
+    """Indexes every user's email and phone number for login again; run once on databases older than the index"""
+    indexed, skipped = login_identifiers.rebuild()
+    db.session.commit()
+    click.echo(f"{indexed} identifiers indexed, {len(skipped)} users skipped for sharing an email or phone number")
+    if skipped:
+        click.echo(f"skipped user ids, who can't log in until fixed: {', '.join(map(str, skipped))}")
+
+
+@jwt.token_in_blocklist_loader
+def tokenRevoked(jwt_header, jwt_payload):
+    if not current_app.config['JWT_BLACKLIST_ENABLED'] or \
+            jwt_payload['type'] not in current_app.config['JWT_BLACKLIST_TOKEN_CHECKS']:
+        return False
+    return revocation_store.is_revoked(jwt_payload['jti'])
+
+@api.app_errorhandler(RateLimitExceeded)
+def rateLimited(e):
+    response = jsonify({"error": f"too many requests, the limit is {e.limit.limit}"})
+    response.headers['Retry-After'] = str(rate_limit_retry_after())
+    return response, 429
+
+@api.app_errorhandler(RouteBusy)
+def routeBusy(e):
+    response = jsonify({"error": "the server is busy, try again in a moment"})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
 
-@app.route('/')
+@api.app_errorhandler(HashingBusy)
+def hashingBusy(e):
+    response = jsonify({"error": "too many sign ins right now, try again in a moment"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+@api.app_errorhandler(StreamFull)
+def streamFull(e):
+    response = jsonify({"error": "too many live streams right now, try again in a moment"})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+@api.route('/')
 def home():
     return render_template('index.html')
     
-@app.route('/signup', methods=['POST'])
+@api.route('/signup', methods=['POST'])
+@idempotent(per_user=False)
 def signup():
     data = request.get_json()
     name = data.get('name')
@@ -38,10 +204,10 @@ def signup():
     password = data.get('password')
     role = data.get('role')
     
-    if not all(name, email, phone_number, password, role):
+    if not all([name, email, phone_number, password, role]):
         return jsonify({"error": "all fields are required"})
     
-    if User.query.filter((User.email == email) | (User.phone_number == phone_number)).first():
+    if login_identifiers.taken(email, phone_number):
         return jsonify({"error": "two legends cannot coexist sorry, the email or phonenumber exists"}), 400 
     
     newUser = User(name=name, email=email, phone_number=phone_number, role=role)
@@ -60,69 +226,84 @@ def signup():
     
     return({"message": "user created successfully hooray"}), 201
     
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
+@limiter.limit(config_limit('LOGIN_RATE_LIMIT'))
+@limiter.limit(config_limit('LOGIN_ACCOUNT_RATE_LIMIT'), key_func=login_identifier_key)
+@concurrency_caps.capped('login')
 def login():
     data = request.get_json()
     identifier = data.get('identifier')
     password = data.get('password')
     
-    user = User.query.filter((User.email == identifier) | (User.phone_number == identifier)).first()
+    user = login_identifiers.find(identifier)
     if user and user.check_password(password):
-        expires = timedelta(hours=1)
-        access_token = create_access_token(identity=user.id, expires_delta=expires)
+        # upgrade hashes made with older KDF parameters while we have the password
+        if password_hasher.needs_rehash(user.password_hash):
+            user.hash_password(password)
         
-        response = make_response(jsonify({"login": "success"}))
+        jti = str(uuid.uuid4())
+        access_token = create_access_token(identity=user.id,
+                                           expires_delta=current_app.config['LOGIN_TOKEN_EXPIRES'],
+                                           additional_claims={"jti": jti, **identity_claims(user)})
+        db.session.add(LoginSession(user_id=user.id, session_token=jti))
+        db.session.commit()
+        
+        response = make_response(jsonify({"login": "success", "access_token": access_token}))
         response.set_cookie("session_token",
                             access_token,
                             httponly=True,
                             secure=True)
         
-        return jsonify(response), 200
+        return response, 200
     else:
         return jsonify({"error": "we've got an imposter"}), 401
 
-@app.route('/logout', methods=['POST'])
-@jwt_required()
+@api.route('/logout', methods=['POST'])
+@timed_jwt_required()
 def logout():
-    user_id = get_jwt_identity()
-    session_token = request.headers.get('session_token') or request.json.get('session_token')
-    session = LoginSession.query.filter_by(user_id=user_id, session_token=session_token, logout_time=None).first()
+    token = get_jwt()
+    revocation_store.revoke(token['jti'], token['exp'])
+    LoginSession.query.filter_by(session_token=token['jti'], logout_time=None) \
+        .update({"logout_time": db.func.current_timestamp()})
+    db.session.commit()
     
-    if session:
-        session.logout_time = db.func.current_timestamp()
-        db.session.commit()
-        
-        return jsonify({"message": "Logout successful, session terminated"}), 200
-    else:
-        return jsonify({"error": "No active session found"}), 400
+    return jsonify({"message": "Logout successful, session terminated"}), 200
     
-@app.route('/products', methods=['GET', 'POST'])
-@jwt_required()
+@api.route('/products', methods=['GET', 'POST'])
+@timed_jwt_required()
+@limiter.limit(config_limit('CATALOG_RATE_LIMIT'), key_func=user_key, methods=['GET'])
+@concurrency_caps.capped('catalog', methods=['GET'])
 def products():
-    userId = get_jwt_identity()
     if request.method == 'GET':
-        products = Product.query.all()
-        productList = []
+        read_replica.use()
+        filters = parse_catalog_args(request.args,
+                                     default_limit=current_app.config['CATALOG_PAGE_SIZE'],
+                                     max_limit=current_app.config['CATALOG_MAX_PAGE_SIZE'])
+        if wants_ndjson(request):
+            filters.pop('limit')
+            return ndjson_response(stream_catalog(**filters))
+        
+        key = catalog_cache.key(filters)
+        page = catalog_cache.get(key)
+        
+        if page is None:
+            generation = catalog_cache.generation
+            productList, nextAfter = fetch_catalog_page(**filters)
+            page = catalog_cache.put(key, current_app.json.response(productList).get_data(), nextAfter, generation)
         
-        for product in products:
-            farmersName = product.farmer.user.name
-            productDetails = {
-                "name": product.name,
-                "description": product.description,
-                "quantity": product.quantity_available,
-                "price": product.price_per_unit,
-                "farmer": farmersName
-            }
-            productList.append(productDetails)
+        response = current_app.response_class(page.body, mimetype=current_app.json.mimetype)
+        response.set_etag(page.etag)
+        if page.next_after is not None:
+            response.headers['X-Next-After'] = str(page.next_after)
         
-        return jsonify(productList), 200
+        return response.make_conditional(request)
     
     if request.method == 'POST':
         data = request.get_json()
         # Check if the user is a farmer
-        farmer = Farmer.query.filter_by(user_id=userId).first()
+        identity = identity_cache.current()
         
-        if not farmer:
+        if not identity or not identity.farmer_id:
             return jsonify({"error": "Only farmers can add products"}), 403
         
         name = data.get('name')
@@ -130,24 +311,116 @@ def products():
         quantity_available = data.get('quantity_available')
         price_per_unit = data.get('price_per_unit')
         
-        newProduct = Product(farmer_id=farmer.id, name=name, description=description,
+        newProduct = Product(farmer_id=identity.farmer_id, name=name, description=description,
                              quantity_available=quantity_available, price_per_unit=price_per_unit)
         db.session.add(newProduct)
         db.session.commit()
         
         return jsonify({"message": "product created"}), 201
     
-@app.route('/orders', methods=['GET', 'POST'])
-@jwt_required()
+@api.route('/products/search', methods=['GET'])
+@timed_jwt_required()
+@limiter.limit(config_limit('CATALOG_RATE_LIMIT'), key_func=user_key)
+@concurrency_caps.capped('catalog')
+def searchProducts():
+    read_replica.use()
+    if not search_available():
+        return jsonify({"error": "product search is not available on this database"}), 501
+    try:
+        filters = parse_search_args(request.args,
+                                    default_limit=current_app.config['SEARCH_PAGE_SIZE'],
+                                    max_limit=current_app.config['SEARCH_MAX_PAGE_SIZE'])
+    except ValueError as e:
+        return jsonify({"error": f"bad search: {e}"}), 400
+    
+    productList, nextAfter = search_products(**filters)
+    return pageResponse(productList, nextAfter)
+    
+@api.route('/products/import', methods=['POST'])
+@timed_jwt_required()
+def importProducts():
+    identity = identity_cache.current()
+    if not identity or not identity.farmer_id:
+        return jsonify({"error": "Only farmers can add products"}), 403
+    
+    if request.mimetype == CSV_MIMETYPE:
+        records = csv_records(request.stream)
+    elif request.mimetype == NDJSON_MIMETYPE:
+        records = ndjson_records(request.stream)
+    else:
+        return jsonify({"error": "upload products as text/csv or application/x-ndjson"}), 415
+    
+    report = import_products(identity.farmer_id, records,
+                             chunk_size=current_app.config['PRODUCT_IMPORT_CHUNK_SIZE'],
+                             max_errors=current_app.config['PRODUCT_IMPORT_MAX_ERRORS'])
+    
+    if request.args.get('on_error') == 'abort' and report["rejected"]:
+        db.session.rollback()
+        return jsonify({**report, "imported": 0}), 400
+    if not report["imported"] and not report["rejected"]:
+        return jsonify({"error": "the upload has no products"}), 400
+    
+    db.session.commit()
+    return jsonify(report), 201
+    
+@api.route('/products/changes', methods=['GET'])
+@timed_jwt_required()
+def productChanges():
+    read_replica.use()
+    try:
+        filters = parse_changes_args(request.args,
+                                     default_limit=current_app.config['CATALOG_CHANGES_PAGE_SIZE'],
+                                     max_limit=current_app.config['CATALOG_CHANGES_MAX_PAGE_SIZE'])
+    except ValueError:
+        return jsonify({"error": "since must be a version number"}), 400
+    
+    return jsonify(catalog_changes(**filters)), 200
+    
+# each open stream holds a worker thread; see WORKER_THREADS in app.config for the worker classes it needs
+@api.route('/products/stream', methods=['GET'])
+@timed_jwt_required()
+@limiter.limit(config_limit('CATALOG_RATE_LIMIT'), key_func=user_key)
+@concurrency_caps.capped('stream')
+def productStream():
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    if since is not None and not since.isdigit():
+        return jsonify({"error": "since must be a version number"}), 400
+    
+    subscription, backlog = stock_hub.subscribe(int(since) if since is not None else None)
+    response = current_app.response_class(stock_hub.stream(subscription, backlog), mimetype=EVENT_STREAM_MIMETYPE)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+    
+@api.route('/internal/catalog-cache', methods=['GET'])
+@internal_only
+def catalogCacheStats():
+    return jsonify(catalog_cache.stats()), 200
+
+@api.route('/internal/metrics', methods=['GET'])
+@internal_only
+def metrics():
+    return jsonify({"routes": instrumentation.snapshot(), "catalog_cache": catalog_cache.stats(),
+                    "stock_stream": stock_hub.stats(), "price_index": price_index.stats(),
+                    "idempotency": idempotency_store.stats(), "admission": concurrency_caps.stats(),
+                    "login_identifiers": login_identifiers.stats()}), 200
+    
+@api.route('/orders', methods=['GET', 'POST'])
+@timed_jwt_required()
+@limiter.limit(config_limit('ORDER_RATE_LIMIT'), key_func=user_key, methods=['POST'])
+@idempotent()
+@concurrency_caps.capped('orders', methods=['POST'])
 def orders():
-    userId = get_jwt_identity()
-    user = User.query.get(userId)
+    identity = identity_cache.current()
+    if not identity:
+        return jsonify({"error": "Invalid. Unauthorized access"}), 403
     
     if request.method == 'GET':
-        if user.role == 'farmer':
-            return getFarmerOrders(user)
-        elif user.role == 'grocer':
-            return getGrocerOrders(user)
+        read_replica.use()
+        if identity.role == 'farmer':
+            return getFarmerOrders(identity)
+        elif identity.role == 'grocer':
+            return getGrocerOrders(identity)
         else:
             return jsonify({"error": "Invalid. Unauthorized access"}), 403
     
@@ -158,113 +431,123 @@ def orders():
         if not orderItems:
             return jsonify({"error": "no items in the order oops"}), 400
         
-        totalAmount = 0
-        orderItemList = []
-        
-        for item in orderItems:
-            product_id = item.get('product_id')
-            quantity_ordered = item.get('quantity')
-            
-            product = Product.query.filter_by(id=product_id).first()
-            
-            if not product:
-                return jsonify({"error": "product not found"}), 400
-            
-            if product.quantity_available < quantity_ordered:
-                return jsonify({"error": f"we don't have that much sorry, there's only {product.quantity_available}"})
-            
-            totalPrice = product.price_per_unit * quantity_ordered
-            totalAmount += totalPrice
-            
-            orderItem = OrderItem(
-                product_id=product.id,
-                quantity_ordered=quantity_ordered,
-                price_per_unit=product.price_per_unit,
-                total_price=totalPrice
-            )
-            orderItemList.append(orderItem)
-            
-            product.quantity_available -= quantity_ordered
-            
-        newOrder = Order(grocer_id=userId, total_amount=totalAmount)
-        db.session.add(newOrder)
-        db.session.flush()
+        if not identity.grocer_id:
+            return jsonify({"error": "Only grocers can place orders"}), 403
         
-        for orderItem in orderItemList:
-            orderItem.order_id = newOrder.id
-            db.session.add(orderItem)
-            
-        db.session.commit()
-        
-        return jsonify({"message": "order created"}), 201
+        return submitOrder(identity.grocer_id, orderItems)
+
+def submitOrder(grocerId, orderItems):
+    try:
+        lines = order_lines(orderItems)
+    except ReservationError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if current_app.config['ORDER_INTAKE_ASYNC']:
+        ticket = order_intake.enqueue(grocerId, lines)
+        response = jsonify({"message": "order received", "ticket": ticket, "status": "queued"})
+        response.headers['Location'] = url_for('api.orderTicket', ticket=ticket)
+        return response, 202
+    
+    try:
+        place_order(grocerId, lines)
+    except ReservationError as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 400
+    db.session.commit()
+    
+    return jsonify({"message": "order created"}), 201
 
-def getFarmerOrders(user):
-    farmer = Farmer.query.filter_by(user_id=user.id).first()
-    if not farmer:
+@api.route('/orders/tickets/<ticket>', methods=['GET'])
+@timed_jwt_required()
+def orderTicket(ticket):
+    identity = identity_cache.current()
+    row = order_intake.status(ticket)
+    if not row or not identity or row.grocer_id != identity.grocer_id:
+        return jsonify({"error": "no such order ticket"}), 404
+    
+    return jsonify({"ticket": row.ticket, "status": row.status, "order_id": row.order_id, "error": row.error}), 200
+
+@api.route('/sourcing', methods=['POST'])
+@timed_jwt_required()
+def sourcing():
+    identity = identity_cache.current()
+    if not identity or not identity.grocer_id:
+        return jsonify({"error": "Only grocers can source orders"}), 403
+    
+    data = request.get_json()
+    try:
+        lines = shopping_list(data.get('items'), current_app.config['SOURCING_MAX_ITEMS'])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    place = bool(data.get('place'))
+    if not place:
+        read_replica.use()
+    plan = price_index.source(lines)
+    if not place:
+        return jsonify(plan), 200
+    
+    if not plan["complete"]:
+        return jsonify({"error": "not enough stock to fill the shopping list", "plan": plan}), 409
+    return submitOrder(identity.grocer_id, plan["order_items"])
+
+@api.route('/analytics/sales', methods=['GET'])
+@timed_jwt_required()
+def salesAnalytics():
+    identity = identity_cache.current()
+    if not identity or not identity.farmer_id:
+        return jsonify({"error": "Only farmers have sales"}), 403
+    
+    read_replica.use()
+    try:
+        filters = parse_sales_args(request.args)
+    except ValueError:
+        return jsonify({"error": "since and until must be ISO 8601 dates"}), 400
+    
+    return jsonify(farmer_sales(identity.farmer_id, **filters)), 200
+
+def historyFilters():
+    return parse_history_args(request.args,
+                              default_limit=current_app.config['ORDER_HISTORY_PAGE_SIZE'],
+                              max_limit=current_app.config['ORDER_HISTORY_MAX_PAGE_SIZE'])
+
+def pageResponse(page, nextAfter):
+    response = jsonify(page)
+    if nextAfter is not None:
+        response.headers['X-Next-After'] = str(nextAfter)
+    return response, 200
+
+def getFarmerOrders(identity):
+    if not identity.farmer_id:
         return jsonify({"message": "farmer profile not found"}), 404
     
-    orders = Order.query.join(OrderItem).join(Product).filter(Product.farmer_id == farmer.id).distinct().all()
+    try:
+        filters = historyFilters()
+    except ValueError:
+        return jsonify({"error": "since and until must be ISO 8601 dates"}), 400
     
-    orderList = []
-    for order in orders:
-        productList = []
-        
-        for item in order.items:
-            if item.product.farmer_id == farmer.id:
-                productDetails = {
-                    "product_name": item.product.name,
-                    "quantity_ordered": item.quantity_ordered,
-                    "price_per_unit": item.price_per_unit
-                }
-                productList.append(productDetails)
-                
-        totalAmount = sum(item.total_price for item in order.items if item.product.farmer_id == farmer.id)
-            
-        grocerName = order.grocer.user.name if order.grocer and order.grocer.user else "Unknown"
-        orderDetails = {
-            "order_id": order.id,
-            "grocer_name": grocerName,
-            "products": productList,
-            "total_amount": totalAmount,
-            "order_date": order.order_date
-        }
-        orderList.append(orderDetails)
-        
-            
-    return jsonify(orderList), 200
+    if wants_ndjson(request):
+        filters.pop('limit')
+        return ndjson_response(stream_farmer_orders(identity.farmer_id, **filters))
+    
+    orderList, nextAfter = farmer_order_history(identity.farmer_id, **filters)
+    return pageResponse(orderList, nextAfter)
 
-def getGrocerOrders(user):
-    grocer = Grocer.query.filter_by(user_id=user.id).first()
-    if not grocer:
+def getGrocerOrders(identity):
+    if not identity.grocer_id:
         return jsonify({"message": "Grocer profile not found"}), 404
     
-    orders = Order.query.filter_by(grocer_id=grocer.id).all()
+    try:
+        filters = historyFilters()
+    except ValueError:
+        return jsonify({"error": "since and until must be ISO 8601 dates"}), 400
     
-    orderList = []
-    for order in orders:
-        productList = []
-        
-        for item in order.items:
-            grocerName = item.order.grocer.user.name
-            productDetails = {
-                "product_name": item.product.name,
-                "farmer_name": item.product.farmer.user.name,
-                "quantity_ordered": item.quantity_ordered,
-                "price_per_unit": item.price_per_unit,
-                "total_price": item.total_price
-            }
-            productList.append(productDetails)
-        
-        orderDetails = {
-            "order_id": order.id,
-            "grocer_name": grocerName,
-            "products": productList,
-            "total_amount": order.total_amount,
-            "order_date": order.order_date
-        }
-        orderList.append(orderDetails)
-        
-    return jsonify(orderList), 200
+    if wants_ndjson(request):
+        filters.pop('limit')
+        return ndjson_response(stream_grocer_orders(identity.grocer_id, identity.name, **filters))
+    
+    orderList, nextAfter = grocer_order_history(identity.grocer_id, identity.name, **filters)
+    return pageResponse(orderList, nextAfter)
 
 if __name__ == '__main__':
-    app.run(port=5000, debug=True)
+    create_app().run(port=5000, debug=True)
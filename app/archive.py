@@ -0,0 +1,101 @@
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, delete, func
+from app.models import (db, Order, OrderItem, OrderTicket, LoginSession, ArchivedOrder, ArchivedOrderItem,
+                        ArchivedLoginSession)
+
+Tier = namedtuple('Tier', ['orders', 'items'])
+
+HOT = Tier(Order, OrderItem)
+ARCHIVE = Tier(ArchivedOrder, ArchivedOrderItem)
+
+
+class HistoryArchive:
+    """
+    Moves cold history out of the tables the app reads and writes.
+
+    Delivered orders placed more than ARCHIVE_ORDER_AGE ago move with their
+    items to archivedOrders and archivedOrderItems, and login sessions
+    closed more than ARCHIVE_SESSION_AGE ago to archivedLoginSessions, ids
+    and all. Intake tickets of moved orders are deleted with them; a client
+    polls a ticket for seconds, not a year. Each batch of ARCHIVE_BATCH_SIZE rows is copied and deleted in
+    one transaction, so an interrupted run loses nothing and the next run
+    carries on from the rows still left.
+
+    Order history reads the hot tables alone unless its date range reaches
+    back to the newest archived order, in which case both tiers are read.
+    """
+
+    def __init__(self):
+        self.order_age = timedelta(days=365)
+        self.session_age = timedelta(days=7)
+        self.batch_size = 1000
+
+    def init_app(self, app):
+        self.order_age = app.config['ARCHIVE_ORDER_AGE']
+        self.session_age = app.config['ARCHIVE_SESSION_AGE']
+        self.batch_size = app.config['ARCHIVE_BATCH_SIZE']
+
+    def horizon(self):
+        """The order date of the newest archived order, or None while the archive is empty"""
+        return db.session.execute(select(func.max(ArchivedOrder.order_date))).scalar()
+
+    def tiers(self, since=None, until=None):
+        """The tiers an order history over [since, until) has to read"""
+        if since is None and until is None:
+            return (HOT,)
+        horizon = self.horizon()
+        if horizon is None or (since is not None and since > horizon):
+            return (HOT,)
+        return (HOT, ARCHIVE)
+
+    def archive_orders(self, now=None):
+        """Moves delivered orders past ARCHIVE_ORDER_AGE and their items to the archive; returns how many orders moved"""
+        cutoff = (now or _utcnow()) - self.order_age
+        candidates = select(Order.id).where(Order.delivery_date.is_not(None), Order.order_date < cutoff)
+
+        def move(ids):
+            _copy(ArchivedOrderItem, OrderItem, OrderItem.order_id.in_(ids))
+            _copy(ArchivedOrder, Order, Order.id.in_(ids))
+            db.session.execute(delete(OrderTicket).where(OrderTicket.order_id.in_(ids)))
+            db.session.execute(delete(OrderItem).where(OrderItem.order_id.in_(ids)))
+            db.session.execute(delete(Order).where(Order.id.in_(ids)))
+        return self._in_batches(candidates, Order.id, move)
+
+    def archive_sessions(self, now=None):
+        """Moves login sessions closed before ARCHIVE_SESSION_AGE to the archive; returns how many moved"""
+        cutoff = (now or _utcnow()) - self.session_age
+        candidates = select(LoginSession.id).where(LoginSession.logout_time < cutoff)
+
+        def move(ids):
+            _copy(ArchivedLoginSession, LoginSession, LoginSession.id.in_(ids))
+            db.session.execute(delete(LoginSession).where(LoginSession.id.in_(ids)))
+        return self._in_batches(candidates, LoginSession.id, move)
+
+    def _in_batches(self, candidates, key, move):
+        moved = 0
+        lastId = 0
+        while True:
+            ids = db.session.execute(
+                candidates.where(key > lastId).order_by(key).limit(self.batch_size)
+            ).scalars().all()
+            if not ids:
+                return moved
+            move(ids)
+            db.session.commit()
+            moved += len(ids)
+            lastId = ids[-1]
+
+
+history_archive = HistoryArchive()
+
+
+def _copy(archive, model, where):
+    columns = [column.name for column in archive.__table__.columns]
+    db.session.execute(archive.__table__.insert().from_select(
+        columns, select(*(model.__table__.c[name] for name in columns)).where(where)
+    ))
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,116 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from sqlalchemy import event
+from app.models import db, Product
+
+CachedPage = namedtuple('CachedPage', ['body', 'etag', 'next_after', 'expires'])
+
+
+class CatalogCache:
+    """
+    LRU cache of serialized catalog pages with a TTL, keyed by the parsed query.
+
+    The cache lives in the worker process, so every committed write to
+    Product clears it through session events. Other gunicorn workers only see
+    the change once their own entries expire, which CATALOG_CACHE_TTL bounds.
+    """
+
+    def __init__(self, max_entries=256, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._generation = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_entries = app.config['CATALOG_CACHE_SIZE']
+        self.ttl = app.config['CATALOG_CACHE_TTL']
+        if not event.contains(db.session, 'after_commit', _clear_if_products_changed):
+            event.listen(db.session, 'after_flush', _mark_product_flush)
+            event.listen(db.session, 'do_orm_execute', _mark_product_statement)
+            event.listen(db.session, 'after_commit', _clear_if_products_changed)
+            event.listen(db.session, 'after_rollback', _forget_product_changes)
+
+    @staticmethod
+    def key(filters):
+        return tuple(sorted(filters.items()))
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is None or page.expires < time.monotonic():
+                self._pages.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def put(self, key, body, next_after, generation):
+        """
+        Stores a page loaded while the cache was at `generation`; pages
+        loaded before an invalidation are returned but not kept.
+        """
+        page = CachedPage(body, hashlib.blake2b(body, digest_size=16).hexdigest(),
+                          next_after, time.monotonic() + self.ttl)
+        if self.max_entries <= 0:
+            return page
+
+        with self._lock:
+            if generation == self._generation:
+                self._pages[key] = page
+                self._pages.move_to_end(key)
+                while len(self._pages) > self.max_entries:
+                    self._pages.popitem(last=False)
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            self._pages.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._pages),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations
+            }
+
+
+catalog_cache = CatalogCache()
+
+
+def _mark_product_flush(session, flush_context):
+    if any(isinstance(obj, Product) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info['catalog_changed'] = True
+
+
+def _mark_product_statement(orm_execute_state):
+    # bulk statements such as the stock reservation and product imports skip the flush
+    if (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete) and \
+            orm_execute_state.bind_mapper is not None and orm_execute_state.bind_mapper.class_ is Product:
+        orm_execute_state.session.info['catalog_changed'] = True
+
+
+def _clear_if_products_changed(session):
+    if session.info.pop('catalog_changed', False):
+        catalog_cache.clear()
+
+
+def _forget_product_changes(session):
+    session.info.pop('catalog_changed', None)
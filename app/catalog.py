@@ -0,0 +1,84 @@
+from sqlalchemy import select
+from app.models import db, User, Farmer, Product
+from app.serialization import RowSerializer
+from app.streaming import stream_rows
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def parse_catalog_args(args, default_limit=DEFAULT_PAGE_SIZE, max_limit=MAX_PAGE_SIZE):
+    """Pulls the keyset cursor and filters for the catalog out of the query string"""
+    limit = args.get('limit', default_limit, type=int)
+
+    return {
+        "after": args.get('after', type=int),
+        "limit": max(1, min(limit, max_limit)),
+        "farmer_id": args.get('farmer_id', type=int),
+        "min_price": args.get('min_price', type=float),
+        "max_price": args.get('max_price', type=float),
+        "min_quantity": args.get('min_quantity', type=int)
+    }
+
+
+def catalog_query(after=None, farmer_id=None, min_price=None, max_price=None, min_quantity=None):
+    """Products with their farmer's name in a single statement, ordered by id for keyset paging"""
+    query = (
+        select(Product.id,
+               Product.name,
+               Product.description,
+               Product.quantity_available,
+               Product.price_per_unit,
+               User.name.label('farmer_name'))
+        .outerjoin(Farmer, Product.farmer_id == Farmer.id)
+        .outerjoin(User, Farmer.user_id == User.id)
+    )
+
+    if after is not None:
+        query = query.where(Product.id > after)
+    if farmer_id is not None:
+        query = query.where(Product.farmer_id == farmer_id)
+    if min_price is not None:
+        query = query.where(Product.price_per_unit >= min_price)
+    if max_price is not None:
+        query = query.where(Product.price_per_unit <= max_price)
+    if min_quantity is not None:
+        query = query.where(Product.quantity_available >= min_quantity)
+
+    return query.order_by(Product.id)
+
+
+serialize_product = RowSerializer({
+    "id": "id",
+    "name": "name",
+    "description": "description",
+    "quantity": "quantity_available",
+    "price": "price_per_unit",
+    "farmer": "farmer_name"
+})
+
+
+def fetch_catalog_page(limit=DEFAULT_PAGE_SIZE, **filters):
+    """
+    Returns one page of the catalog and the cursor for the next page.
+    One extra row is fetched to tell whether another page exists, so the
+    cursor is None on the last page.
+    """
+    result = db.session.execute(catalog_query(**filters).limit(limit + 1))
+    rows = result.all()
+
+    nextAfter = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        nextAfter = rows[-1].id
+
+    serialize = serialize_product.compile(result.keys())
+    return [serialize(row) for row in rows], nextAfter
+
+
+def stream_catalog(**filters):
+    """Every product matching the filters, one at a time, for the NDJSON format"""
+    result = stream_rows(catalog_query(**filters))
+    serialize = serialize_product.compile(result.keys())
+    for row in result:
+        yield serialize(row)
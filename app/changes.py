@@ -0,0 +1,221 @@
+import secrets
+from sqlalchemy import event, select, insert, update, literal, null, union_all
+from app.models import db, User, Farmer, Product, CatalogVersion, ProductTombstone
+from app.database import upsert_insert
+from app.serialization import RowSerializer
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10_000
+
+
+class CatalogVersioning:
+    """
+    Numbers every committed change to the catalog so clients can sync deltas.
+
+    A transaction that writes products stamps every product it creates or
+    edits, through the ORM or a bulk statement alike, with a negative
+    placeholder of its own; deleted products leave a tombstone with it. Only
+    when it commits does it take the next value of a one-row counter and
+    swap that in for the placeholder. The counter row stays locked until the
+    commit ends, so versions commit in increasing order and a client that
+    has read version N has seen every change up to N.
+
+    Taking the counter at commit rather than at the first write keeps
+    concurrent checkouts from queueing behind each other for the whole of
+    their stock reservation; they only serialize for the commit itself. The
+    price is one more UPDATE per commit that changed the catalog, rewriting
+    the version of the rows it wrote through the version indexes.
+    """
+
+    def __init__(self):
+        self._listeners = []
+
+    def init_app(self, app):
+        if not event.contains(db.session, 'before_flush', _version_flushed_products):
+            event.listen(db.session, 'before_flush', _version_flushed_products)
+            event.listen(db.session, 'do_orm_execute', _version_product_statement)
+            event.listen(db.session, 'before_commit', _allocate_version)
+            event.listen(db.session, 'after_commit', _announce_version)
+            event.listen(db.session, 'after_rollback', _forget_version)
+
+    def on_commit(self, listener):
+        """Calls listener(version) after each commit that changed the catalog, on the committing thread"""
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+
+catalog_versioning = CatalogVersioning()
+
+
+def pending_version(session, table):
+    """The placeholder the session's transaction stamps on products or tombstones until it commits"""
+    session.info.setdefault('catalog_stamped', set()).add(table)
+    placeholder = session.info.get('catalog_placeholder')
+    if placeholder is None:
+        placeholder = session.info['catalog_placeholder'] = -1 - secrets.randbelow(2 ** 31 - 1)
+    return placeholder
+
+
+def _allocate_version(session):
+    session.flush()
+    placeholder = session.info.pop('catalog_placeholder', None)
+    stamped = session.info.pop('catalog_stamped', set())
+    if placeholder is None:
+        return
+
+    statement = upsert_insert(CatalogVersion, session).values(id=1, version=1)
+    statement = statement.on_conflict_do_update(
+        index_elements=[CatalogVersion.id], set_={"version": CatalogVersion.version + 1}
+    )
+    version = session.execute(statement.returning(CatalogVersion.version)).scalar_one()
+    if Product in stamped:
+        session.execute(update(Product).where(Product.version == placeholder).values(version=version)
+                        .execution_options(catalog_versioned=True, synchronize_session=False))
+    if ProductTombstone in stamped:
+        session.execute(update(ProductTombstone).where(ProductTombstone.version == placeholder)
+                        .values(version=version).execution_options(synchronize_session=False))
+    session.info['catalog_version'] = version
+
+
+def _version_flushed_products(session, flush_context, instances):
+    changed = [obj for obj in session.new if isinstance(obj, Product)]
+    changed += [obj for obj in session.dirty
+                if isinstance(obj, Product) and session.is_modified(obj, include_collections=False)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Product)]
+    if not changed and not deleted:
+        return
+
+    for product in changed:
+        product.version = pending_version(session, Product)
+    session.add_all(ProductTombstone(product_id=product.id, version=pending_version(session, ProductTombstone))
+                    for product in deleted)
+
+
+def _writes_products(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return False
+    if orm_execute_state.execution_options.get('catalog_versioned'):
+        return False
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None:
+        return mapper.class_ is Product
+    # Core statements on the table, such as the seeder's inserts, have no mapper
+    return orm_execute_state.statement.table is Product.__table__
+
+
+def _version_product_statement(orm_execute_state):
+    # bulk statements such as the stock reservation and product imports skip the flush
+    if not _writes_products(orm_execute_state):
+        return
+
+    statement = orm_execute_state.statement
+    session = orm_execute_state.session
+    if orm_execute_state.is_insert or orm_execute_state.is_update:
+        orm_execute_state.statement = statement.values(version=pending_version(session, Product))
+    elif orm_execute_state.is_delete:
+        doomed = select(Product.id, literal(pending_version(session, ProductTombstone)))
+        if statement.whereclause is not None:
+            doomed = doomed.where(statement.whereclause)
+        session.execute(insert(ProductTombstone).from_select(['product_id', 'version'], doomed))
+
+
+def _announce_version(session):
+    version = session.info.pop('catalog_version', None)
+    if version is not None:
+        for listener in catalog_versioning._listeners:
+            listener(version)
+
+
+def _forget_version(session):
+    session.info.pop('catalog_placeholder', None)
+    session.info.pop('catalog_stamped', None)
+    session.info.pop('catalog_version', None)
+
+
+def current_version():
+    """The newest committed catalog version"""
+    return db.session.execute(select(CatalogVersion.version).where(CatalogVersion.id == 1)).scalar() or 0
+
+
+def parse_changes_args(args, default_limit=DEFAULT_PAGE_SIZE, max_limit=MAX_PAGE_SIZE):
+    """The client's last seen version and the page size. Raises ValueError on a malformed version."""
+    since = args.get('since')
+    limit = args.get('limit', default_limit, type=int)
+    return {
+        "since": int(since) if since else None,
+        "limit": max(1, min(limit, max_limit))
+    }
+
+
+def changes_query(since=None, until=None):
+    """
+    Products written after version `since`, and tombstones of products
+    deleted after it, in one statement ordered by version. Each half is a
+    range scan of its version index. Without `since` it lists every product.
+    """
+    products = (
+        select(Product.version.label('version'),
+               Product.id.label('id'),
+               literal(False).label('deleted'),
+               Product.name,
+               Product.description,
+               Product.quantity_available,
+               Product.price_per_unit,
+               User.name.label('farmer_name'))
+        .outerjoin(Farmer, Product.farmer_id == Farmer.id)
+        .outerjoin(User, Farmer.user_id == User.id)
+    )
+    if until is not None:
+        products = products.where(Product.version <= until)
+    if since is None:
+        return products.order_by(Product.version, Product.id)
+
+    tombstones = (
+        select(ProductTombstone.version, ProductTombstone.product_id, literal(True),
+               null(), null(), null(), null(), null())
+        .where(ProductTombstone.version > since)
+    )
+    if until is not None:
+        tombstones = tombstones.where(ProductTombstone.version <= until)
+    query = union_all(products.where(Product.version > since), tombstones)
+    return query.order_by(query.selected_columns.version, query.selected_columns.id)
+
+
+serialize_change = RowSerializer({
+    "id": "id",
+    "name": "name",
+    "description": "description",
+    "quantity": "quantity_available",
+    "price": "price_per_unit",
+    "farmer": "farmer_name",
+    "version": "version"
+})
+
+
+def catalog_changes(since=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Up to about `limit` changes after version `since` and the version to ask
+    from next. A page always ends on a whole version, since every change of a
+    transaction shares one; a transaction larger than `limit` comes whole.
+    """
+    result = db.session.execute(changes_query(since).limit(limit + 1))
+    columns = result.keys()
+    rows = result.all()
+
+    more = len(rows) > limit
+    if more:
+        cutoff = rows[limit].version
+        rows = [row for row in rows[:limit] if row.version < cutoff]
+        if not rows:
+            rows = db.session.execute(changes_query(cutoff - 1, until=cutoff)).all()
+
+    serialize = serialize_change.compile(columns)
+    products = [serialize(row) for row in rows if not row.deleted]
+    alive = {product["id"] for product in products}
+    return {
+        "version": rows[-1].version if rows else since or 0,
+        "more": more,
+        "products": products,
+        # an id reused by a newer product is alive again
+        "deleted": [row.id for row in rows if row.deleted and row.id not in alive]
+    }
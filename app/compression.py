@@ -0,0 +1,57 @@
+import gzip
+import zlib
+from flask import request
+from app.instrumentation import phase
+
+ENCODINGS = ('gzip', 'deflate')
+
+
+class Compression:
+    """
+    Compresses JSON and HTML bodies of at least COMPRESS_MIN_SIZE bytes with
+    gzip or deflate, whichever the client's Accept-Encoding ranks higher.
+    Streamed bodies are sent as they are. The ETag of a compressed response
+    is made weak, since it was computed for the uncompressed bytes, which
+    keeps If-None-Match answering 304.
+    """
+
+    def init_app(self, app):
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.level = app.config['COMPRESS_LEVEL']
+        self.mimetypes = frozenset(app.config['COMPRESS_MIMETYPES'])
+        if self.min_size:
+            app.after_request(self._compress)
+
+    def _encoding(self):
+        accepted = request.accept_encodings
+        # max keeps the first of equally ranked encodings, so gzip wins ties
+        encoding = max(ENCODINGS, key=accepted.quality)
+        return encoding if accepted.quality(encoding) > 0 else None
+
+    def _compress(self, response):
+        if response.mimetype not in self.mimetypes or response.is_streamed or response.direct_passthrough \
+                or response.status_code < 200 or response.status_code in (204, 304) \
+                or 'Content-Encoding' in response.headers:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self._encoding()
+        if encoding is None or (response.content_length or 0) < self.min_size:
+            return response
+
+        with phase('compress'):
+            body = response.get_data()
+            if encoding == 'gzip':
+                body = gzip.compress(body, self.level, mtime=0)
+            else:
+                body = zlib.compress(body, self.level)
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+compression = Compression()
@@ -5,10 +5,28 @@ from datetime import timedelta
 basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv()
 
+def engine_options():
+    """SQLAlchemy pool options from the environment; unset ones keep SQLAlchemy's defaults"""
+    options = {"pool_pre_ping": os.getenv('DB_POOL_PRE_PING', 'false').lower() == 'true'}
+    for option, variable in (('pool_size', 'DB_POOL_SIZE'), ('max_overflow', 'DB_MAX_OVERFLOW'),
+                             ('pool_recycle', 'DB_POOL_RECYCLE'), ('pool_timeout', 'DB_POOL_TIMEOUT')):
+        if os.getenv(variable):
+            options[option] = int(os.getenv(variable))
+    return options
+
 class Config:
     """Base Configuration"""
     SECRET_KEY = os.getenv('SECRET_KEY')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options()
+    # reads from views marked read only go here when set, e.g. a replica
+    SQLALCHEMY_BINDS = {'replica': os.getenv('READ_DATABASE_URI')} if os.getenv('READ_DATABASE_URI') else {}
+    SQLITE_PRAGMAS = {
+        "journal_mode": os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+        "synchronous": os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        "busy_timeout": int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        "cache_size": int(os.getenv('SQLITE_CACHE_SIZE', -20000))
+    }
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=15)
     JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=30)
@@ -18,6 +36,95 @@ class Config:
     JWT_COOKIE_SAMESITE = 'Lax'
     JWT_BLACKLIST_ENABLED = True
     JWT_BLACKLIST_TOKEN_CHECKS = ['access', 'refresh']
+    LOGIN_TOKEN_EXPIRES = timedelta(hours=1)
+    IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', 10000))
+    IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', 300))
+    # unknown login identifiers are turned away without a query for this long
+    LOGIN_NEGATIVE_CACHE_SIZE = int(os.getenv('LOGIN_NEGATIVE_CACHE_SIZE', 10000))
+    LOGIN_NEGATIVE_CACHE_TTL = float(os.getenv('LOGIN_NEGATIVE_CACHE_TTL', 60))
+    REVOCATION_CACHE_SIZE = int(os.getenv('REVOCATION_CACHE_SIZE', 100000))
+    REVOCATION_SYNC_INTERVAL = float(os.getenv('REVOCATION_SYNC_INTERVAL', 5))
+    REVOCATION_BLOOM_CAPACITY = int(os.getenv('REVOCATION_BLOOM_CAPACITY', 0))
+    REVOCATION_PURGE_INTERVAL = float(os.getenv('REVOCATION_PURGE_INTERVAL', 300))
+    # how far back each sync looks again for revocations that committed after later ones
+    REVOCATION_SYNC_OVERLAP = timedelta(seconds=int(os.getenv('REVOCATION_SYNC_OVERLAP', 30)))
+    LOGIN_SESSION_RETENTION = timedelta(days=int(os.getenv('LOGIN_SESSION_RETENTION_DAYS', 30)))
+    CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', 100))
+    CATALOG_MAX_PAGE_SIZE = int(os.getenv('CATALOG_MAX_PAGE_SIZE', 500))
+    CATALOG_CACHE_SIZE = int(os.getenv('CATALOG_CACHE_SIZE', 256))
+    CATALOG_CACHE_TTL = float(os.getenv('CATALOG_CACHE_TTL', 30))
+    SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+    SEARCH_MAX_PAGE_SIZE = int(os.getenv('SEARCH_MAX_PAGE_SIZE', 100))
+    CATALOG_CHANGES_PAGE_SIZE = int(os.getenv('CATALOG_CHANGES_PAGE_SIZE', 1000))
+    CATALOG_CHANGES_MAX_PAGE_SIZE = int(os.getenv('CATALOG_CHANGES_MAX_PAGE_SIZE', 10000))
+    STOCK_STREAM_QUEUE_SIZE = int(os.getenv('STOCK_STREAM_QUEUE_SIZE', 100))
+    STOCK_STREAM_HEARTBEAT = float(os.getenv('STOCK_STREAM_HEARTBEAT', 15))
+    # how often streams look for commits made by other workers; 0 leaves dispatching to stock_hub.dispatch()
+    STOCK_STREAM_POLL_INTERVAL = float(os.getenv('STOCK_STREAM_POLL_INTERVAL', 1))
+    # An open stream holds a worker thread for as long as the client listens, so GET /products/stream
+    # needs gunicorn's gthread workers (-k gthread --threads WORKER_THREADS) or gevent workers
+    # (-k gevent --worker-connections WORKER_THREADS); a sync worker would be taken by a single client.
+    # Streams get at most half of each worker's budget, so other requests always have threads left.
+    WORKER_THREADS = int(os.getenv('WORKER_THREADS', 8))
+    STOCK_STREAM_MAX_SUBSCRIBERS = int(os.getenv('STOCK_STREAM_MAX_SUBSCRIBERS', max(1, WORKER_THREADS // 2)))
+    # how stale the sourcing price index may get about commits made by other workers, in seconds
+    SOURCING_REFRESH_INTERVAL = float(os.getenv('SOURCING_REFRESH_INTERVAL', 1))
+    SOURCING_MAX_ITEMS = int(os.getenv('SOURCING_MAX_ITEMS', 100))
+    INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION_ENABLED', 'false').lower() == 'true'
+    # the /internal routes answer only requests sending this in X-Internal-Token; unset, they are off
+    INTERNAL_TOKEN = os.getenv('INTERNAL_TOKEN')
+    SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 500))
+    SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100))
+    SLOW_LOG_PATH = os.getenv('SLOW_LOG_PATH')
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    PASSWORD_SALT_LENGTH = int(os.getenv('PASSWORD_SALT_LENGTH', 16))
+    HASH_POOL_WORKERS = int(os.getenv('HASH_POOL_WORKERS', 2))
+    HASH_POOL_MAX_PENDING = int(os.getenv('HASH_POOL_MAX_PENDING', 8))
+    HASH_POOL_TIMEOUT = float(os.getenv('HASH_POOL_TIMEOUT', 30))
+    HASH_ADMISSION_TIMEOUT = float(os.getenv('HASH_ADMISSION_TIMEOUT', 0.5))
+    ORDER_HISTORY_PAGE_SIZE = int(os.getenv('ORDER_HISTORY_PAGE_SIZE', 100))
+    ORDER_HISTORY_MAX_PAGE_SIZE = int(os.getenv('ORDER_HISTORY_MAX_PAGE_SIZE', 500))
+    ORDER_INTAKE_ASYNC = os.getenv('ORDER_INTAKE_ASYNC', 'false').lower() == 'true'
+    ORDER_INTAKE_BATCH_SIZE = int(os.getenv('ORDER_INTAKE_BATCH_SIZE', 200))
+    ORDER_INTAKE_POLL_INTERVAL = float(os.getenv('ORDER_INTAKE_POLL_INTERVAL', 0.5))
+    IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 86400))
+    IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))
+    # how long a retry waits for the first request with its key before answering 409
+    IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', 10))
+    # a key claimed by a request that never finished, say in a crashed worker, is free again after this
+    IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', 60))
+    IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv('IDEMPOTENCY_PURGE_INTERVAL', 300))
+    # delivered orders older than this, and sessions closed longer ago than this, move to the archive tables
+    ARCHIVE_ORDER_AGE = timedelta(days=int(os.getenv('ARCHIVE_ORDER_AGE_DAYS', 365)))
+    ARCHIVE_SESSION_AGE = timedelta(days=int(os.getenv('ARCHIVE_SESSION_AGE_DAYS', 7)))
+    ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 1000))
+    RATELIMIT_ENABLED = os.getenv('RATELIMIT_ENABLED', 'true').lower() == 'true'
+    RATELIMIT_STORAGE_URI = os.getenv('RATELIMIT_STORAGE_URI', 'memory://')
+    RATELIMIT_STRATEGY = os.getenv('RATELIMIT_STRATEGY', 'moving-window')
+    # per client address and per account tried, so one caller can't keep the KDF busy for everyone
+    LOGIN_RATE_LIMIT = os.getenv('LOGIN_RATE_LIMIT', '30/minute')
+    LOGIN_ACCOUNT_RATE_LIMIT = os.getenv('LOGIN_ACCOUNT_RATE_LIMIT', '10/minute')
+    # per signed in user
+    ORDER_RATE_LIMIT = os.getenv('ORDER_RATE_LIMIT', '60/minute')
+    CATALOG_RATE_LIMIT = os.getenv('CATALOG_RATE_LIMIT', '600/minute')
+    # requests each worker process runs at once per expensive route; 0 leaves a route uncapped
+    ROUTE_CONCURRENCY = {
+        "login": int(os.getenv('LOGIN_CONCURRENCY', 4)),
+        "orders": int(os.getenv('ORDER_CONCURRENCY', 8)),
+        "catalog": int(os.getenv('CATALOG_CONCURRENCY', 16)),
+        # open stock streams, the same budget as STOCK_STREAM_MAX_SUBSCRIBERS
+        "stream": STOCK_STREAM_MAX_SUBSCRIBERS
+    }
+    ADMISSION_WAIT = float(os.getenv('ADMISSION_WAIT', 0.05))
+    ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 1))
+    PRODUCT_IMPORT_CHUNK_SIZE = int(os.getenv('PRODUCT_IMPORT_CHUNK_SIZE', 5000))
+    PRODUCT_IMPORT_MAX_ERRORS = int(os.getenv('PRODUCT_IMPORT_MAX_ERRORS', 1000))
+    # 'fast' encodes with orjson when it is installed, 'default' is Flask's own provider
+    JSON_PROVIDER = os.getenv('JSON_PROVIDER', 'fast')
+    # bodies smaller than this many bytes go uncompressed; 0 turns compression off
+    COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+    COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+    COMPRESS_MIMETYPES = ['application/json', 'text/html']
     
 
 @staticmethod
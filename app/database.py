@@ -0,0 +1,69 @@
+from flask import current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+
+READ_BIND = 'replica'
+# databases whose INSERT has ON CONFLICT, which the rollups, counters and claims rely on
+UPSERT_DIALECTS = {'sqlite': sqlite, 'postgresql': postgresql}
+
+
+class RoutingSession(Session):
+    """
+    Sends plain SELECTs to the `replica` bind while the session is marked
+    read only. Flushes and every INSERT, UPDATE and DELETE still go to the
+    primary, so a view that does write by mistake stays correct.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('read_only') and not self._flushing \
+                and getattr(clause, 'is_select', False):
+            replica = self._db.engines.get(READ_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReadReplica:
+    """
+    Applies SQLITE_PRAGMAS to every SQLite connection the app opens and lets
+    read-only views move their queries onto the `replica` bind configured by
+    READ_DATABASE_URI. Without that bind `use()` changes nothing.
+    """
+
+    def init_app(self, app):
+        pragmas = app.config['SQLITE_PRAGMAS']
+        with app.app_context():
+            engines = app.extensions['sqlalchemy'].engines
+            for engine in engines.values():
+                if engine.dialect.name == 'sqlite' and pragmas:
+                    event.listen(engine, 'connect', lambda connection, record: _set_pragmas(connection, pragmas))
+        app.teardown_request(self._finish_request)
+
+    def use(self):
+        """Routes the rest of the request's reads, streamed bodies included, to the replica"""
+        current_app.extensions['sqlalchemy'].session.info['read_only'] = True
+
+    def _finish_request(self, exc):
+        session = current_app.extensions['sqlalchemy'].session
+        if session.registry.has():
+            session.info.pop('read_only', None)
+
+
+read_replica = ReadReplica()
+
+
+def upsert_insert(entity, session):
+    """An INSERT into `entity` with on_conflict_do_nothing/do_update for the session's database"""
+    name = session.get_bind().dialect.name
+    dialect = UPSERT_DIALECTS.get(name)
+    if dialect is None:
+        raise NotImplementedError(f"upserts need one of {', '.join(sorted(UPSERT_DIALECTS))}, not {name}")
+    return dialect.insert(entity)
+
+
+def _set_pragmas(connection, pragmas):
+    cursor = connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
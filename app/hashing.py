@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool has no room for another password"""
+
+
+def stored_method(method):
+    """
+    The method prefix Werkzeug writes for `method`, defaults filled in, as in
+    'scrypt' -> 'scrypt:32768:8:1'. Worked out from the string, since a hash
+    costs a full KDF run at every app start.
+    """
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        if not args:
+            args = [2 ** 15, 8, 1]
+        elif len(args) != 3:
+            raise ValueError("'scrypt' takes 3 arguments.")
+        return ':'.join([name, *map(str, map(int, args))])
+    if name == 'pbkdf2':
+        if len(args) > 2:
+            raise ValueError("'pbkdf2' takes 2 arguments.")
+        hashName = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f"{name}:{hashName}:{iterations}"
+    raise ValueError(f"Invalid hash method '{method}'.")
+
+
+class PasswordHasher:
+    """
+    Runs Werkzeug's password KDF on a small process pool so slow hashes don't
+    hold a gunicorn worker's CPU while cheaper requests wait.
+
+    At most HASH_POOL_MAX_PENDING hashes are admitted per process; callers
+    beyond that wait HASH_ADMISSION_TIMEOUT seconds for a slot and then get
+    HashingBusy. With HASH_POOL_WORKERS set to 0 hashes run inline but are
+    still admission controlled.
+    """
+
+    def __init__(self):
+        self.method = 'scrypt:32768:8:1'
+        self.stored_method = 'scrypt:32768:8:1'
+        self.salt_length = 16
+        self.workers = 0
+        self.timeout = 30
+        self.admission_timeout = 0.5
+        self._admission = threading.BoundedSemaphore(8)
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.shutdown()
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.stored_method = stored_method(self.method)
+        self.salt_length = app.config['PASSWORD_SALT_LENGTH']
+        self.workers = app.config['HASH_POOL_WORKERS']
+        self.timeout = app.config['HASH_POOL_TIMEOUT']
+        self.admission_timeout = app.config['HASH_ADMISSION_TIMEOUT']
+        self._admission = threading.BoundedSemaphore(app.config['HASH_POOL_MAX_PENDING'])
+
+    def _executor(self):
+        # built on first use in each process so forked gunicorn workers never share one
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _run(self, fn, *args):
+        if not self._admission.acquire(timeout=self.admission_timeout):
+            raise HashingBusy()
+        try:
+            if self.workers <= 0:
+                return fn(*args)
+            try:
+                return self._submit(fn, *args)
+            except BrokenProcessPool:
+                # a pool worker died (killed for memory, say); retry once on a new
+                # pool and let a second failure surface as an error, not as busy
+                return self._submit(fn, *args)
+        except TimeoutError:
+            raise HashingBusy()
+        finally:
+            self._admission.release()
+
+    def _submit(self, fn, *args):
+        pool = self._executor()
+        try:
+            return pool.submit(fn, *args).result(timeout=self.timeout)
+        except BrokenProcessPool:
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            raise
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True when the stored hash was made with different KDF parameters than configured"""
+        return password_hash.split('$', 1)[0] != self.stored_method
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,279 @@
+from datetime import datetime
+from itertools import groupby
+from operator import attrgetter
+from sqlalchemy import select, func, union_all
+from sqlalchemy.orm import aliased
+from app.models import db, User, Farmer, Grocer, Product
+from app.archive import HOT, history_archive
+from app.serialization import RowSerializer
+from app.streaming import stream_rows
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def parse_history_args(args, default_limit=DEFAULT_PAGE_SIZE, max_limit=MAX_PAGE_SIZE):
+    """
+    Pulls the keyset cursor and date range out of the query string.
+    `since` is inclusive and `until` exclusive, both ISO 8601 dates or datetimes.
+    Raises ValueError on a malformed date.
+    """
+    limit = args.get('limit', default_limit, type=int)
+    since = args.get('since')
+    until = args.get('until')
+
+    return {
+        "after": args.get('after', type=int),
+        "limit": max(1, min(limit, max_limit)),
+        "since": datetime.fromisoformat(since) if since else None,
+        "until": datetime.fromisoformat(until) if until else None
+    }
+
+
+def _page_filters(query, orders, after, since, until):
+    if after is not None:
+        query = query.where(orders.id > after)
+    if since is not None:
+        query = query.where(orders.order_date >= since)
+    if until is not None:
+        query = query.where(orders.order_date < until)
+    return query.order_by(orders.id)
+
+
+def _across(queries, *order_by):
+    """
+    One tier's query as it is, or the UNION ALL of every tier's ordered by the
+    named columns; SQLite only matches names the first SELECT labels itself.
+    """
+    if len(queries) == 1:
+        return queries[0]
+    query = union_all(*(query.order_by(None) for query in queries))
+    return query.order_by(*(query.selected_columns[name] for name in order_by))
+
+
+def _split_page(rows, limit):
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1].id
+    return rows, None
+
+
+def _items_by_order(query):
+    itemsByOrder = {}
+    for row in db.session.execute(query):
+        itemsByOrder.setdefault(row.order_id, []).append(row)
+    return itemsByOrder
+
+
+FARMER_ORDER = RowSerializer({
+    "order_id": "id",
+    "grocer_name": "grocer_name",
+    "total_amount": "total_amount",
+    "order_date": "order_date"
+}, dates=("order_date",))
+
+FARMER_ITEM = RowSerializer({
+    "product_name": "product_name",
+    "quantity_ordered": "quantity_ordered",
+    "price_per_unit": "price_per_unit"
+})
+
+GROCER_ORDER = RowSerializer({
+    "order_id": "id",
+    "total_amount": "total_amount",
+    "order_date": "order_date"
+}, dates=("order_date",))
+
+GROCER_ITEM = RowSerializer({
+    "product_name": "product_name",
+    "farmer_name": "farmer_name",
+    "quantity_ordered": "quantity_ordered",
+    "price_per_unit": "price_per_unit",
+    "total_price": "total_price"
+})
+
+
+def farmer_orders_query(farmer_id, after=None, since=None, until=None, tier=HOT):
+    """Orders containing the farmer's products, with the farmer's subtotal summed in the database"""
+    orders, items = tier
+    grocerUser = aliased(User)
+    query = (
+        select(orders.id.label('id'),
+               orders.order_date,
+               grocerUser.name.label('grocer_name'),
+               func.sum(items.total_price).label('total_amount'))
+        .join(items, items.order_id == orders.id)
+        .join(Product, items.product_id == Product.id)
+        .outerjoin(Grocer, orders.grocer_id == Grocer.id)
+        .outerjoin(grocerUser, Grocer.user_id == grocerUser.id)
+        .where(Product.farmer_id == farmer_id)
+        .group_by(orders.id, orders.order_date, grocerUser.name)
+    )
+    return _page_filters(query, orders, after, since, until)
+
+
+def farmer_items_query(farmer_id, order_ids, tier=HOT):
+    items = tier.items
+    return (
+        select(items.order_id,
+               items.id.label('item_id'),
+               Product.name.label('product_name'),
+               items.quantity_ordered,
+               items.price_per_unit)
+        .join(Product, items.product_id == Product.id)
+        .where(items.order_id.in_(order_ids), Product.farmer_id == farmer_id)
+        .order_by(items.order_id, items.id)
+    )
+
+
+def farmer_order_serializer(order_columns, item_columns):
+    """serialize(order, items) for order and item rows labelled `order_columns` and `item_columns`"""
+    serializeOrder = FARMER_ORDER.compile(order_columns)
+    serializeItem = FARMER_ITEM.compile(item_columns)
+
+    def serialize(order, items):
+        record = serializeOrder(order)
+        record["grocer_name"] = record["grocer_name"] or "Unknown"
+        record["products"] = [serializeItem(item) for item in items]
+        return record
+    return serialize
+
+
+def farmer_order_history(farmer_id, limit=DEFAULT_PAGE_SIZE, after=None, since=None, until=None):
+    """One page of a farmer's order history in two statements, plus the next cursor"""
+    tiers = history_archive.tiers(since, until)
+    ordersQuery = _across([farmer_orders_query(farmer_id, after, since, until, tier) for tier in tiers], 'id')
+    result = db.session.execute(ordersQuery.limit(limit + 1))
+    rows, nextAfter = _split_page(result.all(), limit)
+    if not rows:
+        return [], None
+
+    orderIds = [row.id for row in rows]
+    itemsQuery = _across([farmer_items_query(farmer_id, orderIds, tier) for tier in tiers], 'order_id', 'item_id')
+    itemsByOrder = _items_by_order(itemsQuery)
+    serialize = farmer_order_serializer(result.keys(), itemsQuery.selected_columns.keys())
+    return [serialize(row, itemsByOrder.get(row.id, [])) for row in rows], nextAfter
+
+
+def stream_farmer_orders(farmer_id, after=None, since=None, until=None):
+    """
+    The farmer's whole order history for the NDJSON format. Items arrive on one
+    cursor ordered by order, and each order is emitted as soon as its last item
+    is read; the subtotal is a window sum over the farmer's items in the order.
+    """
+    def tierQuery(tier):
+        orders, items = tier
+        grocerUser = aliased(User)
+        query = (
+            select(orders.id.label('id'),
+                   orders.order_date,
+                   grocerUser.name.label('grocer_name'),
+                   func.sum(items.total_price).over(partition_by=orders.id).label('total_amount'),
+                   items.order_id,
+                   items.id.label('item_id'),
+                   Product.name.label('product_name'),
+                   items.quantity_ordered,
+                   items.price_per_unit)
+            .join(items, items.order_id == orders.id)
+            .join(Product, items.product_id == Product.id)
+            .outerjoin(Grocer, orders.grocer_id == Grocer.id)
+            .outerjoin(grocerUser, Grocer.user_id == grocerUser.id)
+            .where(Product.farmer_id == farmer_id)
+        )
+        return _page_filters(query, orders, after, since, until).order_by(items.id)
+
+    result = stream_rows(_across([tierQuery(tier) for tier in history_archive.tiers(since, until)], 'id', 'item_id'))
+    serialize = farmer_order_serializer(result.keys(), result.keys())
+    for _, rows in groupby(result, key=attrgetter('id')):
+        items = list(rows)
+        yield serialize(items[0], items)
+
+
+def grocer_orders_query(grocer_id, after=None, since=None, until=None, tier=HOT):
+    orders = tier.orders
+    query = (
+        select(orders.id.label('id'), orders.order_date, orders.total_amount)
+        .where(orders.grocer_id == grocer_id)
+    )
+    return _page_filters(query, orders, after, since, until)
+
+
+def grocer_items_query(order_ids, tier=HOT):
+    items = tier.items
+    farmerUser = aliased(User)
+    return (
+        select(items.order_id,
+               items.id.label('item_id'),
+               Product.name.label('product_name'),
+               farmerUser.name.label('farmer_name'),
+               items.quantity_ordered,
+               items.price_per_unit,
+               items.total_price)
+        .join(Product, items.product_id == Product.id)
+        .outerjoin(Farmer, Product.farmer_id == Farmer.id)
+        .outerjoin(farmerUser, Farmer.user_id == farmerUser.id)
+        .where(items.order_id.in_(order_ids))
+        .order_by(items.order_id, items.id)
+    )
+
+
+def grocer_order_serializer(order_columns, item_columns, grocer_name):
+    """serialize(order, items) for one grocer's order and item rows labelled `order_columns` and `item_columns`"""
+    serializeOrder = GROCER_ORDER.compile(order_columns)
+    serializeItem = GROCER_ITEM.compile(item_columns)
+
+    def serialize(order, items):
+        record = serializeOrder(order)
+        record["grocer_name"] = grocer_name
+        record["products"] = [serializeItem(item) for item in items]
+        return record
+    return serialize
+
+
+def grocer_order_history(grocer_id, grocer_name, limit=DEFAULT_PAGE_SIZE, after=None, since=None, until=None):
+    """One page of a grocer's order history in two statements, plus the next cursor"""
+    tiers = history_archive.tiers(since, until)
+    ordersQuery = _across([grocer_orders_query(grocer_id, after, since, until, tier) for tier in tiers], 'id')
+    result = db.session.execute(ordersQuery.limit(limit + 1))
+    rows, nextAfter = _split_page(result.all(), limit)
+    if not rows:
+        return [], None
+
+    orderIds = [row.id for row in rows]
+    itemsQuery = _across([grocer_items_query(orderIds, tier) for tier in tiers], 'order_id', 'item_id')
+    itemsByOrder = _items_by_order(itemsQuery)
+    serialize = grocer_order_serializer(result.keys(), itemsQuery.selected_columns.keys(), grocer_name)
+    return [serialize(row, itemsByOrder.get(row.id, [])) for row in rows], nextAfter
+
+
+def stream_grocer_orders(grocer_id, grocer_name, after=None, since=None, until=None):
+    """The grocer's whole order history for the NDJSON format, one order at a time"""
+    def tierQuery(tier):
+        orders, items = tier
+        farmerUser = aliased(User)
+        query = (
+            select(orders.id.label('id'),
+                   orders.order_date,
+                   orders.total_amount,
+                   items.order_id,
+                   items.id.label('item_id'),
+                   Product.name.label('product_name'),
+                   farmerUser.name.label('farmer_name'),
+                   items.quantity_ordered,
+                   items.price_per_unit,
+                   items.total_price)
+            .outerjoin(items, items.order_id == orders.id)
+            .outerjoin(Product, items.product_id == Product.id)
+            .outerjoin(Farmer, Product.farmer_id == Farmer.id)
+            .outerjoin(farmerUser, Farmer.user_id == farmerUser.id)
+            .where(orders.grocer_id == grocer_id)
+        )
+        return _page_filters(query, orders, after, since, until).order_by(items.id)
+
+    result = stream_rows(_across([tierQuery(tier) for tier in history_archive.tiers(since, until)], 'id', 'item_id'))
+    serialize = grocer_order_serializer(result.keys(), result.keys(), grocer_name)
+    for _, rows in groupby(result, key=attrgetter('id')):
+        rows = list(rows)
+        # an order without items comes back as a single row of NULL item columns
+        items = [row for row in rows if row.order_id is not None]
+        yield serialize(rows[0], items)
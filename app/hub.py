@@ -0,0 +1,207 @@
+import os
+import queue
+import threading
+from flask import current_app
+from app.models import db
+from app.changes import catalog_versioning, catalog_changes, current_version
+
+EVENT_STREAM_MIMETYPE = 'text/event-stream'
+
+
+class StreamFull(Exception):
+    """Raised when the worker already serves STOCK_STREAM_MAX_SUBSCRIBERS streams"""
+
+
+class Subscription:
+    """One client's bounded queue of SSE frames, starting after catalog `version`"""
+
+    def __init__(self, size, version):
+        self.frames = queue.Queue(size)
+        self.version = version
+        self.dropped = False
+
+
+class StockHub:
+    """
+    In-process publish/subscribe of committed stock and price changes.
+
+    Commits that change the catalog wake a dispatcher thread, which reads
+    everything since the last version it published from the changes feed
+    and formats it as one SSE frame for all subscribers. A burst of commits
+    costs one read, however many clients listen, and fanning out costs one
+    queue put per subscriber. The dispatcher also polls every
+    STOCK_STREAM_POLL_INTERVAL seconds for commits made by other workers.
+
+    Each subscriber's queue holds STOCK_STREAM_QUEUE_SIZE frames. A client
+    too slow to keep up is dropped rather than slowing everyone down; its
+    EventSource reconnects with Last-Event-ID and catches up from the feed.
+    """
+
+    def __init__(self):
+        self.queue_size = 100
+        self.heartbeat = 15
+        self.poll_interval = 1
+        self.max_subscribers = 1000
+        self.page_size = 1000
+        self.published = 0
+        self.dropped = 0
+        self._subscriptions = set()
+        self._version = 0
+        self._dispatcher_pid = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._dispatching = threading.Lock()
+
+    def init_app(self, app):
+        self.queue_size = app.config['STOCK_STREAM_QUEUE_SIZE']
+        self.heartbeat = app.config['STOCK_STREAM_HEARTBEAT']
+        self.poll_interval = app.config['STOCK_STREAM_POLL_INTERVAL']
+        self.max_subscribers = app.config['STOCK_STREAM_MAX_SUBSCRIBERS']
+        self.page_size = app.config['CATALOG_CHANGES_PAGE_SIZE']
+        catalog_versioning.on_commit(self.notify)
+
+    def notify(self, version):
+        self._wake.set()
+
+    def subscribe(self, since=None):
+        """
+        Registers a subscriber for the changes after the current version and
+        returns it with the frames that catch it up from catalog version
+        `since`, read a page at a time as the stream sends them. Only taking
+        the current version holds up the dispatcher, however far behind
+        `since` is.
+        """
+        app = current_app._get_current_object()
+        with self._dispatching:
+            with self._lock:
+                if len(self._subscriptions) >= self.max_subscribers:
+                    raise StreamFull()
+
+            version = current_version()
+            db.session.rollback()
+            subscription = Subscription(self.queue_size, version)
+            with self._lock:
+                # with nobody listening the dispatcher stopped following the feed
+                if not self._subscriptions:
+                    self._version = version
+                self._subscriptions.add(subscription)
+
+        self._start_dispatcher(app)
+        backlog = self._backlog(app, since, version) if since is not None and since < version else ()
+        return subscription, backlog
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def stream(self, subscription, backlog=()):
+        """The subscriber's SSE body: its backlog, then frames as they are published, with heartbeats"""
+        try:
+            yield f"retry: {int(self.heartbeat * 1000)}\n\n"
+            yield from backlog
+            while True:
+                try:
+                    version, frame = subscription.frames.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    if subscription.dropped:
+                        return
+                    yield ": heartbeat\n\n"
+                    continue
+                yield frame
+                # after the frames queued before it fell behind, a dropped client reconnects
+                if subscription.dropped and subscription.frames.empty():
+                    return
+        finally:
+            self.unsubscribe(subscription)
+
+    def dispatch(self):
+        """Publishes the changes committed since the last dispatch to every subscriber; returns the frames sent"""
+        with self._dispatching:
+            with self._lock:
+                if not self._subscriptions:
+                    return 0
+
+            frames = 0
+            for changes in self._changes_since(self._version):
+                self.publish(changes["version"], self._frame(changes))
+                frames += 1
+                self._version = changes["version"]
+            db.session.rollback()
+            return frames
+
+    def publish(self, version, frame):
+        """Queues a frame for every subscriber that hasn't seen `version`, dropping those that are full"""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+
+        for subscription in subscriptions:
+            if version <= subscription.version:
+                continue
+            try:
+                subscription.frames.put_nowait((version, frame))
+            except queue.Full:
+                subscription.dropped = True
+                self.unsubscribe(subscription)
+                self.dropped += 1
+        self.published += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "subscribers": len(self._subscriptions),
+                "max_subscribers": self.max_subscribers,
+                "version": self._version,
+                "published": self.published,
+                "dropped": self.dropped
+            }
+
+    def _changes_since(self, version):
+        while True:
+            changes = catalog_changes(since=version, limit=self.page_size)
+            if changes["products"] or changes["deleted"]:
+                yield changes
+            if not changes["more"]:
+                return
+            version = changes["version"]
+
+    def _backlog(self, app, since, until):
+        # each page in its own app context, so a long catch up holds no session between pages
+        while since < until:
+            with app.app_context():
+                changes = catalog_changes(since=since, limit=self.page_size)
+            if changes["products"] or changes["deleted"]:
+                yield self._frame(changes, app)
+            if not changes["more"]:
+                return
+            since = changes["version"]
+
+    def _frame(self, changes, app=None):
+        data = (app or current_app).json.dumps({
+            "version": changes["version"],
+            "products": [{"id": product["id"], "name": product["name"], "quantity": product["quantity"],
+                          "price": product["price"], "version": product["version"]}
+                         for product in changes["products"]],
+            "deleted": changes["deleted"]
+        })
+        return f"id: {changes['version']}\nevent: stock\ndata: {data}\n\n"
+
+    def _start_dispatcher(self, app):
+        if not self.poll_interval or self._dispatcher_pid == os.getpid():
+            return
+        self._dispatcher_pid = os.getpid()
+
+        def dispatchForever():
+            while True:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                with app.app_context():
+                    try:
+                        self.dispatch()
+                    except Exception:
+                        app.logger.exception("stock stream dispatch failed")
+                        db.session.rollback()
+
+        threading.Thread(target=dispatchForever, name='stock-hub', daemon=True).start()
+
+
+stock_hub = StockHub()
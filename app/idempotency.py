@@ -0,0 +1,276 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from flask import current_app, request, jsonify
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import event, select, update, delete
+from app.models import db, IdempotencyKey
+from app.database import upsert_insert
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+POLL_INTERVAL = 0.05
+# headers the response is rebuilt without; they are computed again on replay
+SKIPPED_HEADERS = {'content-length', 'set-cookie'}
+# what a retry gets when the first request's writes committed but its response was never stored
+LOST_RESPONSE = (409, [["Content-Type", "application/json"]],
+                 json.dumps({"error": f"the request with this {HEADER} was carried out, "
+                                      "but its response was lost"}).encode())
+
+StoredResponse = namedtuple('StoredResponse', ['fingerprint', 'status', 'headers', 'body', 'expires'])
+
+
+class IdempotencyStore:
+    """
+    Responses of POSTs sent with an Idempotency-Key, so a client retrying
+    after a timeout gets the first answer back instead of a second order.
+
+    The first request with a key claims it with a row in idempotencyKeys
+    before running, and the response is written to that row and to a
+    per-process LRU of IDEMPOTENCY_CACHE_SIZE entries for IDEMPOTENCY_TTL
+    seconds. A retry is answered from the LRU, or, when another worker
+    served the first request, from the row its claim runs into. A duplicate that
+    arrives while the first is still running waits for it, up to
+    IDEMPOTENCY_WAIT seconds, rather than running twice.
+
+    Every commit the view makes also writes LOST_RESPONSE to the claim and
+    extends it to the TTL, so once the view's work is committed the key is
+    never released or taken over: if the view then fails, or the worker dies
+    before the real response is stored, retries get LOST_RESPONSE instead of
+    running again. Server errors, 429s and exceptions from views that
+    committed nothing release the key so the request can be retried for
+    real. Keys are scoped to the route and, on authenticated routes, to the
+    user.
+    """
+
+    def __init__(self):
+        self.ttl = 86400
+        self.cache_size = 10_000
+        self.wait = 10
+        self.lock_timeout = 60
+        self.purge_interval = 300
+        self.replays = 0
+        self.waits = 0
+        self._responses = OrderedDict()
+        self._inflight = {}
+        self._next_purge = 0.0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = app.config['IDEMPOTENCY_TTL']
+        self.cache_size = app.config['IDEMPOTENCY_CACHE_SIZE']
+        self.wait = app.config['IDEMPOTENCY_WAIT']
+        self.lock_timeout = app.config['IDEMPOTENCY_LOCK_TIMEOUT']
+        self.purge_interval = app.config['IDEMPOTENCY_PURGE_INTERVAL']
+        if not event.contains(db.session, 'before_commit', _stage_claim):
+            event.listen(db.session, 'before_commit', _stage_claim)
+            event.listen(db.session, 'after_commit', _mark_claim_committed)
+
+    def clear(self):
+        with self._lock:
+            self._responses.clear()
+            self._inflight.clear()
+
+    def respond(self, scope, key, call):
+        """The response for `key`: a replay of the stored one, or call()'s, stored for the next retry"""
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({"error": f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters"}), 400
+
+        fingerprint = hashlib.blake2b(request.get_data(), digest_size=16).hexdigest()
+        cacheKey = (scope, key)
+        deadline = time.monotonic() + self.wait
+        while True:
+            stored = self._cached(cacheKey)
+            if stored is not None:
+                return self._replay(stored, fingerprint)
+            with self._lock:
+                running = self._inflight.get(cacheKey)
+                if running is None:
+                    running = self._inflight[cacheKey] = threading.Event()
+                    break
+            self.waits += 1
+            if not running.wait(max(0.0, deadline - time.monotonic())):
+                return self._busy()
+
+        try:
+            return self._run(scope, key, fingerprint, call, deadline)
+        finally:
+            with self._lock:
+                self._inflight.pop(cacheKey, None)
+            running.set()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._responses), "max_entries": self.cache_size, "in_flight": len(self._inflight),
+                    "replays": self.replays, "waits": self.waits}
+
+    def _run(self, scope, key, fingerprint, call, deadline):
+        # another worker may hold the key; poll its row until it finishes
+        while True:
+            claimId, row = self._claim(scope, key, fingerprint)
+            if claimId is not None:
+                break
+            if row.status_code is not None:
+                stored = StoredResponse(row.fingerprint, row.status_code, json.loads(row.headers), row.body,
+                                        row.expires_at)
+                self._remember((scope, key), stored)
+                return self._replay(stored, fingerprint)
+            if row.fingerprint != fingerprint:
+                return self._mismatch()
+            if time.monotonic() >= deadline:
+                return self._busy()
+            self.waits += 1
+            time.sleep(POLL_INTERVAL)
+
+        claim = db.session.info['idempotency_claim'] = {"id": claimId, "ttl": self.ttl, "committed": False}
+        try:
+            response = current_app.make_response(call())
+        except Exception:
+            del db.session.info['idempotency_claim']
+            db.session.rollback()
+            if not claim["committed"]:
+                self._release(claimId)
+            raise
+        del db.session.info['idempotency_claim']
+
+        # once the view's writes are in, its answer is the answer, whatever the status
+        if response.is_streamed or (not claim["committed"] and
+                                    (response.status_code >= 500 or response.status_code == 429)):
+            db.session.rollback()
+            if not claim["committed"]:
+                self._release(claimId)
+            return response
+
+        now = int(time.time())
+        stored = StoredResponse(fingerprint, response.status_code,
+                                [(name, value) for name, value in response.headers
+                                 if name.lower() not in SKIPPED_HEADERS],
+                                response.get_data(), now + self.ttl)
+        db.session.execute(
+            update(IdempotencyKey).where(IdempotencyKey.id == claimId)
+            .values(status_code=stored.status, headers=json.dumps(stored.headers), body=stored.body,
+                    expires_at=stored.expires)
+        )
+        self._purge(now)
+        db.session.commit()
+        self._remember((scope, key), stored)
+        return response
+
+    def _claim(self, scope, key, fingerprint):
+        """
+        Inserts the key's row unless it exists and returns (row id, None), or
+        (None, the existing row). A row past its expiry, finished or not, is
+        taken over.
+        """
+        while True:
+            now = int(time.time())
+            claimId = db.session.execute(
+                upsert_insert(IdempotencyKey, db.session)
+                .values(scope=scope, key=key, fingerprint=fingerprint, expires_at=now + self.lock_timeout)
+                .on_conflict_do_nothing(index_elements=[IdempotencyKey.scope, IdempotencyKey.key])
+                .returning(IdempotencyKey.id)
+            ).scalar()
+            if claimId is not None:
+                db.session.commit()
+                return claimId, None
+
+            row = db.session.execute(
+                select(IdempotencyKey.fingerprint, IdempotencyKey.status_code, IdempotencyKey.headers,
+                       IdempotencyKey.body, IdempotencyKey.expires_at)
+                .where(IdempotencyKey.scope == scope, IdempotencyKey.key == key)
+            ).first()
+            if row is not None and row.expires_at > now:
+                # end the read so the next poll sees other workers' commits
+                db.session.rollback()
+                return None, row
+            db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.scope == scope,
+                                                            IdempotencyKey.key == key,
+                                                            IdempotencyKey.expires_at <= now))
+            db.session.commit()
+
+    def _release(self, claim_id):
+        db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.id == claim_id))
+        db.session.commit()
+
+    def _purge(self, now):
+        if self.purge_interval and time.monotonic() >= self._next_purge:
+            self._next_purge = time.monotonic() + self.purge_interval
+            db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= now))
+
+    def _cached(self, cache_key):
+        with self._lock:
+            stored = self._responses.get(cache_key)
+            if stored is None:
+                return None
+            if stored.expires <= time.time():
+                del self._responses[cache_key]
+                return None
+            self._responses.move_to_end(cache_key)
+            return stored
+
+    def _remember(self, cache_key, stored):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._responses[cache_key] = stored
+            self._responses.move_to_end(cache_key)
+            while len(self._responses) > self.cache_size:
+                self._responses.popitem(last=False)
+
+    def _replay(self, stored, fingerprint):
+        if stored.fingerprint != fingerprint:
+            return self._mismatch()
+        self.replays += 1
+        response = current_app.response_class(stored.body, status=stored.status, headers=stored.headers)
+        response.headers[REPLAYED_HEADER] = 'true'
+        return response
+
+    def _mismatch(self):
+        return jsonify({"error": f"this {HEADER} was already used for a different request"}), 422
+
+    def _busy(self):
+        response = jsonify({"error": f"a request with this {HEADER} is still being processed"})
+        response.headers['Retry-After'] = '1'
+        return response, 409
+
+
+idempotency_store = IdempotencyStore()
+
+
+def _stage_claim(session):
+    # rides on the view's own commit, so its writes never land without their claim being settled
+    claim = session.info.get('idempotency_claim')
+    if claim is not None:
+        status, headers, body = LOST_RESPONSE
+        session.execute(
+            update(IdempotencyKey).where(IdempotencyKey.id == claim["id"])
+            .values(status_code=status, headers=json.dumps(headers), body=body,
+                    expires_at=int(time.time()) + claim["ttl"])
+        )
+
+
+def _mark_claim_committed(session):
+    claim = session.info.get('idempotency_claim')
+    if claim is not None:
+        claim["committed"] = True
+
+
+def idempotent(per_user=True):
+    """
+    Makes a view's POSTs replayable with an Idempotency-Key header. Goes under
+    timed_jwt_required when `per_user`, since keys are then scoped to the user.
+    """
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            if request.method != 'POST' or key is None:
+                return fn(*args, **kwargs)
+            scope = f"{request.endpoint}:{get_jwt_identity() if per_user else ''}"
+            return idempotency_store.respond(scope, key, lambda: fn(*args, **kwargs))
+        return decorator
+    return wrapper
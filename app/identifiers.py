@@ -0,0 +1,200 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event, select, delete
+from app.models import db, User, LoginIdentifier
+
+PHONE_SEPARATORS = re.compile(r'[\s().-]')
+REBUILD_CHUNK_SIZE = 5000
+
+
+def normalize_email(email):
+    return str(email).strip().casefold()
+
+
+def normalize_phone(phone_number):
+    return PHONE_SEPARATORS.sub('', str(phone_number))
+
+
+def normalize_identifier(identifier):
+    """What a user typed to log in, as either of their identifiers is stored"""
+    identifier = str(identifier).strip()
+    return normalize_email(identifier) if '@' in identifier else normalize_phone(identifier)
+
+
+def user_identifiers(email, phone_number):
+    """The (kind, identifier) pairs indexed for a user"""
+    return (("email", normalize_email(email)), ("phone", normalize_phone(phone_number)))
+
+
+class LoginIdentifiers:
+    """
+    Finds the user behind a login's email or phone number with one probe of
+    the unique index on loginIdentifiers, where both are kept normalized:
+    emails trimmed and casefolded, phone numbers without spaces, dots,
+    dashes or brackets. Rows follow every user written through the ORM, and
+    the migration that adds the table fills it for users made before. While
+    the table is still empty, as on a database made with create-db before
+    the index existed, lookups fall back to the users columns as typed.
+
+    Identifiers that matched nobody are remembered for
+    LOGIN_NEGATIVE_CACHE_TTL seconds in an LRU of LOGIN_NEGATIVE_CACHE_SIZE,
+    so repeated logins for accounts that don't exist are turned away without
+    a query. A signup clears its identifiers from this worker's cache on
+    commit; other workers may go on rejecting them until the TTL runs out.
+    """
+
+    def __init__(self):
+        self.max_entries = 10_000
+        self.ttl = 60
+        self.lookups = 0
+        self.absent_hits = 0
+        self._absent = OrderedDict()
+        self._generation = 0
+        self._indexed = False
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_entries = app.config['LOGIN_NEGATIVE_CACHE_SIZE']
+        self.ttl = app.config['LOGIN_NEGATIVE_CACHE_TTL']
+        if not event.contains(db.session, 'before_flush', _index_flushed_users):
+            event.listen(db.session, 'before_flush', _index_flushed_users)
+            event.listen(db.session, 'after_commit', _forget_indexed_absences)
+            event.listen(db.session, 'after_rollback', _drop_indexed)
+
+    def find(self, identifier):
+        """The user an email or phone number belongs to, profiles loaded, or None"""
+        key = normalize_identifier(identifier) if identifier is not None else ''
+        if not key:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self.lookups += 1
+            expires = self._absent.get(key)
+            if expires is not None:
+                if expires > now:
+                    self.absent_hits += 1
+                    return None
+                del self._absent[key]
+            generation = self._generation
+
+        user = db.session.execute(
+            select(User)
+            .join(LoginIdentifier, LoginIdentifier.user_id == User.id)
+            .options(db.joinedload(User.farmer), db.joinedload(User.grocer))
+            .where(LoginIdentifier.identifier == key)
+        ).scalar_one_or_none()
+
+        if user is not None:
+            self._indexed = True
+        elif not self._index_filled():
+            return User.query.options(db.joinedload(User.farmer), db.joinedload(User.grocer)) \
+                .filter((User.email == str(identifier).strip()) | (User.phone_number == str(identifier).strip())) \
+                .first()
+
+        if user is None and self.max_entries > 0:
+            with self._lock:
+                # a signup committed while we looked may have made the key valid
+                if generation == self._generation:
+                    self._absent[key] = now + self.ttl
+                    self._absent.move_to_end(key)
+                    while len(self._absent) > self.max_entries:
+                        self._absent.popitem(last=False)
+        return user
+
+    def taken(self, email, phone_number):
+        """Whether another user already has this email or phone number, however it is written"""
+        keys = [identifier for _, identifier in user_identifiers(email, phone_number)]
+        if db.session.execute(
+            select(LoginIdentifier.id).where(LoginIdentifier.identifier.in_(keys)).limit(1)
+        ).first() is not None:
+            return True
+        if self._index_filled():
+            return False
+        return db.session.execute(
+            select(User.id).where((User.email == email) | (User.phone_number == phone_number)).limit(1)
+        ).first() is not None
+
+    def rebuild(self):
+        """
+        Indexes every user's identifiers again, for users written before the
+        table existed or around the ORM. Returns the number of identifiers
+        indexed and the ids of the users skipped because a normalized
+        identifier belongs to an earlier user; those can't log in until fixed.
+        """
+        db.session.execute(delete(LoginIdentifier))
+        seen = set()
+        rows = []
+        skipped = []
+        for user in db.session.execute(select(User.id, User.email, User.phone_number).order_by(User.id)):
+            pairs = user_identifiers(user.email, user.phone_number)
+            if any(identifier in seen for _, identifier in pairs) or pairs[0][1] == pairs[1][1]:
+                skipped.append(user.id)
+                continue
+            for kind, identifier in pairs:
+                seen.add(identifier)
+                rows.append({"identifier": identifier, "kind": kind, "user_id": user.id})
+        for start in range(0, len(rows), REBUILD_CHUNK_SIZE):
+            db.session.execute(LoginIdentifier.__table__.insert(), rows[start:start + REBUILD_CHUNK_SIZE])
+        self.clear()
+        return len(rows), skipped
+
+    def forget(self, identifiers):
+        with self._lock:
+            self._generation += 1
+            self._indexed = True
+            for identifier in identifiers:
+                self._absent.pop(identifier, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._absent.clear()
+            self._indexed = False
+
+    def _index_filled(self):
+        # an empty table means nobody was indexed yet, not that nobody exists
+        if not self._indexed:
+            self._indexed = db.session.execute(select(LoginIdentifier.id).limit(1)).first() is not None
+        return self._indexed
+
+    def stats(self):
+        with self._lock:
+            return {"absent_entries": len(self._absent), "max_entries": self.max_entries,
+                    "lookups": self.lookups, "absent_hits": self.absent_hits}
+
+
+login_identifiers = LoginIdentifiers()
+
+
+def _index_flushed_users(session, flush_context, instances):
+    indexed = session.info.setdefault('indexed_identifiers', set())
+    for user in session.new:
+        if isinstance(user, User):
+            for kind, identifier in user_identifiers(user.email, user.phone_number):
+                user.login_identifiers.append(LoginIdentifier(identifier=identifier, kind=kind))
+                indexed.add(identifier)
+    for user in session.dirty:
+        if not isinstance(user, User) or not session.is_modified(user, include_collections=False):
+            continue
+        rows = {row.kind: row for row in user.login_identifiers}
+        for kind, identifier in user_identifiers(user.email, user.phone_number):
+            row = rows.get(kind)
+            if row is None:
+                user.login_identifiers.append(LoginIdentifier(identifier=identifier, kind=kind))
+            elif row.identifier != identifier:
+                row.identifier = identifier
+            else:
+                continue
+            indexed.add(identifier)
+
+
+def _forget_indexed_absences(session):
+    indexed = session.info.pop('indexed_identifiers', None)
+    if indexed:
+        login_identifiers.forget(indexed)
+
+
+def _drop_indexed(session):
+    session.info.pop('indexed_identifiers', None)
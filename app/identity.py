@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from sqlalchemy import event, select, inspect
+from app.models import db, User, Farmer, Grocer
+
+Identity = namedtuple('Identity', ['user_id', 'role', 'name', 'farmer_id', 'grocer_id'])
+
+
+def identity_claims(user):
+    """Claims minted into a user's tokens so requests can skip the user and profile lookups"""
+    return {
+        "role": user.role,
+        "name": user.name,
+        "farmer_id": user.farmer.id if user.farmer else None,
+        "grocer_id": user.grocer.id if user.grocer else None,
+        "identity_at": time.time()
+    }
+
+
+class IdentityCache:
+    """
+    Resolves the caller's role and profile ids.
+
+    Tokens minted by login carry them as claims and cost no query. Older tokens
+    fall back to a small LRU cache with a TTL filled by one joined query. When a
+    user's role or profiles change, their cache entry is dropped and the claims
+    in tokens issued before the change stop being trusted in this process.
+    """
+
+    def __init__(self, max_entries=10_000, ttl=300, token_lifetime=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.token_lifetime = token_lifetime
+        self._identities = OrderedDict()
+        self._changed_at = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_entries = app.config['IDENTITY_CACHE_SIZE']
+        self.ttl = app.config['IDENTITY_CACHE_TTL']
+        self.token_lifetime = app.config['LOGIN_TOKEN_EXPIRES'].total_seconds()
+        if not event.contains(db.session, 'after_commit', _invalidate_changed_identities):
+            event.listen(db.session, 'after_flush', _mark_identity_changes)
+            event.listen(db.session, 'after_commit', _invalidate_changed_identities)
+            event.listen(db.session, 'after_rollback', _forget_identity_changes)
+
+    def current(self):
+        """The identity of the request's JWT"""
+        claims = get_jwt()
+        userId = get_jwt_identity()
+        if 'identity_at' in claims and claims['identity_at'] > self._changed_at.get(userId, 0):
+            return Identity(userId, claims['role'], claims['name'], claims['farmer_id'], claims['grocer_id'])
+        return self.get(userId)
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._identities.get(user_id)
+            if cached is not None and cached[1] > now:
+                self._identities.move_to_end(user_id)
+                return cached[0]
+
+        identity = load_identity(user_id)
+        if identity is not None:
+            with self._lock:
+                self._identities[user_id] = (identity, now + self.ttl)
+                self._identities.move_to_end(user_id)
+                while len(self._identities) > self.max_entries:
+                    self._identities.popitem(last=False)
+        return identity
+
+    def invalidate(self, user_id):
+        now = time.time()
+        with self._lock:
+            self._identities.pop(user_id, None)
+            self._changed_at.pop(user_id, None)
+            self._changed_at[user_id] = now
+            # every token issued before the oldest changes has expired by now
+            while next(iter(self._changed_at.values())) < now - self.token_lifetime:
+                self._changed_at.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._identities.clear()
+            self._changed_at.clear()
+
+
+identity_cache = IdentityCache()
+
+
+def load_identity(user_id):
+    row = db.session.execute(
+        select(User.id, User.role, User.name, Farmer.id.label('farmer_id'), Grocer.id.label('grocer_id'))
+        .outerjoin(Farmer, Farmer.user_id == User.id)
+        .outerjoin(Grocer, Grocer.user_id == User.id)
+        .where(User.id == user_id)
+        .limit(1)
+    ).first()
+    return Identity(row.id, row.role, row.name, row.farmer_id, row.grocer_id) if row else None
+
+
+def _mark_identity_changes(session, flush_context):
+    changed = session.info.setdefault('identity_changes', set())
+    for obj in session.dirty:
+        if isinstance(obj, User) and (inspect(obj).attrs.role.history.has_changes()
+                                      or inspect(obj).attrs.name.history.has_changes()):
+            changed.add(obj.id)
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (Farmer, Grocer)) and obj.user_id is not None:
+            changed.add(obj.user_id)
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            changed.add(obj.id)
+
+
+def _invalidate_changed_identities(session):
+    for user_id in session.info.pop('identity_changes', ()):
+        identity_cache.invalidate(user_id)
+
+
+def _forget_identity_changes(session):
+    session.info.pop('identity_changes', None)
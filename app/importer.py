@@ -0,0 +1,113 @@
+import csv
+import io
+import json
+from sqlalchemy import insert
+from app.models import db, Product
+
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_MAX_ERRORS = 1000
+CSV_MIMETYPE = 'text/csv'
+
+
+def csv_records(stream):
+    """Yields (row number, record, error) for each data row of a CSV upload with a header row"""
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    try:
+        for rowNumber, record in enumerate(reader, 1):
+            yield rowNumber, record, None
+    except (csv.Error, UnicodeDecodeError) as e:
+        yield reader.line_num, None, f"unreadable CSV: {e}"
+
+
+def ndjson_records(stream):
+    """Yields (row number, record, error) for each non-blank line of an NDJSON upload"""
+    for rowNumber, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield rowNumber, None, "not valid JSON"
+            continue
+        if not isinstance(record, dict):
+            yield rowNumber, None, "each line must be a JSON object"
+            continue
+        yield rowNumber, record, None
+
+
+def _whole(value):
+    # NDJSON sends numbers, CSV sends their text
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    # isdigit() alone takes digits such as '²' that int() refuses
+    if isinstance(value, str) and value.strip().isascii() and value.strip().isdigit():
+        return int(value)
+    return None
+
+
+def validate_product(record):
+    """Returns the Product columns for one uploaded record, or raises ValueError"""
+    name = record.get('name') or ''
+    if not isinstance(name, str):
+        raise ValueError("name must be text")
+    name = name.strip()
+    description = record.get('description') or None
+    quantity_available = _whole(record.get('quantity_available'))
+    price_per_unit = _whole(record.get('price_per_unit'))
+
+    if not name or len(name) > 50:
+        raise ValueError("name is required and at most 50 characters")
+    if description is not None and (not isinstance(description, str) or len(description) > 400):
+        raise ValueError("description must be text of at most 400 characters")
+    if quantity_available is None:
+        raise ValueError("quantity_available must be a whole number of at least 0")
+    if price_per_unit is None or price_per_unit <= 0:
+        raise ValueError("price_per_unit must be a positive whole number")
+
+    return {"name": name, "description": description,
+            "quantity_available": quantity_available, "price_per_unit": price_per_unit}
+
+
+def import_products(farmer_id, records, chunk_size=IMPORT_CHUNK_SIZE, max_errors=IMPORT_MAX_ERRORS):
+    """
+    Validates uploaded records as they arrive and inserts the valid ones for
+    `farmer_id` in bulk, `chunk_size` rows per statement, in the caller's
+    transaction. At most one chunk and `max_errors` error entries are held in
+    memory however long the upload is; the caller commits or rolls back.
+    """
+    # one executemany per chunk, rather than one per combination of missing columns
+    statement = insert(Product).execution_options(render_nulls=True)
+    imported = rejected = 0
+    errors = []
+    chunk = []
+
+    for rowNumber, record, error in records:
+        if error is None:
+            try:
+                chunk.append({"farmer_id": farmer_id, **validate_product(record)})
+            except ValueError as e:
+                error = str(e)
+
+        if error is not None:
+            rejected += 1
+            if len(errors) < max_errors:
+                errors.append({"row": rowNumber, "error": error})
+            continue
+
+        if len(chunk) >= chunk_size:
+            db.session.execute(statement, chunk)
+            imported += len(chunk)
+            chunk = []
+
+    if chunk:
+        db.session.execute(statement, chunk)
+        imported += len(chunk)
+
+    return {
+        "imported": imported,
+        "rejected": rejected,
+        "errors": errors,
+        "errors_truncated": rejected > len(errors)
+    }
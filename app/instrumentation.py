@@ -0,0 +1,202 @@
+import hmac
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, g, request, has_app_context, abort
+from flask.json.provider import JSONProvider
+from flask_jwt_extended import verify_jwt_in_request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+INTERNAL_TOKEN_HEADER = 'X-Internal-Token'
+BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+slowLog = logging.getLogger('evergreen.slow')
+
+
+def _active():
+    return has_app_context() and g.get('timings') is not None
+
+
+@contextmanager
+def phase(name):
+    """Adds the time spent in the block to the current request's `name` timing"""
+    if not _active():
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.timings[name] = g.timings.get(name, 0.0) + time.perf_counter() - started
+
+
+def timed_jwt_required(**kwargs):
+    """flask_jwt_extended's jwt_required, with token verification timed as the `jwt` phase"""
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kw):
+            with phase('jwt'):
+                verify_jwt_in_request(**kwargs)
+            return current_app.ensure_sync(fn)(*args, **kw)
+        return decorator
+    return wrapper
+
+
+def internal_only(fn):
+    """
+    Serves an /internal route only to callers sending INTERNAL_TOKEN in the
+    X-Internal-Token header. Without INTERNAL_TOKEN set the route is a 404.
+    """
+    @wraps(fn)
+    def decorator(*args, **kwargs):
+        token = current_app.config['INTERNAL_TOKEN']
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get(INTERNAL_TOKEN_HEADER, '').encode(), token.encode()):
+            abort(403)
+        return fn(*args, **kwargs)
+    return decorator
+
+
+class TimedJSONProvider(JSONProvider):
+    """Wraps the app's JSON provider so serialization is timed as the `json` phase"""
+
+    def __init__(self, app, inner):
+        super().__init__(app)
+        self.inner = inner
+        self.mimetype = getattr(inner, 'mimetype', 'application/json')
+
+    def dumps(self, obj, **kwargs):
+        with phase('json'):
+            return self.inner.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        return self.inner.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        with phase('json'):
+            return self.inner.response(*args, **kwargs)
+
+
+class RouteHistogram:
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.db_ms = 0.0
+        self.statements = 0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def record(self, duration_ms, db_ms, statements):
+        self.count += 1
+        self.total_ms += duration_ms
+        self.db_ms += db_ms
+        self.statements += statements
+        self.buckets[bisect_left(BUCKETS_MS, duration_ms)] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "mean_db_ms": round(self.db_ms / self.count, 3) if self.count else 0.0,
+            "mean_statements": round(self.statements / self.count, 2) if self.count else 0.0,
+            "buckets_ms": {
+                **{f"le_{bound}": hits for bound, hits in zip(BUCKETS_MS, self.buckets)},
+                "le_inf": self.buckets[-1]
+            }
+        }
+
+
+class Instrumentation:
+    """
+    Opt-in per-request timing. With INSTRUMENTATION_ENABLED each request counts
+    its SQL statements and database time, times the jwt, hash and json phases,
+    answers with a Server-Timing header and feeds a per-route latency histogram.
+    Requests over SLOW_REQUEST_MS and statements over SLOW_QUERY_MS are logged
+    to the `evergreen.slow` logger with their SQL.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.json = TimedJSONProvider(app, app.json)
+
+        if app.config.get('SLOW_LOG_PATH') and not slowLog.handlers:
+            handler = logging.FileHandler(app.config['SLOW_LOG_PATH'])
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            slowLog.addHandler(handler)
+            slowLog.setLevel(logging.WARNING)
+
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    def _start_request(self):
+        if not current_app.config['INSTRUMENTATION_ENABLED']:
+            return
+        g.timings = {}
+        g.statements = 0
+        g.slowest_statement = (0.0, None)
+        g.request_started = time.perf_counter()
+
+    def _finish_request(self, response):
+        if g.get('timings') is None:
+            return response
+
+        duration_ms = (time.perf_counter() - g.request_started) * 1000
+        timings_ms = {name: seconds * 1000 for name, seconds in g.timings.items()}
+        db_ms = timings_ms.pop('db', 0.0)
+
+        metrics = [f'db;dur={db_ms:.2f};desc="{g.statements} queries"']
+        metrics += [f'{name};dur={ms:.2f}' for name, ms in timings_ms.items()]
+        metrics.append(f'total;dur={duration_ms:.2f}')
+        response.headers['Server-Timing'] = ', '.join(metrics)
+
+        route = f"{request.method} {request.url_rule.rule if request.url_rule else 'unmatched'}"
+        with self._lock:
+            self._routes.setdefault(route, RouteHistogram()).record(duration_ms, db_ms, g.statements)
+
+        if duration_ms >= current_app.config['SLOW_REQUEST_MS']:
+            slowestMs, slowestSql = g.slowest_statement
+            slowLog.warning("slow request %s %.1fms status=%s db=%.1fms queries=%d phases=%s slowest_sql=%.1fms %s",
+                            route, duration_ms, response.status_code, db_ms, g.statements,
+                            {name: round(ms, 1) for name, ms in timings_ms.items()}, slowestMs * 1000, slowestSql)
+        return response
+
+    def snapshot(self):
+        with self._lock:
+            return {route: histogram.to_dict() for route, histogram in sorted(self._routes.items())}
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+instrumentation = Instrumentation()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active():
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not _active() or not conn.info.get('query_started'):
+        return
+
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    g.statements += 1
+    g.timings['db'] = g.timings.get('db', 0.0) + elapsed
+    if elapsed > g.slowest_statement[0]:
+        g.slowest_statement = (elapsed, statement)
+    if elapsed * 1000 >= current_app.config['SLOW_QUERY_MS']:
+        slowLog.warning("slow query %.1fms on %s %s: %s",
+                        elapsed * 1000, request.method, request.path, statement)
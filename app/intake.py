@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timezone
+from flask import current_app
+from sqlalchemy import select, update
+from app.models import db, OrderTicket
+from app.inventory import place_orders, ReservationError
+
+
+class OrderIntake:
+    """
+    Optional asynchronous order intake.
+
+    With ORDER_INTAKE_ASYNC, POST /orders only validates the request and
+    stores it as a queued ticket in the orderTickets table. A background
+    thread in each worker wakes every ORDER_INTAKE_POLL_INTERVAL seconds, or
+    as soon as a full batch is waiting, and drains queued tickets
+    ORDER_INTAKE_BATCH_SIZE at a time. A batch costs a fixed number of
+    statements and one commit however many orders it holds; an order that
+    runs out of stock is rejected alone. A batch that fails for any other
+    reason is retried a ticket at a time, and a ticket that fails alone is
+    rejected so it can't stop the queue. Tickets survive restarts because
+    the queue is the table.
+    """
+
+    def __init__(self):
+        self.batch_size = 200
+        self.poll_interval = 0.5
+        self._worker_pid = None
+        self._queued = 0
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.batch_size = app.config['ORDER_INTAKE_BATCH_SIZE']
+        self.poll_interval = app.config['ORDER_INTAKE_POLL_INTERVAL']
+        app.before_request(lambda: self._start_worker(app))
+
+    def enqueue(self, grocer_id, lines):
+        """Queues validated order lines for the grocer and returns the ticket id"""
+        ticket = OrderTicket(ticket=str(uuid.uuid4()), grocer_id=grocer_id, lines=json.dumps(lines))
+        db.session.add(ticket)
+        db.session.commit()
+        with self._lock:
+            self._queued += 1
+            if self._queued >= self.batch_size:
+                self._wake.set()
+        return ticket.ticket
+
+    def status(self, ticket):
+        return db.session.execute(
+            select(OrderTicket.ticket, OrderTicket.grocer_id, OrderTicket.status, OrderTicket.order_id, OrderTicket.error)
+            .where(OrderTicket.ticket == ticket)
+        ).first()
+
+    def drain(self):
+        """Places up to batch_size queued orders in one transaction and returns how many it settled"""
+        oldest = (
+            select(OrderTicket.id)
+            .where(OrderTicket.status == 'queued')
+            .order_by(OrderTicket.id)
+            .limit(self.batch_size)
+            .scalar_subquery()
+        )
+        claimed = self._claim(oldest)
+        if not claimed:
+            db.session.rollback()
+            return 0
+
+        try:
+            self._settle(claimed)
+        except ReservationError:
+            # a checkout took the stock first; the whole batch goes back to the queue
+            db.session.rollback()
+            raise
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception("order intake batch failed, settling its tickets one at a time")
+            return self._settle_each(sorted(ticket.id for ticket in claimed))
+        return len(claimed)
+
+    def _claim(self, ids):
+        # claiming with a conditional UPDATE keeps two drainers off the same tickets
+        claimed = db.session.execute(
+            update(OrderTicket)
+            .where(OrderTicket.id.in_(ids), OrderTicket.status == 'queued')
+            .values(status='processing')
+            .returning(OrderTicket.id, OrderTicket.grocer_id, OrderTicket.lines)
+            .execution_options(synchronize_session=False)
+        ).all()
+        claimed.sort(key=lambda row: row.id)
+        return claimed
+
+    def _settle(self, claimed):
+        outcomes = place_orders([(ticket.grocer_id, [tuple(line) for line in json.loads(ticket.lines)])
+                                 for ticket in claimed])
+
+        processedAt = datetime.now(timezone.utc).replace(tzinfo=None)
+        db.session.execute(update(OrderTicket), [
+            {"id": ticket.id, "status": "placed" if orderId else "rejected", "order_id": orderId,
+             "error": error, "processed_at": processedAt}
+            for ticket, (orderId, error) in zip(claimed, outcomes)
+        ])
+        db.session.commit()
+
+    def _settle_each(self, ticket_ids):
+        settled = 0
+        for ticketId in ticket_ids:
+            claimed = self._claim([ticketId])
+            if not claimed:
+                db.session.rollback()
+                continue
+            try:
+                self._settle(claimed)
+            except ReservationError:
+                db.session.rollback()
+                continue
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.exception("order ticket %s rejected", ticketId)
+                db.session.execute(
+                    update(OrderTicket).where(OrderTicket.id == ticketId)
+                    .values(status='rejected', error=f"the order could not be placed ({type(e).__name__})",
+                            processed_at=datetime.now(timezone.utc).replace(tzinfo=None))
+                    .execution_options(synchronize_session=False)
+                )
+                db.session.commit()
+            settled += 1
+        return settled
+
+    def _start_worker(self, app):
+        if not app.config['ORDER_INTAKE_ASYNC'] or not self.poll_interval or self._worker_pid == os.getpid():
+            return
+        self._worker_pid = os.getpid()
+
+        def drainForever():
+            while True:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                with self._lock:
+                    self._queued = 0
+                with app.app_context():
+                    try:
+                        while self.drain() == self.batch_size:
+                            pass
+                    except Exception:
+                        app.logger.exception("order intake batch failed")
+                        db.session.rollback()
+
+        threading.Thread(target=drainForever, name='order-intake', daemon=True).start()
+
+
+order_intake = OrderIntake()
@@ -0,0 +1,174 @@
+from datetime import datetime, timezone
+from sqlalchemy import select, insert, update, case
+from app.models import db, Product, Order, OrderItem
+from app.analytics import add_sale, record_sales
+
+
+class ReservationError(Exception):
+    """Raised when an order cannot be filled; the caller rolls the session back"""
+
+
+def order_lines(orderItems):
+    """Validates the posted order items into (product_id, quantity) pairs"""
+    lines = []
+    for item in orderItems:
+        product_id = item.get('product_id') if isinstance(item, dict) else None
+        quantity = item.get('quantity') if isinstance(item, dict) else None
+
+        # JSON true and false arrive as bools, which are ints to isinstance
+        if not _whole(product_id) or not _whole(quantity) or quantity <= 0:
+            raise ReservationError("each item needs a product_id and a positive whole quantity")
+        lines.append((product_id, quantity))
+    return lines
+
+
+def _whole(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _wanted(lines):
+    wanted = {}
+    for product_id, quantity in lines:
+        wanted[product_id] = wanted.get(product_id, 0) + quantity
+    return wanted
+
+
+def _stock(product_ids):
+    return {
+        row.id: row
+        for row in db.session.execute(
+            select(Product.id, Product.farmer_id, Product.price_per_unit, Product.quantity_available)
+            .where(Product.id.in_(product_ids))
+        )
+    }
+
+
+def _shortage(wanted, available):
+    """Why `wanted` can't be filled from the `available` quantities, or None when it can"""
+    for product_id, quantity in wanted.items():
+        if product_id not in available:
+            return "product not found"
+        if available[product_id] < quantity:
+            return f"we don't have that much sorry, there's only {available[product_id]}"
+    return None
+
+
+def _take_stock(taken):
+    """One conditional UPDATE taking `taken` units of each product, all or none"""
+    amount = case(taken, value=Product.id)
+    result = db.session.execute(
+        update(Product)
+        .where(Product.id.in_(taken), Product.quantity_available >= amount)
+        .values(quantity_available=Product.quantity_available - amount)
+        .execution_options(synchronize_session=False)
+    )
+
+    # another checkout got there first for at least one product
+    if result.rowcount != len(taken):
+        raise ReservationError("we don't have that much sorry, it just sold out")
+
+
+def reserve_stock(lines):
+    """
+    Decrements stock for every line or for none of them and returns each
+    product's id, farmer_id and price_per_unit by id.
+
+    Products are read in one query, then a single conditional UPDATE takes
+    the stock only where enough is still left, so concurrent checkouts cannot
+    push quantity_available below zero.
+    """
+    wanted = _wanted(lines)
+    products = _stock(wanted)
+
+    shortage = _shortage(wanted, {product.id: product.quantity_available for product in products.values()})
+    if shortage:
+        raise ReservationError(shortage)
+
+    _take_stock(wanted)
+    return products
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def place_order(grocer_id, lines):
+    """Reserves the stock for `lines`, adds the grocer's order to the session and counts its sales"""
+    products = reserve_stock(lines)
+    orderDate = _now()
+    sales = {}
+    orderItemList = []
+    for product_id, quantity_ordered in lines:
+        product = products[product_id]
+        orderItemList.append(OrderItem(product_id=product_id,
+                                       quantity_ordered=quantity_ordered,
+                                       price_per_unit=product.price_per_unit,
+                                       total_price=product.price_per_unit * quantity_ordered))
+        add_sale(sales, product.farmer_id, product_id, quantity_ordered, product.price_per_unit * quantity_ordered)
+
+    order = Order(grocer_id=grocer_id, total_amount=sum(item.total_price for item in orderItemList),
+                  order_date=orderDate, items=orderItemList)
+    db.session.add(order)
+    record_sales(orderDate.date(), sales)
+    return order
+
+
+def place_orders(requests):
+    """
+    Places a batch of (grocer_id, lines) orders with a fixed number of
+    statements and returns an (order id, error) pair for each.
+
+    Stock is read once for the whole batch and handed out in request order,
+    so an order that can't be filled is rejected without holding up the
+    rest. Everything taken is then decremented by one conditional UPDATE and
+    added to the day's sales rollup; if a concurrent checkout got there
+    first that raises ReservationError and the caller rolls the whole batch
+    back.
+    """
+    wantedByRequest = [_wanted(lines) for _, lines in requests]
+    products = _stock(set().union(*wantedByRequest))
+    available = {product.id: product.quantity_available for product in products.values()}
+
+    outcomes = []
+    accepted = []
+    taken = {}
+    for (grocer_id, lines), wanted in zip(requests, wantedByRequest):
+        shortage = _shortage(wanted, available)
+        if shortage:
+            outcomes.append((None, shortage))
+            continue
+        for product_id, quantity in wanted.items():
+            available[product_id] -= quantity
+            taken[product_id] = taken.get(product_id, 0) + quantity
+        outcomes.append(None)
+        accepted.append((len(outcomes) - 1, grocer_id, lines))
+
+    if not accepted:
+        return outcomes
+    _take_stock(taken)
+
+    orderDate = _now()
+    sales = {}
+    for _, _, lines in accepted:
+        for product_id, quantity in lines:
+            product = products[product_id]
+            add_sale(sales, product.farmer_id, product_id, quantity, product.price_per_unit * quantity)
+    record_sales(orderDate.date(), sales)
+
+    orderIds = db.session.scalars(
+        insert(Order).returning(Order.id, sort_by_parameter_order=True),
+        [{"grocer_id": grocer_id, "order_date": orderDate,
+          "total_amount": sum(products[product_id].price_per_unit * quantity for product_id, quantity in lines)}
+         for _, grocer_id, lines in accepted]
+    ).all()
+    db.session.execute(insert(OrderItem), [
+        {"order_id": orderId, "product_id": product_id, "quantity_ordered": quantity,
+         "price_per_unit": products[product_id].price_per_unit,
+         "total_price": products[product_id].price_per_unit * quantity}
+        for orderId, (_, _, lines) in zip(orderIds, accepted)
+        for product_id, quantity in lines
+    ])
+
+    for orderId, (position, _, _) in zip(orderIds, accepted):
+        outcomes[position] = (orderId, None)
+    return outcomes
@@ -0,0 +1,36 @@
+"""add hot path indexes
+
+Revision ID: 3f1c2a9d7b10
+Revises: 
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_products_farmer_id_id', 'products', ['farmer_id', 'id']),
+    ('ix_orders_grocer_id_id', 'orders', ['grocer_id', 'id']),
+    ('ix_orderItems_order_id', 'orderItems', ['order_id']),
+    ('ix_orderItems_product_id_order_id_total_price', 'orderItems', ['product_id', 'order_id', 'total_price']),
+    ('ix_loginSession_user_id', 'loginSession', ['user_id']),
+    ('ix_loginSession_session_token', 'loginSession', ['session_token']),
+]
+
+
+def upgrade():
+    # the tables come from db.create_all(), which already indexes fresh databases
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False, if_not_exists=True)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,49 @@
+"""add product change versions
+
+Revision ID: 8b2e4c6d1a37
+Revises: 3f1c2a9d7b10
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4c6d1a37'
+down_revision = '3f1c2a9d7b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases made by db.create_all() already have all of it
+    inspector = sa.inspect(op.get_bind())
+    if 'version' not in {column['name'] for column in inspector.get_columns('products')}:
+        op.add_column('products', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+    op.create_index('ix_products_version_id', 'products', ['version', 'id'], unique=False, if_not_exists=True)
+
+    tables = set(inspector.get_table_names())
+    if 'catalogVersion' not in tables:
+        op.create_table('catalogVersion',
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('version', sa.Integer(), nullable=False),
+                        sa.PrimaryKeyConstraint('id'))
+    if 'productTombstones' not in tables:
+        op.create_table('productTombstones',
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('product_id', sa.Integer(), nullable=False),
+                        sa.Column('version', sa.Integer(), nullable=False),
+                        sa.Column('deleted_at', sa.DateTime(), nullable=True),
+                        sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_productTombstones_version_product_id', 'productTombstones', ['version', 'product_id'],
+                    unique=False, if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_productTombstones_version_product_id', table_name='productTombstones', if_exists=True)
+    op.drop_table('productTombstones')
+    op.drop_table('catalogVersion')
+    op.drop_index('ix_products_version_id', table_name='products', if_exists=True)
+    with op.batch_alter_table('products') as batch:
+        batch.drop_column('version')
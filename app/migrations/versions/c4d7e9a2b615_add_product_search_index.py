@@ -0,0 +1,51 @@
+"""add product search index
+
+Revision ID: c4d7e9a2b615
+Revises: 8b2e4c6d1a37
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d7e9a2b615'
+down_revision = '8b2e4c6d1a37'
+branch_labels = None
+depends_on = None
+
+SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS productSearch USING fts5("
+    "name, description, content='products', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "INSERT INTO productSearch(productSearch, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+    "CREATE TRIGGER IF NOT EXISTS products_search_insert AFTER INSERT ON products BEGIN "
+    "INSERT INTO productSearch(rowid, name, description) VALUES (new.id, new.name, new.description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS products_search_delete AFTER DELETE ON products BEGIN "
+    "INSERT INTO productSearch(productSearch, rowid, name, description) "
+    "VALUES ('delete', old.id, old.name, old.description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS products_search_update AFTER UPDATE OF name, description ON products BEGIN "
+    "INSERT INTO productSearch(productSearch, rowid, name, description) "
+    "VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO productSearch(rowid, name, description) VALUES (new.id, new.name, new.description); "
+    "END",
+)
+
+
+def upgrade():
+    # FTS5 is SQLite's; elsewhere product search answers 501
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for statement in SEARCH_DDL:
+        op.execute(statement)
+    op.execute("INSERT INTO productSearch(productSearch) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for trigger in ('products_search_insert', 'products_search_delete', 'products_search_update'):
+        op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    op.execute("DROP TABLE IF EXISTS productSearch")
@@ -0,0 +1,39 @@
+"""add revokedTokens.revoked_at
+
+Revision ID: d5e8f1a3c927
+Revises: c4d7e9a2b615
+Create Date: 2026-10-18 23:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e8f1a3c927'
+down_revision = 'c4d7e9a2b615'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases made by db.create_all() already have it, or will once create-db makes the table
+    inspector = sa.inspect(op.get_bind())
+    if 'revokedTokens' not in inspector.get_table_names():
+        return
+    if 'revoked_at' not in {column['name'] for column in inspector.get_columns('revokedTokens')}:
+        # SQLite can't ALTER in a column defaulting to CURRENT_TIMESTAMP, so it gets the table rebuilt
+        recreate = 'always' if op.get_bind().dialect.name == 'sqlite' else 'auto'
+        with op.batch_alter_table('revokedTokens', recreate=recreate) as batch:
+            batch.add_column(sa.Column('revoked_at', sa.DateTime(), nullable=False,
+                                       server_default=sa.func.current_timestamp()))
+    op.create_index('ix_revokedTokens_revoked_at', 'revokedTokens', ['revoked_at'], unique=False, if_not_exists=True)
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'revokedTokens' not in inspector.get_table_names():
+        return
+    op.drop_index('ix_revokedTokens_revoked_at', table_name='revokedTokens', if_exists=True)
+    with op.batch_alter_table('revokedTokens') as batch:
+        batch.drop_column('revoked_at')
@@ -0,0 +1,68 @@
+"""backfill login identifiers
+
+Revision ID: e7f2a4b8c031
+Revises: d5e8f1a3c927
+Create Date: 2026-10-18 23:30:00.000000
+
+"""
+import logging
+import re
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7f2a4b8c031'
+down_revision = 'd5e8f1a3c927'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.env')
+
+# as app.identifiers normalized them when this was written
+PHONE_SEPARATORS = re.compile(r'[\s().-]')
+CHUNK_SIZE = 5000
+
+
+def upgrade():
+    bind = op.get_bind()
+    if 'loginIdentifiers' not in sa.inspect(bind).get_table_names():
+        op.create_table('loginIdentifiers',
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('identifier', sa.String(length=120), nullable=False),
+                        sa.Column('kind', sa.Enum('email', 'phone'), nullable=False),
+                        sa.Column('user_id', sa.Integer(), nullable=False),
+                        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+                        sa.PrimaryKeyConstraint('id'),
+                        sa.UniqueConstraint('identifier', name='uq_loginIdentifiers_identifier'))
+    op.create_index('ix_loginIdentifiers_user_id', 'loginIdentifiers', ['user_id'], unique=False,
+                    if_not_exists=True)
+
+    # login only looks users up through this table, so users made before it need their rows
+    identifiers = sa.table('loginIdentifiers', sa.column('identifier'), sa.column('kind'), sa.column('user_id'))
+    if bind.execute(sa.select(identifiers.c.user_id).limit(1)).first() is not None:
+        return
+    users = sa.table('users', sa.column('id'), sa.column('email'), sa.column('phone_number'))
+    seen = set()
+    rows = []
+    skipped = []
+    for user in bind.execute(sa.select(users.c.id, users.c.email, users.c.phone_number).order_by(users.c.id)):
+        email = str(user.email).strip().casefold()
+        phone = PHONE_SEPARATORS.sub('', str(user.phone_number))
+        if email in seen or phone in seen or email == phone:
+            skipped.append(user.id)
+            continue
+        seen.update((email, phone))
+        rows += [{"identifier": email, "kind": "email", "user_id": user.id},
+                 {"identifier": phone, "kind": "phone", "user_id": user.id}]
+    for start in range(0, len(rows), CHUNK_SIZE):
+        bind.execute(identifiers.insert(), rows[start:start + CHUNK_SIZE])
+    if skipped:
+        logger.warning("users %s share an email or phone number with an earlier user and can't log in "
+                       "until that is fixed and `flask rebuild-login-identifiers` is run",
+                       ", ".join(map(str, skipped)))
+
+
+def downgrade():
+    op.drop_index('ix_loginIdentifiers_user_id', table_name='loginIdentifiers', if_exists=True)
+    op.drop_table('loginIdentifiers')
@@ -0,0 +1,31 @@
+"""widen users.password_hash
+
+Revision ID: f3a9c6d2e418
+Revises: e7f2a4b8c031
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a9c6d2e418'
+down_revision = 'e7f2a4b8c031'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Werkzeug's scrypt hashes run to 162 characters; SQLite ignores VARCHAR lengths anyway
+    if op.get_bind().dialect.name == 'sqlite':
+        return
+    op.alter_column('users', 'password_hash', existing_type=sa.String(length=120), type_=sa.String(length=256),
+                    existing_nullable=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        return
+    op.alter_column('users', 'password_hash', existing_type=sa.String(length=256), type_=sa.String(length=120),
+                    existing_nullable=False)
@@ -1,10 +1,12 @@
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy import MetaData
+from app.instrumentation import phase
+from app.hashing import password_hasher
+from app.database import RoutingSession
 
 metadata = MetaData()
 
-db = SQLAlchemy(metadata=metadata)
+db = SQLAlchemy(metadata=metadata, session_options={"class_": RoutingSession})
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -13,7 +15,7 @@ class User(db.Model):
     name = db.Column(db.String(120), nullable=False)
     email = db.Column(db.String(120), nullable=False, unique=True)
     phone_number = db.Column(db.String(12), nullable=False, unique=True)
-    password_hash = db.Column(db.String(120), nullable=False)
+    password_hash = db.Column(db.String(256), nullable=False)
     role = db.Column(db.Enum("farmer", "grocer"), nullable=False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     updated_at = db.Column(db.DateTime, default=db.func.current_timestamp())
@@ -23,10 +25,12 @@ class User(db.Model):
     login_sessions = db.relationship('LoginSession', backref='user', lazy=True)
     
     def hash_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        with phase('hash'):
+            self.password_hash = password_hasher.hash(password)
         
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        with phase('hash'):
+            return password_hasher.verify(self.password_hash, password)
     
     @property
     def is_active(self):
@@ -67,6 +71,10 @@ class Grocer(db.Model):
     
 class Product(db.Model):
     __tablename__ = 'products'
+    __table_args__ = (
+        db.Index('ix_products_farmer_id_id', 'farmer_id', 'id'),
+        db.Index('ix_products_version_id', 'version', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     farmer_id = db.Column(db.Integer, db.ForeignKey('farmers.id'))
@@ -74,6 +82,8 @@ class Product(db.Model):
     description = db.Column(db.String(400))
     quantity_available = db.Column(db.Integer, nullable=False)
     price_per_unit = db.Column(db.Integer, nullable=False)
+    # catalog version of the transaction that last wrote the row, see app.changes
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     order_items = db.relationship('OrderItem', backref='product', lazy=True)
     
@@ -82,6 +92,9 @@ class Product(db.Model):
     
 class Order(db.Model):
     __tablename__ = 'orders'
+    __table_args__ = (
+        db.Index('ix_orders_grocer_id_id', 'grocer_id', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     grocer_id = db.Column(db.Integer, db.ForeignKey('grocers.id'))
@@ -96,9 +109,13 @@ class Order(db.Model):
     
 class OrderItem(db.Model):
     __tablename__ = 'orderItems'
+    __table_args__ = (
+        # covers the farmer history join: product -> order with the line total
+        db.Index('ix_orderItems_product_id_order_id_total_price', 'product_id', 'order_id', 'total_price'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'))
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'))
     quantity_ordered = db.Column(db.Integer, nullable=False)
     price_per_unit = db.Column(db.Integer, nullable=False)
@@ -111,10 +128,160 @@ class LoginSession(db.Model):
     __tablename__ = 'loginSession'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    session_token = db.Column(db.String(120), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    session_token = db.Column(db.String(120), nullable=False, index=True)
     login_time = db.Column(db.DateTime, default=db.func.current_timestamp())
     logout_time = db.Column(db.DateTime, default=None)
     
     def __repr__(self):
-        return f"<LoginSession: {self.id}, {self.user_id}, {self.session_token}, {self.login_time}, {self.logout_time}>"
\ No newline at end of file
+        return f"<LoginSession: {self.id}, {self.user_id}, {self.session_token}, {self.login_time}, {self.logout_time}>"
+    
+class LoginIdentifier(db.Model):
+    __tablename__ = 'loginIdentifiers'
+    __table_args__ = (
+        db.UniqueConstraint('identifier', name='uq_loginIdentifiers_identifier'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # a user's email or phone number as app.identifiers normalizes it
+    identifier = db.Column(db.String(120), nullable=False)
+    kind = db.Column(db.Enum("email", "phone"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    
+    user = db.relationship('User', backref=db.backref('login_identifiers', cascade='all, delete-orphan'))
+    
+    def __repr__(self):
+        return f"<LoginIdentifier: {self.identifier}, {self.kind}, {self.user_id}>"
+    
+class RevokedToken(db.Model):
+    __tablename__ = 'revokedTokens'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), nullable=False, unique=True)
+    expires_at = db.Column(db.Integer, nullable=False, index=True)
+    # the database's clock, which workers sync from; see TokenRevocationStore.sync
+    revoked_at = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp(), index=True)
+    
+    def __repr__(self):
+        return f"<RevokedToken: {self.id}, {self.jti}, {self.expires_at}>"
+    
+class OrderTicket(db.Model):
+    __tablename__ = 'orderTickets'
+    __table_args__ = (
+        db.Index('ix_orderTickets_status_id', 'status', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    ticket = db.Column(db.String(36), nullable=False, unique=True)
+    grocer_id = db.Column(db.Integer, db.ForeignKey('grocers.id'), nullable=False)
+    lines = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Enum("queued", "processing", "placed", "rejected"), nullable=False, default="queued")
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'))
+    error = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    processed_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f"<OrderTicket: {self.id}, {self.ticket}, {self.grocer_id}, {self.status}, {self.order_id}>"
+    
+class ProductDailySales(db.Model):
+    __tablename__ = 'productDailySales'
+    __table_args__ = (
+        db.Index('ix_productDailySales_farmer_id_day', 'farmer_id', 'day'),
+    )
+    
+    farmer_id = db.Column(db.Integer, db.ForeignKey('farmers.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    units_sold = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<ProductDailySales: {self.farmer_id}, {self.product_id}, {self.day}, {self.units_sold}, {self.revenue}>"
+    
+class CatalogVersion(db.Model):
+    __tablename__ = 'catalogVersion'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<CatalogVersion: {self.version}>"
+    
+class ProductTombstone(db.Model):
+    __tablename__ = 'productTombstones'
+    __table_args__ = (
+        db.Index('ix_productTombstones_version_product_id', 'version', 'product_id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    
+    def __repr__(self):
+        return f"<ProductTombstone: {self.product_id}, {self.version}>"
+    
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotencyKeys'
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'key', name='uq_idempotencyKeys_scope_key'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(80), nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    fingerprint = db.Column(db.String(32), nullable=False)
+    # null while the first request is still running
+    status_code = db.Column(db.Integer)
+    headers = db.Column(db.Text)
+    body = db.Column(db.LargeBinary)
+    expires_at = db.Column(db.Integer, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f"<IdempotencyKey: {self.scope}, {self.key}, {self.status_code}>"
+    
+class ArchivedOrder(db.Model):
+    __tablename__ = 'archivedOrders'
+    __table_args__ = (
+        db.Index('ix_archivedOrders_grocer_id_id', 'grocer_id', 'id'),
+        db.Index('ix_archivedOrders_order_date', 'order_date'),
+    )
+    
+    # ids are kept, so history pages and archived items still line up
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    grocer_id = db.Column(db.Integer)
+    total_amount = db.Column(db.Integer, nullable=False)
+    order_date = db.Column(db.DateTime)
+    delivery_date = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f"<ArchivedOrder: {self.id}, {self.grocer_id}, {self.total_amount}, {self.order_date}, {self.delivery_date}>"
+    
+class ArchivedOrderItem(db.Model):
+    __tablename__ = 'archivedOrderItems'
+    __table_args__ = (
+        db.Index('ix_archivedOrderItems_product_id_order_id_total_price', 'product_id', 'order_id', 'total_price'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    order_id = db.Column(db.Integer, nullable=False, index=True)
+    product_id = db.Column(db.Integer)
+    quantity_ordered = db.Column(db.Integer, nullable=False)
+    price_per_unit = db.Column(db.Integer, nullable=False)
+    total_price = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f"<ArchivedOrderItem: {self.order_id}, {self.product_id}, {self.quantity_ordered}, {self.price_per_unit}, {self.total_price}>"
+    
+class ArchivedLoginSession(db.Model):
+    __tablename__ = 'archivedLoginSessions'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, index=True)
+    session_token = db.Column(db.String(120), nullable=False)
+    login_time = db.Column(db.DateTime, index=True)
+    logout_time = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f"<ArchivedLoginSession: {self.id}, {self.user_id}, {self.session_token}, {self.login_time}, {self.logout_time}>"
@@ -0,0 +1,179 @@
+import hashlib
+import heapq
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, delete, exists
+from app.models import db, RevokedToken, LoginSession, ArchivedLoginSession
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings; never gives false negatives"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * step) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class TokenRevocationStore:
+    """
+    Revoked JWT ids, checked on every authenticated request.
+
+    Revocations live in the revokedTokens table and in a per-process map of
+    jti to expiry, so a check is normally a dictionary lookup. Each worker pulls
+    other workers' revocations from the table at most every
+    REVOCATION_SYNC_INTERVAL seconds, and entries drop out once their token
+    expires. Syncs follow revoked_at rather than ids, which databases hand out
+    in insert order, not commit order, and each one reads the last
+    REVOCATION_SYNC_OVERLAP again so a revocation that committed late is still
+    picked up. When more than REVOCATION_CACHE_SIZE tokens are revoked the map no
+    longer holds them all; an optional Bloom filter then answers for tokens that
+    were never revoked and only its positives are looked up in the table.
+    """
+
+    def __init__(self):
+        self.cache_size = 100_000
+        self.sync_interval = 5
+        self.bloom_capacity = 0
+        self.purge_interval = 0
+        self.sync_overlap = timedelta(seconds=30)
+        self.session_retention = timedelta(days=30)
+        self._purger_pid = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def init_app(self, app):
+        self.configure(app.config)
+        app.before_request(lambda: self._start_purger(app))
+
+    def configure(self, config):
+        self.cache_size = config['REVOCATION_CACHE_SIZE']
+        self.sync_interval = config['REVOCATION_SYNC_INTERVAL']
+        self.bloom_capacity = config['REVOCATION_BLOOM_CAPACITY']
+        self.purge_interval = config['REVOCATION_PURGE_INTERVAL']
+        self.sync_overlap = config['REVOCATION_SYNC_OVERLAP']
+        self.session_retention = config['LOGIN_SESSION_RETENTION']
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._revoked = {}
+            self._expiry = []
+            self._complete = True
+            self._synced_to = None
+            # jti -> revoked_at of the rows inside the overlap, so rereading them is a no-op
+            self._recent = {}
+            self._next_sync = 0.0
+            self._bloom = BloomFilter(self.bloom_capacity) if self.bloom_capacity else None
+
+    def revoke(self, jti, expires_at):
+        """Revokes a token until its `exp`; the caller commits the session"""
+        db.session.add(RevokedToken(jti=jti, expires_at=int(expires_at)))
+        with self._lock:
+            self._remember(jti, int(expires_at), time.time())
+
+    def is_revoked(self, jti):
+        now = time.time()
+        if now >= self._next_sync:
+            self.sync(now)
+
+        with self._lock:
+            self._evict(now)
+            if jti in self._revoked:
+                return True
+            if self._complete:
+                return False
+            if self._bloom is not None and jti not in self._bloom:
+                return False
+
+        return db.session.execute(
+            select(exists().where(RevokedToken.jti == jti, RevokedToken.expires_at > int(now)))
+        ).scalar()
+
+    def sync(self, now=None):
+        """Pulls revocations made since the last sync, by this or any other worker"""
+        now = now or time.time()
+        query = select(RevokedToken.jti, RevokedToken.expires_at, RevokedToken.revoked_at) \
+            .where(RevokedToken.expires_at > int(now)).order_by(RevokedToken.revoked_at)
+        if self._synced_to is not None:
+            # a transaction stamps revoked_at before it commits, so rows can land behind the watermark
+            query = query.where(RevokedToken.revoked_at >= self._synced_to - self.sync_overlap)
+        rows = db.session.execute(query).all()
+
+        with self._lock:
+            for row in rows:
+                if row.jti not in self._recent:
+                    self._remember(row.jti, row.expires_at, now)
+                    self._recent[row.jti] = row.revoked_at
+                if self._synced_to is None or row.revoked_at > self._synced_to:
+                    self._synced_to = row.revoked_at
+            if self._synced_to is not None:
+                cutoff = self._synced_to - self.sync_overlap
+                self._recent = {jti: revokedAt for jti, revokedAt in self._recent.items() if revokedAt >= cutoff}
+            self._next_sync = now + self.sync_interval
+
+    def _remember(self, jti, expires_at, now):
+        if expires_at <= now or jti in self._revoked:
+            return
+        self._revoked[jti] = expires_at
+        heapq.heappush(self._expiry, (expires_at, jti))
+        if self._bloom is not None:
+            self._bloom.add(jti)
+
+        # over capacity the soonest-expiring entries go first; the table still has them
+        while len(self._revoked) > self.cache_size:
+            _, evicted = heapq.heappop(self._expiry)
+            if self._revoked.pop(evicted, None) is not None:
+                self._complete = False
+
+    def _evict(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            _, jti = heapq.heappop(self._expiry)
+            self._revoked.pop(jti, None)
+
+    def purge(self):
+        """Deletes expired revocations and login sessions, archived or not, older than LOGIN_SESSION_RETENTION"""
+        now = time.time()
+        sessionCutoff = datetime.now(timezone.utc).replace(tzinfo=None) - self.session_retention
+        db.session.execute(delete(RevokedToken).where(RevokedToken.expires_at <= int(now)))
+        db.session.execute(delete(LoginSession).where(LoginSession.login_time < sessionCutoff))
+        db.session.execute(delete(ArchivedLoginSession).where(ArchivedLoginSession.login_time < sessionCutoff))
+        db.session.commit()
+        # reload from the table so the map and Bloom filter shed what expired
+        self.reset()
+
+    def _start_purger(self, app):
+        if not self.purge_interval or self._purger_pid == os.getpid():
+            return
+        self._purger_pid = os.getpid()
+
+        def purgeForever():
+            while True:
+                time.sleep(self.purge_interval)
+                with app.app_context():
+                    try:
+                        self.purge()
+                    except Exception:
+                        app.logger.exception("revocation purge failed")
+                        db.session.rollback()
+
+        threading.Thread(target=purgeForever, name='revocation-purge', daemon=True).start()
+
+
+revocation_store = TokenRevocationStore()
@@ -0,0 +1,176 @@
+import re
+from sqlalchemy import event, select, table, column, and_, or_, Integer, Float, Text
+from app.models import db, User, Farmer, Product
+from app.catalog import serialize_product
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_TERMS = 8
+SORTS = ('rank', 'id')
+
+# An external content FTS5 table: it indexes products.name and description but
+# stores no copy of them, and the triggers keep it in step with every write,
+# ORM or bulk. Stock and price updates leave the indexed columns alone and so
+# never touch it. Names weigh ten times as much as descriptions in the ranking.
+SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS productSearch USING fts5("
+    "name, description, content='products', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "INSERT INTO productSearch(productSearch, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+    "CREATE TRIGGER IF NOT EXISTS products_search_insert AFTER INSERT ON products BEGIN "
+    "INSERT INTO productSearch(rowid, name, description) VALUES (new.id, new.name, new.description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS products_search_delete AFTER DELETE ON products BEGIN "
+    "INSERT INTO productSearch(productSearch, rowid, name, description) "
+    "VALUES ('delete', old.id, old.name, old.description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS products_search_update AFTER UPDATE OF name, description ON products BEGIN "
+    "INSERT INTO productSearch(productSearch, rowid, name, description) "
+    "VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO productSearch(rowid, name, description) VALUES (new.id, new.name, new.description); "
+    "END",
+)
+
+search_index = table('productSearch', column('rowid', Integer), column('rank', Float), column('productSearch', Text))
+
+
+def create_search_index(connection):
+    """Creates the search table and its triggers where they are missing; SQLite only"""
+    for statement in SEARCH_DDL:
+        connection.exec_driver_sql(statement)
+
+
+def rebuild_search_index():
+    """Creates the search index if needed and reindexes every product, for databases filled before it existed"""
+    connection = db.session.connection()
+    create_search_index(connection)
+    connection.exec_driver_sql("INSERT INTO productSearch(productSearch) VALUES ('rebuild')")
+
+
+def search_available():
+    return db.session.get_bind().dialect.name == 'sqlite'
+
+
+@event.listens_for(Product.__table__, 'after_create')
+def _create_with_products(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        create_search_index(connection)
+
+
+@event.listens_for(Product.__table__, 'after_drop')
+def _drop_with_products(target, connection, **kw):
+    # the triggers go with the products table, the index has to be dropped by hand
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql("DROP TABLE IF EXISTS productSearch")
+        # pooled connections keep the dropped index's structure cached and misread a new one by the same name
+        connection.engine.dispose()
+
+
+def match_expression(text):
+    """
+    The FTS5 query for what a user typed: every word must match, as a word or
+    as the start of one. Quoting each word keeps FTS5 syntax in the input
+    from being interpreted. Raises ValueError when there is nothing to search for.
+    """
+    words = re.findall(r'\w+', text or '')
+    if not words:
+        raise ValueError("q needs at least one word")
+    return " ".join(f'"{word}"*' for word in words[:MAX_TERMS])
+
+
+def parse_search_args(args, default_limit=DEFAULT_PAGE_SIZE, max_limit=MAX_PAGE_SIZE):
+    """
+    Pulls the search terms, sort, keyset cursor and filters out of the query
+    string. The cursor is the X-Next-After of the previous page: an id when
+    sorting by id, "rank,id" when sorting by rank. Raises ValueError on bad input.
+    """
+    limit = args.get('limit', default_limit, type=int)
+    sort = args.get('sort', 'rank')
+    if sort not in SORTS:
+        raise ValueError(f"sort must be one of {', '.join(SORTS)}")
+
+    after = args.get('after')
+    if after is not None:
+        if sort == 'rank':
+            rank, productId = after.split(',')
+            after = (float(rank), int(productId))
+        else:
+            after = int(after)
+
+    return {
+        "match": match_expression(args.get('q')),
+        "sort": sort,
+        "after": after,
+        "limit": max(1, min(limit, max_limit)),
+        "farmer_id": args.get('farmer_id', type=int),
+        "min_price": args.get('min_price', type=float),
+        "max_price": args.get('max_price', type=float),
+        "min_quantity": args.get('min_quantity', type=int)
+    }
+
+
+def search_query(match, sort='rank', after=None, limit=None, farmer_id=None, min_price=None, max_price=None,
+                 min_quantity=None):
+    """
+    Products matching the FTS5 expression `match`, with their farmer's name
+    and rank, best first or by id. The index drives the join, so filters only
+    look at matching products, and without filters only the page of matches
+    is joined at all.
+    """
+    rank = search_index.c.rank
+    rowid = search_index.c.rowid
+    # in rowid order FTS5 hands matches over already sorted, so a page stops reading early;
+    # by rank every match has to be scored first
+    order = (rank, rowid) if sort == 'rank' else (rowid,)
+    hits = select(rowid.label('id'), rank.label('rank')).where(search_index.c.productSearch.match(match))
+    if after is not None:
+        if sort == 'rank':
+            afterRank, afterId = after
+            hits = hits.where(or_(rank > afterRank, and_(rank == afterRank, rowid > afterId)))
+        else:
+            hits = hits.where(rowid > after)
+
+    conditions = []
+    if farmer_id is not None:
+        conditions.append(Product.farmer_id == farmer_id)
+    if min_price is not None:
+        conditions.append(Product.price_per_unit >= min_price)
+    if max_price is not None:
+        conditions.append(Product.price_per_unit <= max_price)
+    if min_quantity is not None:
+        conditions.append(Product.quantity_available >= min_quantity)
+    if not conditions and limit is not None:
+        hits = hits.order_by(*order).limit(limit)
+    hits = hits.subquery('hits')
+
+    query = (
+        select(Product.id,
+               Product.name,
+               Product.description,
+               Product.quantity_available,
+               Product.price_per_unit,
+               User.name.label('farmer_name'),
+               hits.c.rank)
+        .select_from(hits)
+        .join(Product, Product.id == hits.c.id)
+        .outerjoin(Farmer, Product.farmer_id == Farmer.id)
+        .outerjoin(User, Farmer.user_id == User.id)
+        .where(*conditions)
+        .order_by(*((hits.c.rank, hits.c.id) if sort == 'rank' else (hits.c.id,)))
+    )
+    return query.limit(limit) if limit is not None else query
+
+
+def search_products(limit=DEFAULT_PAGE_SIZE, **filters):
+    """One page of search results, shaped like the catalog's, and the cursor for the next page or None"""
+    result = db.session.execute(search_query(limit=limit + 1, **filters))
+    rows = result.all()
+
+    nextAfter = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        nextAfter = f"{last.rank!r},{last.id}" if filters.get('sort', 'rank') == 'rank' else last.id
+
+    serialize = serialize_product.compile(result.keys())
+    return [serialize(row) for row in rows], nextAfter
@@ -0,0 +1,125 @@
+import random
+from datetime import datetime, timedelta
+from app.models import db, User, Farmer, Grocer, Product, Order, OrderItem
+from werkzeug.security import generate_password_hash
+from app.hashing import password_hasher
+from app.analytics import rebuild_sales
+from app.identifiers import login_identifiers
+
+SCALES = {
+    '1k': 1_000,
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000
+}
+SEED_PASSWORD = 'secret'
+ITEMS_PER_ORDER = 4
+CHUNK_SIZE = 10_000
+START_DATE = datetime(2024, 1, 1)
+PRODUCE = ["Tomatoes", "Kale", "Spinach", "Onions", "Potatoes", "Carrots", "Cabbage",
+           "Avocados", "Mangoes", "Bananas", "Beans", "Maize", "Peppers", "Garlic"]
+
+
+def marketplace_size(order_items):
+    """How many rows of each model a marketplace with `order_items` order items gets"""
+    products = max(10, order_items // 20)
+    return {
+        "farmers": max(2, products // 25),
+        "grocers": max(2, order_items // 200),
+        "products": products,
+        "orders": max(1, -(-order_items // ITEMS_PER_ORDER)),
+        "order_items": order_items
+    }
+
+
+def farmer_email(number):
+    return f"farmer{number}@evergreen.test"
+
+
+def grocer_email(number):
+    return f"grocer{number}@evergreen.test"
+
+
+def _insert_chunked(model, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            db.session.execute(model.__table__.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(model.__table__.insert(), chunk)
+
+
+def seed_marketplace(order_items=SCALES['1k'], seed=0):
+    """
+    Fills an empty database with a synthetic marketplace in one transaction.
+
+    The same `order_items` and `seed` always produce the same rows and ids, so
+    benchmark runs are comparable. Every user's password is SEED_PASSWORD and
+    products carry enough stock that benchmark orders never run out.
+    """
+    rng = random.Random(seed)
+    size = marketplace_size(order_items)
+    passwordHash = generate_password_hash(SEED_PASSWORD, password_hasher.method, password_hasher.salt_length)
+    farmers, grocers = size["farmers"], size["grocers"]
+
+    _insert_chunked(User, (
+        {"id": number, "name": f"Farmer {number}", "email": farmer_email(number),
+         "phone_number": f"07{number:08d}", "password_hash": passwordHash, "role": "farmer"}
+        for number in range(1, farmers + 1)
+    ))
+    _insert_chunked(User, (
+        {"id": farmers + number, "name": f"Grocer {number}", "email": grocer_email(number),
+         "phone_number": f"01{number:08d}", "password_hash": passwordHash, "role": "grocer"}
+        for number in range(1, grocers + 1)
+    ))
+    _insert_chunked(Farmer, ({"id": number, "user_id": number} for number in range(1, farmers + 1)))
+    _insert_chunked(Grocer, (
+        {"id": number, "user_id": farmers + number, "store_name": f"Store {number}"}
+        for number in range(1, grocers + 1)
+    ))
+
+    prices = [rng.randint(5, 500) for _ in range(size["products"])]
+    _insert_chunked(Product, (
+        {"id": number, "farmer_id": rng.randint(1, farmers),
+         "name": f"{rng.choice(PRODUCE)} {number}", "description": "Fresh from the farm",
+         "quantity_available": 10_000_000, "price_per_unit": prices[number - 1]}
+        for number in range(1, size["products"] + 1)
+    ))
+
+    def ordersAndItems():
+        itemId = 0
+        for orderId in range(1, size["orders"] + 1):
+            items = []
+            for _ in range(min(ITEMS_PER_ORDER, order_items - itemId)):
+                itemId += 1
+                productId = rng.randint(1, size["products"])
+                quantity = rng.randint(1, 20)
+                price = prices[productId - 1]
+                items.append({"id": itemId, "order_id": orderId, "product_id": productId,
+                              "quantity_ordered": quantity, "price_per_unit": price,
+                              "total_price": price * quantity})
+            order = {"id": orderId, "grocer_id": rng.randint(1, grocers),
+                     "total_amount": sum(item["total_price"] for item in items),
+                     "order_date": START_DATE + timedelta(minutes=rng.randint(0, 365 * 24 * 60)),
+                     "delivery_date": None}
+            yield order, items
+
+    orderChunk, itemChunk = [], []
+    for order, items in ordersAndItems():
+        orderChunk.append(order)
+        itemChunk.extend(items)
+        if len(itemChunk) >= CHUNK_SIZE:
+            db.session.execute(Order.__table__.insert(), orderChunk)
+            db.session.execute(OrderItem.__table__.insert(), itemChunk)
+            orderChunk, itemChunk = [], []
+    if orderChunk:
+        db.session.execute(Order.__table__.insert(), orderChunk)
+    if itemChunk:
+        db.session.execute(OrderItem.__table__.insert(), itemChunk)
+
+    rebuild_sales()
+    login_identifiers.rebuild()
+    db.session.commit()
+    return size
@@ -0,0 +1,189 @@
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import namedtuple
+from app.changes import catalog_versioning, catalog_changes, changes_query, current_version
+from app.streaming import stream_rows
+
+MAX_ITEMS = 100
+
+Offer = namedtuple('Offer', ['key', 'name', 'price', 'quantity', 'farmer'])
+
+
+def normalize_name(name):
+    return " ".join(name.split()).casefold()
+
+
+def shopping_list(items, max_items=MAX_ITEMS):
+    """Validates the posted shopping list into (name, quantity) pairs. Raises ValueError when it is malformed."""
+    if not isinstance(items, list) or not items:
+        raise ValueError("the shopping list needs items")
+    if len(items) > max_items:
+        raise ValueError(f"at most {max_items} items per shopping list")
+
+    lines = []
+    for item in items:
+        name = item.get('name') if isinstance(item, dict) else None
+        quantity = item.get('quantity') if isinstance(item, dict) else None
+        # JSON true and false arrive as bools, which are ints to isinstance
+        if not isinstance(name, str) or not name.strip() or not isinstance(quantity, int) \
+                or isinstance(quantity, bool) or quantity <= 0:
+            raise ValueError("each item needs a name and a positive whole quantity")
+        lines.append((name, quantity))
+    return lines
+
+
+class PriceIndex:
+    """
+    In-memory index of the catalog for sourcing: products grouped by
+    normalized name, each group sorted by price_per_unit, with their stock.
+
+    The first use loads every product; after that the index follows the
+    changes feed, reading it when a commit in this worker changed the catalog
+    or SOURCING_REFRESH_INTERVAL seconds after it last looked, which picks up
+    other workers' commits. Answers are only as fresh as that, so orders
+    placed from them still take stock with the usual conditional UPDATE.
+    """
+
+    def __init__(self):
+        self.refresh_interval = 1
+        self.page_size = 1000
+        self._offers = {}
+        self._products = {}
+        self._version = None
+        self._stale = True
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.refresh_interval = app.config['SOURCING_REFRESH_INTERVAL']
+        self.page_size = app.config['CATALOG_CHANGES_PAGE_SIZE']
+        catalog_versioning.on_commit(self.notify)
+
+    def notify(self, version):
+        self._stale = True
+
+    def clear(self):
+        with self._lock:
+            self._offers.clear()
+            self._products.clear()
+            self._version = None
+            self._stale = True
+
+    def refresh(self):
+        """
+        Brings the index up to the committed catalog. The database is read
+        without the lock, so sourcing goes on from the old index meanwhile,
+        and what was read is swapped in only once all of it was.
+        """
+        with self._lock:
+            self._stale = False
+            self._checked = time.monotonic()
+            since = self._version
+        try:
+            if since is None:
+                self._load()
+            else:
+                self._follow(since)
+        except Exception:
+            self._stale = True
+            raise
+
+    def _load(self):
+        offers, products = {}, {}
+        # the version first, so nothing committed during the load is skipped later
+        version = current_version()
+        for row in stream_rows(changes_query()):
+            _put(offers, products, row.id, row.name, row.price_per_unit, row.quantity_available, row.farmer_name)
+        with self._lock:
+            # another request may have loaded it meanwhile
+            if self._version is None:
+                self._offers, self._products, self._version = offers, products, version
+
+    def _follow(self, since):
+        pages = []
+        version = since
+        while True:
+            changes = catalog_changes(since=version, limit=self.page_size)
+            pages.append(changes)
+            version = changes["version"]
+            if not changes["more"]:
+                break
+        with self._lock:
+            if self._version != since:
+                return
+            for changes in pages:
+                for productId in changes["deleted"]:
+                    _remove(self._offers, self._products, productId)
+                for product in changes["products"]:
+                    _put(self._offers, self._products, product["id"], product["name"], product["price"],
+                         product["quantity"], product["farmer"])
+            self._version = version
+
+    def source(self, lines):
+        """
+        The cheapest way to buy each (name, quantity) line: offers for the
+        name are taken cheapest first, as much of each as is in stock, until
+        the quantity is covered. Lines naming the same product share its stock.
+        """
+        # until a load has succeeded every request loads for itself rather than source from nothing
+        if self._stale or self._version is None or time.monotonic() - self._checked > self.refresh_interval:
+            self.refresh()
+
+        taken = {}
+        sourcedLines = []
+        with self._lock:
+            for name, quantity in lines:
+                remaining = quantity
+                sourced = []
+                for price, productId in self._offers.get(normalize_name(name), ()):
+                    offer = self._products[productId]
+                    available = offer.quantity - taken.get(productId, 0)
+                    if available <= 0:
+                        continue
+                    bought = min(available, remaining)
+                    taken[productId] = taken.get(productId, 0) + bought
+                    sourced.append({"product_id": productId, "product_name": offer.name, "farmer": offer.farmer,
+                                    "price_per_unit": price, "quantity": bought, "total_price": price * bought})
+                    remaining -= bought
+                    if not remaining:
+                        break
+                sourcedLines.append({"name": name, "quantity": quantity, "sourced": sourced,
+                                     "total_price": sum(item["total_price"] for item in sourced),
+                                     "missing": remaining})
+
+        return {
+            "lines": sourcedLines,
+            "complete": not any(line["missing"] for line in sourcedLines),
+            "total_amount": sum(line["total_price"] for line in sourcedLines),
+            # the body POST /orders takes
+            "order_items": [{"product_id": productId, "quantity": quantity} for productId, quantity in taken.items()]
+        }
+
+    def stats(self):
+        with self._lock:
+            return {"products": len(self._products), "names": len(self._offers), "version": self._version}
+
+
+price_index = PriceIndex()
+
+
+def _put(offers, products, product_id, name, price, quantity, farmer):
+    key = normalize_name(name)
+    current = products.get(product_id)
+    if current is not None and (current.key, current.price) != (key, price):
+        _remove(offers, products, product_id)
+        current = None
+    if current is None:
+        insort(offers.setdefault(key, []), (price, product_id))
+    products[product_id] = Offer(key, name, price, quantity, farmer)
+
+
+def _remove(offers, products, product_id):
+    offer = products.pop(product_id, None)
+    if offer is None:
+        return
+    group = offers[offer.key]
+    del group[bisect_left(group, (offer.price, product_id))]
+    if not group:
+        del offers[offer.key]
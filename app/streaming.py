@@ -0,0 +1,25 @@
+from flask import current_app, stream_with_context
+from app.models import db
+
+STREAM_BATCH_SIZE = 1000
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def wants_ndjson(request):
+    return request.args.get('format') == 'ndjson'
+
+
+def stream_rows(query, batch_size=STREAM_BATCH_SIZE):
+    """Runs the query on a server-side cursor, holding at most one batch of rows at a time"""
+    return db.session.execute(query.execution_options(yield_per=batch_size))
+
+
+def ndjson_response(records):
+    """Streams each record as one line of JSON while the request context stays open"""
+    dumps = current_app.json.dumps
+
+    def generate():
+        for record in records:
+            yield dumps(record) + "\n"
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
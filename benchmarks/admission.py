@@ -0,0 +1,108 @@
+"""
+Tail latency of a cheap route while --concurrency clients hammer POST /login,
+with no admission control, with the per-route concurrency caps, and with the
+caps and the rate limits together, against the cheap route on an idle worker.
+
+    python -m benchmarks.admission --logins 100 --concurrency 32 --login-cap 2
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.harness import use_scratch_database, summarize, write_results
+
+os.environ['RATELIMIT_ENABLED'] = 'true'
+use_scratch_database()
+
+from app.models import db
+from app.admission import limiter, concurrency_caps
+from app.hashing import password_hasher
+from app.seed import SCALES, SEED_PASSWORD, seed_marketplace, farmer_email
+from benchmarks.endpoints import app, authenticate
+
+
+def cheap_route(done, samples):
+    """Polls the catalog changes feed, a one-statement route no cap or limit covers, until `done`"""
+    client = app.test_client()
+    authenticate(client, 1)
+    while not done.is_set():
+        begin = time.perf_counter()
+        client.get('/products/changes', query_string={'since': 1, 'limit': 10}).close()
+        samples.append(time.perf_counter() - begin)
+        time.sleep(0.005)
+
+
+def run(logins, concurrency, seconds, farmers=1):
+    done = threading.Event()
+    samples = []
+    poller = threading.Thread(target=cheap_route, args=(done, samples))
+    poller.start()
+
+    def login(i):
+        client = app.test_client()
+        begin = time.perf_counter()
+        response = client.post('/login', json={"identifier": farmer_email(i % farmers + 1), "password": SEED_PASSWORD},
+                               environ_base={'REMOTE_ADDR': f"10.0.{i // 250}.{i % 250}"})
+        return time.perf_counter() - begin, response.status_code
+
+    started = time.perf_counter()
+    if logins:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(login, range(logins)))
+    else:
+        results = []
+        time.sleep(seconds)
+    elapsed = time.perf_counter() - started
+    done.set()
+    poller.join()
+
+    statuses = [status for _, status in results]
+    return {
+        "login": summarize([latency for latency, status in results if status == 200], elapsed, 0, 0),
+        "rejected": {str(code): statuses.count(code) for code in sorted(set(statuses)) if code != 200},
+        "cheap_route": summarize(samples, elapsed, 0, 0)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--login-cap', type=int, default=app.config['ROUTE_CONCURRENCY']['login'])
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        size = seed_marketplace(SCALES['1k'])
+    # a hashing queue deep enough that only admission control turns logins away
+    app.config['HASH_POOL_MAX_PENDING'] = args.concurrency
+    app.config['HASH_ADMISSION_TIMEOUT'] = 30
+    password_hasher.init_app(app)
+    password_hasher.hash("warm the pool up")
+
+    results = {"idle": run(0, 0, 3)}
+    scenarios = (("no admission", 0, False), ("caps", args.login_cap, False), ("caps + limits", args.login_cap, True))
+    for label, cap, limits in scenarios:
+        app.config['ROUTE_CONCURRENCY'] = {**app.config['ROUTE_CONCURRENCY'], "login": cap}
+        concurrency_caps.init_app(app)
+        limiter.enabled = limits
+        limiter.reset()
+        results[label] = run(args.logins, args.concurrency, 0, size["farmers"])
+
+    print(f"{'mode':<15}{'cheap p50 ms':>13}{'p95 ms':>9}{'p99 ms':>9}{'logins ok':>11}{'login p95 ms':>14}  rejected")
+    for label, stats in results.items():
+        cheap = stats["cheap_route"]
+        print(f"{label:<15}{cheap['p50_ms']:>13}{cheap['p95_ms']:>9}{cheap['p99_ms']:>9}"
+              f"{stats['login']['requests']:>11}{stats['login']['p95_ms']:>14}  {stats['rejected']}")
+    if args.output:
+        write_results(args.output, results)
+    password_hasher.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
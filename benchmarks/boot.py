@@ -0,0 +1,85 @@
+"""
+Worker boot cost: importing the app, building it with create_app() and serving
+its first requests, each sample in a fresh interpreter as a new gunicorn
+worker would.
+
+    python -m benchmarks.boot --runs 20 --output boot-results.json
+    python -m benchmarks.boot --runs 20 --baseline boot-results.json
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from benchmarks.harness import use_scratch_database, summarize, write_results, load_results, compare, report
+
+PHASES = ["import app.app", "create_app()", "first GET /", "first POST /login"]
+
+BOOT_SCRIPT = """
+import json, time
+started = time.perf_counter()
+from app.app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+client = app.test_client()
+home = client.get('/')
+served = time.perf_counter()
+login = client.post('/login', json={"identifier": "nobody@evergreen.test", "password": "wrong"})
+loggedIn = time.perf_counter()
+print(json.dumps({
+    "seconds": [imported - started, created - imported, served - created, loggedIn - served],
+    "errors": [0, 0, int(home.status_code >= 400), int(login.status_code != 401)]
+}))
+"""
+
+
+def boot_once():
+    output = subprocess.run([sys.executable, '-c', BOOT_SCRIPT], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(runs):
+    samples = {phase: [] for phase in PHASES}
+    errors = {phase: 0 for phase in PHASES}
+    started = time.perf_counter()
+    for _ in range(runs):
+        boot = boot_once()
+        for phase, seconds, failed in zip(PHASES, boot["seconds"], boot["errors"]):
+            samples[phase].append(seconds)
+            errors[phase] += failed
+    elapsed = time.perf_counter() - started
+
+    return {"runs": runs, "scenarios": {
+        phase: summarize(samples[phase], elapsed, 0, errors[phase]) for phase in PHASES
+    }}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare against results written by an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    use_scratch_database()
+    # the boots share one database so the first requests find a schema
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app.app:create_app', 'create-db'],
+                   check=True, capture_output=True)
+
+    results = run(args.runs)
+    report(results)
+    if args.output:
+        write_results(args.output, results)
+
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+Benchmarks every endpoint through the Flask test client against a seeded marketplace.
+
+    python -m benchmarks.endpoints --scale 10k --output benchmark-results.json
+    python -m benchmarks.endpoints --scale 10k --baseline benchmark-results.json
+
+With --baseline the run exits with status 1 when any scenario regressed.
+"""
+import argparse
+import sys
+from benchmarks.harness import (use_scratch_database, StatementCounter, measure,
+                                write_results, load_results, compare, report)
+
+use_scratch_database()
+
+from flask_jwt_extended import create_access_token, get_csrf_token
+from app.app import create_app
+from app.models import db, User
+from app.identity import identity_claims
+from app.seed import SCALES, SEED_PASSWORD, seed_marketplace, farmer_email, grocer_email
+
+app = create_app()
+
+
+def authenticate(client, user_id, claims=None):
+    """Logs the client in with a token carrying the same claims login mints"""
+    with app.app_context():
+        if claims is None:
+            claims = identity_claims(db.session.get(User, user_id))
+        access_token = create_access_token(identity=user_id, additional_claims=claims)
+        csrf_token = get_csrf_token(access_token)
+    client.set_cookie('access_token_cookie', access_token)
+    return {'X-CSRF-TOKEN': csrf_token}
+
+
+def scenarios(size):
+    """Maps each scenario name to a call(i) that issues one request"""
+    farmerClient = app.test_client()
+    farmerHeaders = authenticate(farmerClient, 1)
+    grocerClient = app.test_client()
+    grocerHeaders = authenticate(grocerClient, size["farmers"] + 1)
+    anonymous = app.test_client()
+    products = size["products"]
+    with app.app_context():
+        grocerClaims = identity_claims(db.session.get(User, size["farmers"] + 1))
+
+    def logout(i):
+        # every logout revokes its token, so each one gets a client that has just logged in
+        client = app.test_client()
+        headers = authenticate(client, size["farmers"] + 1, grocerClaims)
+        return client.post('/logout', headers=headers)
+
+    return {
+        "GET /products": lambda i: farmerClient.get('/products'),
+        "GET /products?after": lambda i: farmerClient.get('/products', query_string={'after': (i * 97) % products}),
+        "GET /products?format=ndjson": lambda i: farmerClient.get('/products', query_string={'format': 'ndjson'}),
+        "GET /orders farmer": lambda i: farmerClient.get('/orders'),
+        "GET /orders grocer": lambda i: grocerClient.get('/orders'),
+        "GET /analytics/sales": lambda i: farmerClient.get('/analytics/sales', query_string={
+            'since': '2024-01-01', 'until': '2024-07-01'
+        }),
+        "POST /orders": lambda i: grocerClient.post('/orders', headers=grocerHeaders, json={
+            "order_items": [{"product_id": (i * 7) % products + 1, "quantity": 1},
+                            {"product_id": (i * 13) % products + 1, "quantity": 2}]
+        }),
+        "POST /products": lambda i: farmerClient.post('/products', headers=farmerHeaders, json={
+            "name": f"Bench Produce {i}", "description": "Benchmark produce",
+            "quantity_available": 100, "price_per_unit": 50
+        }),
+        "POST /signup": lambda i: anonymous.post('/signup', json={
+            "name": "Bench Grocer", "email": f"bench{i}@evergreen.test", "phone_number": f"05{i + 100:08d}",
+            "password": SEED_PASSWORD, "role": "grocer", "store_name": f"Bench Store {i}"
+        }),
+        "POST /login": lambda i: anonymous.post('/login', json={
+            "identifier": farmer_email(1) if i % 2 else grocer_email(1), "password": SEED_PASSWORD
+        }),
+        "POST /logout": logout
+    }
+
+
+def run(scale, seed, iterations, only=None):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        size = seed_marketplace(SCALES[scale], seed)
+        engine = db.engine
+
+    results = {"scale": scale, "seed": seed, "size": size, "scenarios": {}}
+    with StatementCounter(engine) as counter:
+        for name, call in scenarios(size).items():
+            if only and only not in name:
+                continue
+            results["scenarios"][name] = measure(call, iterations, counter)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=SCALES, default='1k', help="order items to seed")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=50, help="requests per scenario")
+    parser.add_argument('--only', help="run only scenarios whose name contains this")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="fail on regressions against this results file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed p95 slowdown, 0.25 is 25%%")
+    args = parser.parse_args(argv)
+
+    results = run(args.scale, args.seed, args.iterations, args.only)
+    report(results)
+    if args.output:
+        write_results(args.output, results)
+
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
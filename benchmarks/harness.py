@@ -0,0 +1,121 @@
+"""Shared plumbing for the benchmark scripts: a scratch database, timing and SQL counting"""
+import json
+import os
+import tempfile
+import time
+from sqlalchemy import event
+
+
+def use_scratch_database():
+    """Points the app at a throwaway SQLite file; call before importing app.app"""
+    os.environ.setdefault('FLASK_CONFIG', 'development')
+    os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///' + tempfile.mkstemp(suffix='.db')[1])
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark-secret')
+    # the scripts replay one client as fast as it can; benchmarks.admission turns the limits back on
+    os.environ.setdefault('RATELIMIT_ENABLED', 'false')
+
+
+class StatementCounter:
+    """Counts SQL statements sent through an engine while attached"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self)
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not samples:
+        return 0.0
+    rank = max(1, -(-len(samples) * pct // 100))
+    return samples[int(rank) - 1]
+
+
+def summarize(samples, elapsed, statements, errors):
+    samples = sorted(samples)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "statements_per_request": round(statements / len(samples), 2) if samples else 0.0
+    }
+
+
+def measure(call, iterations, counter, warmup=3):
+    """
+    Runs call(i) `iterations` times after a short warmup and summarizes the
+    latency, throughput and SQL statements per request. Responses with a
+    status of 400 or more are counted as errors.
+    """
+    for i in range(warmup):
+        call(-1 - i).close()
+
+    samples = []
+    statements = 0
+    errors = 0
+    started = time.perf_counter()
+    for i in range(iterations):
+        counter.count = 0
+        begin = time.perf_counter()
+        response = call(i)
+        # streamed bodies are only produced while they are read
+        response.get_data()
+        response.close()
+        samples.append(time.perf_counter() - begin)
+        statements += counter.count
+        if response.status_code >= 400:
+            errors += 1
+
+    return summarize(samples, time.perf_counter() - started, statements, errors)
+
+
+def write_results(path, results):
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as source:
+        return json.load(source)
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Lists the regressions of `results` against `baseline`: a scenario that
+    disappeared, p95 latency more than `tolerance` slower, more SQL
+    statements per request, or new errors.
+    """
+    regressions = []
+    for name, before in baseline["scenarios"].items():
+        after = results["scenarios"].get(name)
+        if after is None:
+            regressions.append(f"{name}: missing from this run")
+            continue
+        if after["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {after['p95_ms']}ms")
+        if after["statements_per_request"] > before["statements_per_request"]:
+            regressions.append(f"{name}: statements per request "
+                               f"{before['statements_per_request']} -> {after['statements_per_request']}")
+        if after["errors"] > before["errors"]:
+            regressions.append(f"{name}: errors {before['errors']} -> {after['errors']}")
+    return regressions
+
+
+def report(results):
+    print(f"{'scenario':<34}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'sql/req':>9}{'errors':>8}")
+    for name, stats in results["scenarios"].items():
+        print(f"{name:<34}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+              f"{stats['throughput_rps']:>10}{stats['statements_per_request']:>9}{stats['errors']:>8}")
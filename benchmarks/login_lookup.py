@@ -0,0 +1,118 @@
+"""
+Resolves a mix of valid and invalid login identifiers against --users users:
+with the OR query login used to run, with one probe of the identifier index,
+and with the probe behind the negative cache. Invalid identifiers are drawn
+from a pool of --bogus, so credential stuffing repeats some of them. Only
+the lookup is timed; checking the password costs the same either way.
+
+    python -m benchmarks.login_lookup --users 200000 --invalid-share 0.5 --lookups 5000
+"""
+import argparse
+import random
+import sys
+import time
+from benchmarks.harness import use_scratch_database, StatementCounter, percentile, write_results
+
+use_scratch_database()
+
+from app.models import db, User
+from app.identifiers import login_identifiers
+from app.seed import SCALES, seed_marketplace
+from benchmarks.endpoints import app
+
+
+def add_users(users, seed=0):
+    """Bulk inserts `users` farmers and returns (email, phone number) for each"""
+    rng = random.Random(seed)
+    passwordHash = db.session.get(User, 1).password_hash
+    rows = [{"name": f"User {i}", "email": f"user{i}@example.test", "phone_number": f"+2547{i:08d}",
+             "password_hash": passwordHash, "role": "farmer"} for i in range(users)]
+    for start in range(0, len(rows), 10_000):
+        db.session.execute(User.__table__.insert(), rows[start:start + 10_000])
+    login_identifiers.rebuild()
+    db.session.commit()
+    return [(row["email"], row["phone_number"]) for row in rng.sample(rows, min(users, 5000))]
+
+
+def workload(accounts, lookups, invalid_share, bogus, seed=1):
+    """What logins send: known emails and phone numbers as written, and made up ones"""
+    rng = random.Random(seed)
+    pool = [f"nobody{i}@example.test" if i % 2 else f"+2541{i:08d}" for i in range(bogus)]
+    identifiers = []
+    for _ in range(lookups):
+        if rng.random() < invalid_share:
+            identifiers.append(rng.choice(pool))
+        else:
+            email, phone = rng.choice(accounts)
+            identifiers.append(email if rng.random() < 0.5 else phone)
+    return identifiers
+
+
+def by_or_query(identifier):
+    """The lookup login ran before the identifier index"""
+    return User.query.options(db.joinedload(User.farmer), db.joinedload(User.grocer)) \
+        .filter((User.email == identifier) | (User.phone_number == identifier)).first()
+
+
+def timed(lookup, identifiers):
+    samples = []
+    with StatementCounter(db.engine) as counter:
+        begin = time.perf_counter()
+        for identifier in identifiers:
+            start = time.perf_counter()
+            lookup(identifier)
+            samples.append(time.perf_counter() - start)
+            db.session.rollback()
+        elapsed = time.perf_counter() - begin
+    samples.sort()
+    return {"p50_ms": round(percentile(samples, 50) * 1000, 3), "p95_ms": round(percentile(samples, 95) * 1000, 3),
+            "lookups_per_s": round(len(identifiers) / elapsed, 1),
+            "statements_per_lookup": round(counter.count / len(identifiers), 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200_000)
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--invalid-share', type=float, default=0.5, help="fraction of lookups for nobody")
+    parser.add_argument('--bogus', type=int, default=1000, help="distinct invalid identifiers")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_marketplace(SCALES['1k'])
+        accounts = add_users(args.users)
+        identifiers = workload(accounts, args.lookups, args.invalid_share, args.bogus)
+
+        results = {"users": db.session.query(User).count(), "lookups": args.lookups,
+                   "invalid_share": args.invalid_share, "bogus": args.bogus,
+                   "or_query": timed(by_or_query, identifiers)}
+        login_identifiers.max_entries = 0
+        results["index_probe"] = timed(login_identifiers.find, identifiers)
+        login_identifiers.max_entries = app.config['LOGIN_NEGATIVE_CACHE_SIZE']
+        login_identifiers.clear()
+        results["index_probe_negative_cache"] = timed(login_identifiers.find, identifiers)
+
+        # the OR query only finds identifiers written exactly as stored
+        typed = [identifier.upper() if '@' in identifier else identifier[:4] + " " + identifier[4:]
+                 for identifier in identifiers[:500]]
+        results["found_as_typed"] = {"or_query": sum(by_or_query(i) is not None for i in typed),
+                                     "index_probe": sum(login_identifiers.find(i) is not None for i in typed)}
+
+    print(f"{results['users']} users, {args.lookups} lookups, {args.invalid_share:.0%} for one of "
+          f"{args.bogus} unknown identifiers")
+    for label in ("or_query", "index_probe", "index_probe_negative_cache"):
+        timing = results[label]
+        print(f"{label:>27}: p50 {timing['p50_ms']} ms, p95 {timing['p95_ms']} ms, "
+              f"{timing['lookups_per_s']} lookups/s, {timing['statements_per_lookup']} statements per lookup")
+    print(f"typed in another case or with spaces, out of 500: {results['found_as_typed']}")
+
+    if args.output:
+        write_results(args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+Login throughput with the password hashing pool enabled and disabled, and the
+latency a cheap route sees while logins saturate the worker.
+
+    python -m benchmarks.login_pool --logins 200 --concurrency 16 --pool-workers 4
+"""
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.harness import use_scratch_database, summarize, write_results
+
+use_scratch_database()
+
+from app.models import db
+from app.hashing import password_hasher
+from app.seed import SCALES, SEED_PASSWORD, seed_marketplace, farmer_email
+from benchmarks.endpoints import app, authenticate
+
+
+def run_logins(logins, concurrency):
+    """Fires `logins` logins from `concurrency` threads while timing GET /products alongside"""
+    def login(i):
+        client = app.test_client()
+        begin = time.perf_counter()
+        response = client.post('/login', json={"identifier": farmer_email(i % 5 + 1), "password": SEED_PASSWORD})
+        return time.perf_counter() - begin, response.status_code
+
+    done = threading.Event()
+    cheapSamples = []
+
+    def pollCatalog():
+        client = app.test_client()
+        authenticate(client, 1)
+        while not done.is_set():
+            begin = time.perf_counter()
+            client.get('/products').close()
+            cheapSamples.append(time.perf_counter() - begin)
+            time.sleep(0.005)
+
+    poller = threading.Thread(target=pollCatalog)
+    poller.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(login, range(logins)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    poller.join()
+
+    rejected = sum(1 for _, status in results if status == 503)
+    loginStats = summarize([seconds for seconds, _ in results], elapsed, 0, rejected)
+    return {
+        "login": loginStats,
+        "rejected_503": rejected,
+        "cheap_route": summarize(cheapSamples, elapsed, 0, 0)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--pool-workers', type=int, default=app.config['HASH_POOL_WORKERS'] or 2)
+    parser.add_argument('--max-pending', type=int, default=64)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_marketplace(SCALES['1k'])
+
+    results = {}
+    for label, workers in (("pool", args.pool_workers), ("inline", 0)):
+        app.config['HASH_POOL_WORKERS'] = workers
+        app.config['HASH_POOL_MAX_PENDING'] = args.max_pending
+        password_hasher.init_app(app)
+        password_hasher.hash("warm the pool up")
+        results[label] = run_logins(args.logins, args.concurrency)
+
+    print(f"{'mode':<8}{'logins/s':>10}{'login p95 ms':>14}{'503s':>6}{'cheap p50 ms':>14}{'cheap p95 ms':>14}")
+    for label, stats in results.items():
+        print(f"{label:<8}{stats['login']['throughput_rps']:>10}{stats['login']['p95_ms']:>14}"
+              f"{stats['rejected_503']:>6}{stats['cheap_route']['p50_ms']:>14}{stats['cheap_route']['p95_ms']:>14}")
+    if args.output:
+        write_results(args.output, results)
+    password_hasher.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
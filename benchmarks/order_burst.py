@@ -0,0 +1,111 @@
+"""
+A flash-sale burst of orders through the synchronous POST /orders path and
+through the asynchronous intake, where the time until the background worker
+has settled every ticket is measured as well as the time to accept them.
+
+    python -m benchmarks.order_burst --orders 2000 --concurrency 32 --batch-size 200
+"""
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.harness import use_scratch_database, summarize, write_results
+
+use_scratch_database()
+
+from sqlalchemy import select, func
+from app.models import db, OrderTicket
+from app.intake import order_intake
+from app.seed import SCALES, seed_marketplace
+from benchmarks.endpoints import app, authenticate
+
+
+def burst(orders, concurrency, grocers, products):
+    """Posts `orders` orders from `concurrency` threads, each with its own logged in grocer client"""
+    local = threading.local()
+
+    def post(i):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            local.headers = authenticate(local.client, grocers[i % len(grocers)])
+        begin = time.perf_counter()
+        response = local.client.post('/orders', headers=local.headers, json={
+            "order_items": [{"product_id": (i * 7) % products + 1, "quantity": 1},
+                            {"product_id": (i * 13) % products + 1, "quantity": 2}]
+        })
+        return time.perf_counter() - begin, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(post, range(orders)))
+    return results, time.perf_counter() - started
+
+
+def wait_until_settled(timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with app.app_context():
+            pending = db.session.execute(
+                select(func.count()).where(OrderTicket.status.in_(['queued', 'processing']))
+            ).scalar()
+        if not pending:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=app.config['ORDER_INTAKE_BATCH_SIZE'])
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        size = seed_marketplace(SCALES['1k'])
+    grocers = list(range(size["farmers"] + 1, size["farmers"] + size["grocers"] + 1))
+
+    results = {}
+    app.config['ORDER_INTAKE_ASYNC'] = False
+    samples, elapsed = burst(args.orders, args.concurrency, grocers, size["products"])
+    results["sync"] = summarize([seconds for seconds, _ in samples], elapsed, 0,
+                                sum(1 for _, status in samples if status != 201))
+
+    app.config['ORDER_INTAKE_ASYNC'] = True
+    order_intake.batch_size = args.batch_size
+    order_intake.poll_interval = order_intake.poll_interval or 0.05
+    started = time.perf_counter()
+    samples, accepted = burst(args.orders, args.concurrency, grocers, size["products"])
+    settled = wait_until_settled()
+    settledElapsed = time.perf_counter() - started
+    results["async_accept"] = summarize([seconds for seconds, _ in samples], accepted, 0,
+                                        sum(1 for _, status in samples if status != 202))
+    with app.app_context():
+        placed = db.session.execute(
+            select(func.count()).select_from(OrderTicket).where(OrderTicket.status == 'placed')
+        ).scalar()
+    results["async_settled"] = {
+        "all_settled": settled,
+        "placed": placed,
+        "seconds": round(settledElapsed, 3),
+        "orders_per_s": round(placed / settledElapsed, 1)
+    }
+
+    print(f"{'path':<16}{'p50 ms':>10}{'p95 ms':>10}{'orders/s':>12}{'errors':>8}")
+    for name in ("sync", "async_accept"):
+        stats = results[name]
+        print(f"{name:<16}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['throughput_rps']:>12}{stats['errors']:>8}")
+    print(f"{'async_settled':<16}{'':>10}{'':>10}{results['async_settled']['orders_per_s']:>12}"
+          f"{args.orders - placed:>8}")
+
+    if args.output:
+        write_results(args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+Searches a catalog of --products products through the FTS5 index, ranked
+and in id order, with and without price and stock filters, and for
+comparison with the LIKE scan a search would otherwise take. Also times
+writing the products with the index triggers on and rebuilding the index.
+
+    python -m benchmarks.search --products 500000 --iterations 50
+"""
+import argparse
+import random
+import sys
+import time
+from benchmarks.harness import use_scratch_database, percentile, write_results
+
+use_scratch_database()
+
+from sqlalchemy import or_
+from app.models import db, Product
+from app.catalog import catalog_query
+from app.seed import PRODUCE, SCALES, seed_marketplace
+from app.search import match_expression, search_products, rebuild_search_index
+from benchmarks.endpoints import app
+
+ADJECTIVES = ["Fresh", "Organic", "Ripe", "Green", "Red", "Local", "Sweet", "Crunchy", "Juicy", "Baby"]
+WORDS = ["picked", "this", "morning", "grown", "without", "sprays", "from", "the", "highlands", "sold", "by",
+         "the", "crate", "or", "kilo", "delivered", "weekly", "farm", "fresh", "grade"]
+
+# what grocers type, from narrow to broad
+QUERIES = {
+    "exact_name": "Ripe Tomatoes 4217",
+    "two_prefixes": "juic mang",
+    "name_prefix": "tomat",
+    "description_word": "highlands",
+}
+
+
+def add_products(products, farmers, seed=0):
+    """Bulk inserts `products` products with varied names and descriptions; returns the seconds it took"""
+    rng = random.Random(seed)
+    rows = [{"farmer_id": rng.randint(1, farmers),
+             "name": f"{rng.choice(ADJECTIVES)} {rng.choice(PRODUCE)} {i}",
+             "description": " ".join(rng.choice(WORDS) for _ in range(8)),
+             "quantity_available": rng.randint(0, 200), "price_per_unit": rng.randint(1, 500)}
+            for i in range(products)]
+    begin = time.perf_counter()
+    for start in range(0, len(rows), 10_000):
+        db.session.execute(Product.__table__.insert(), rows[start:start + 10_000])
+    db.session.commit()
+    return time.perf_counter() - begin
+
+
+def by_like(text, limit, **filters):
+    """A search without the index: every word somewhere in the name or description, by id"""
+    query = catalog_query(**filters)
+    for word in text.split():
+        query = query.where(or_(Product.name.ilike(f"%{word}%"), Product.description.ilike(f"%{word}%")))
+    return db.session.execute(query.limit(limit)).all()
+
+
+def timed(call, iterations):
+    samples = []
+    for i in range(iterations):
+        begin = time.perf_counter()
+        call(i)
+        samples.append(time.perf_counter() - begin)
+    samples.sort()
+    return {"p50_ms": round(percentile(samples, 50) * 1000, 3), "p95_ms": round(percentile(samples, 95) * 1000, 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=500_000)
+    parser.add_argument('--limit', type=int, default=20, help="results per page")
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        size = seed_marketplace(SCALES['1k'])
+        insertSeconds = add_products(args.products, size["farmers"])
+        begin = time.perf_counter()
+        rebuild_search_index()
+        db.session.commit()
+        rebuildSeconds = time.perf_counter() - begin
+
+        filters = {"max_price": 250, "min_quantity": 50}
+        results = {"products": args.products + size["products"], "insert_s": round(insertSeconds, 1),
+                   "rebuild_s": round(rebuildSeconds, 1), "queries": {}}
+        for label, text in QUERIES.items():
+            match = match_expression(text)
+            _, cursor = search_products(match=match, limit=args.limit)
+            afterRank, afterId = cursor.split(',') if cursor else (0, 0)
+            results["queries"][label] = {
+                "ranked": timed(lambda i: search_products(match=match, limit=args.limit), args.iterations),
+                "ranked_filtered": timed(lambda i: search_products(match=match, limit=args.limit, **filters),
+                                         args.iterations),
+                "ranked_next_page": timed(lambda i: search_products(match=match, limit=args.limit,
+                                                                    after=(float(afterRank), int(afterId))),
+                                          args.iterations),
+                "by_id": timed(lambda i: search_products(match=match, sort='id', limit=args.limit), args.iterations),
+                "by_id_filtered": timed(lambda i: search_products(match=match, sort='id', limit=args.limit,
+                                                                  **filters), args.iterations),
+                "like_scan": timed(lambda i: by_like(text, args.limit, **filters), min(args.iterations, 5))
+            }
+
+    print(f"{results['products']} products: inserted with the index in {results['insert_s']} s, "
+          f"rebuilt in {results['rebuild_s']} s")
+    for label, timings in results["queries"].items():
+        print(f"{label} ({QUERIES[label]!r})")
+        for variant, timing in timings.items():
+            print(f"{variant:>20}: p50 {timing['p50_ms']} ms, p95 {timing['p95_ms']} ms")
+
+    if args.output:
+        write_results(args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""
+Serializes a 10k-order purchase history in one response, with Flask's default
+JSON provider and the orjson one, uncompressed and gzipped, and reports the
+latency and the bytes on the wire. Building the order dicts from rows by
+attribute, as the serializers used to, is timed against the compiled ones.
+
+    python -m benchmarks.serialization --orders 10000 --iterations 10
+"""
+import argparse
+import sys
+import time
+from benchmarks.harness import use_scratch_database, StatementCounter, measure, write_results
+
+use_scratch_database()
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import update
+from app.models import db, Order
+from app.history import grocer_orders_query, grocer_items_query, grocer_order_serializer, _items_by_order
+from app.serialization import FastJSONProvider
+from app.seed import ITEMS_PER_ORDER, seed_marketplace
+from benchmarks.endpoints import app, authenticate
+
+
+def by_attribute(order, items, grocer_name):
+    return {
+        "order_id": order.id,
+        "grocer_name": grocer_name,
+        "products": [
+            {
+                "product_name": item.product_name,
+                "farmer_name": item.farmer_name,
+                "quantity_ordered": item.quantity_ordered,
+                "price_per_unit": item.price_per_unit,
+                "total_price": item.total_price
+            }
+            for item in items
+        ],
+        "total_amount": order.total_amount,
+        "order_date": order.order_date
+    }
+
+
+def time_encoders(document, providers, iterations):
+    """Milliseconds for each provider to encode the history document into a response"""
+    timings = {}
+    with app.app_context():
+        for name, provider in providers.items():
+            begin = time.perf_counter()
+            for _ in range(iterations):
+                provider.response(document)
+            timings[name] = round((time.perf_counter() - begin) / iterations * 1000, 2)
+    return timings
+
+
+def time_serializers(grocer_id, iterations):
+    """
+    Milliseconds to turn the whole history's rows into dicts, by attribute and
+    compiled, and the compiled serializer's document
+    """
+    with app.app_context():
+        result = db.session.execute(grocer_orders_query(grocer_id))
+        rows = result.all()
+        itemsQuery = grocer_items_query([row.id for row in rows])
+        itemsByOrder = _items_by_order(itemsQuery)
+
+        timings = {}
+        for name in ("by_attribute", "compiled"):
+            begin = time.perf_counter()
+            for _ in range(iterations):
+                if name == "compiled":
+                    serialize = grocer_order_serializer(result.keys(), itemsQuery.selected_columns.keys(), "Bench")
+                    document = [serialize(row, itemsByOrder.get(row.id, [])) for row in rows]
+                else:
+                    [by_attribute(row, itemsByOrder.get(row.id, []), "Bench") for row in rows]
+            timings[name] = round((time.perf_counter() - begin) / iterations * 1000, 2)
+    return timings, document
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=10_000)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        size = seed_marketplace(args.orders * ITEMS_PER_ORDER)
+        grocerId = 1
+        # one grocer owns every order, so a single page is the whole history
+        db.session.execute(update(Order).values(grocer_id=grocerId))
+        db.session.commit()
+        engine = db.engine
+    app.config['ORDER_HISTORY_MAX_PAGE_SIZE'] = args.orders
+
+    client = app.test_client()
+    authenticate(client, size["farmers"] + grocerId)
+    providers = {"default": DefaultJSONProvider(app), "orjson": FastJSONProvider(app)}
+    for provider in providers.values():
+        provider.compact = True
+    serializers, document = time_serializers(grocerId, args.iterations)
+    results = {"orders": args.orders, "serializers_ms": serializers,
+               "encoders_ms": time_encoders(document, providers, args.iterations), "responses": {}}
+
+    with StatementCounter(engine) as counter:
+        for providerName, provider in providers.items():
+            app.json = provider
+            for encoding in ("identity", "gzip"):
+                headers = {'Accept-Encoding': encoding}
+                response = client.get('/orders', query_string={'limit': args.orders}, headers=headers)
+                stats = measure(lambda i: client.get('/orders', query_string={'limit': args.orders}, headers=headers),
+                                args.iterations, counter, warmup=1)
+                stats["bytes"] = len(response.data)
+                results["responses"][f"{providerName} {encoding}"] = stats
+
+    print(f"rows to dicts: by attribute {results['serializers_ms']['by_attribute']}ms, "
+          f"compiled {results['serializers_ms']['compiled']}ms")
+    print(f"encoding: default {results['encoders_ms']['default']}ms, orjson {results['encoders_ms']['orjson']}ms")
+    print(f"{'response':<18}{'p50 ms':>10}{'p95 ms':>10}{'bytes':>12}")
+    for name, stats in results["responses"].items():
+        print(f"{name:<18}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['bytes']:>12}")
+
+    if args.output:
+        write_results(args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
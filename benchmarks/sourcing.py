@@ -0,0 +1,123 @@
+"""
+Sources shopping lists against a catalog of --products products, where each
+name is sold by many farmers at different prices, from the in-memory price
+index and, for comparison, with one ordered query per line. Also times the
+index's first load and its catch-up after a farmer reprices a product.
+
+    python -m benchmarks.sourcing --products 50000 --names 700 --lines 20 --iterations 200
+"""
+import argparse
+import random
+import sys
+import time
+from benchmarks.harness import use_scratch_database, percentile, write_results
+
+use_scratch_database()
+
+from sqlalchemy import select
+from app.models import db, Product
+from app.seed import PRODUCE, SCALES, seed_marketplace
+from app.sourcing import price_index, normalize_name
+from benchmarks.endpoints import app
+
+
+def add_offers(products, names, farmers, seed=0):
+    """Bulk inserts `products` products spread over `names` names, each sold by several farmers"""
+    rng = random.Random(seed)
+    catalog = [f"{PRODUCE[i % len(PRODUCE)]} {i // len(PRODUCE)}" for i in range(names)]
+    rows = [{"farmer_id": rng.randint(1, farmers), "name": catalog[i % names], "description": "Fresh",
+             "quantity_available": rng.randint(0, 200), "price_per_unit": rng.randint(1, 500)}
+            for i in range(products)]
+    for start in range(0, len(rows), 10_000):
+        db.session.execute(Product.__table__.insert(), rows[start:start + 10_000])
+    db.session.commit()
+    return catalog
+
+
+def by_query(lines):
+    """The same greedy plan with a query per line, cheapest offers first"""
+    plan = []
+    for name, quantity in lines:
+        remaining = quantity
+        offers = db.session.execute(
+            select(Product.id, Product.name, Product.price_per_unit, Product.quantity_available)
+            .where(Product.name == name, Product.quantity_available > 0)
+            .order_by(Product.price_per_unit, Product.id)
+        )
+        for offer in offers:
+            bought = min(offer.quantity_available, remaining)
+            plan.append((offer.id, bought))
+            remaining -= bought
+            if not remaining:
+                break
+    return plan
+
+
+def timed(call, iterations):
+    samples = []
+    for i in range(iterations):
+        begin = time.perf_counter()
+        call(i)
+        samples.append(time.perf_counter() - begin)
+    samples.sort()
+    return {"p50_ms": round(percentile(samples, 50) * 1000, 3), "p95_ms": round(percentile(samples, 95) * 1000, 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=50_000)
+    parser.add_argument('--names', type=int, default=700, help="distinct product names")
+    parser.add_argument('--lines', type=int, default=20, help="items per shopping list")
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        size = seed_marketplace(SCALES['10k'])
+        catalog = add_offers(args.products, args.names, size["farmers"])
+        rng = random.Random(1)
+        lists = [[(rng.choice(catalog), rng.randint(1, 300)) for _ in range(args.lines)] for _ in range(50)]
+
+        price_index.clear()
+        begin = time.perf_counter()
+        price_index.refresh()
+        loadMs = (time.perf_counter() - begin) * 1000
+        price_index.refresh_interval = 3600
+
+        results = {
+            "products": args.products + size["products"],
+            "names": price_index.stats()["names"],
+            "lines": args.lines,
+            "index_load_ms": round(loadMs, 1),
+            "index": timed(lambda i: price_index.source(lists[i % len(lists)]), args.iterations),
+            "query_per_line": timed(lambda i: by_query(lists[i % len(lists)]), min(args.iterations, 50))
+        }
+
+        # a farmer reprices, so the next answer first reads the changes since the index's version
+        def afterCommit(i):
+            name = lists[i % len(lists)][0][0]
+            product = db.session.get(Product, price_index._offers[normalize_name(name)][0][1])
+            product.price_per_unit += 1
+            db.session.commit()
+            begin = time.perf_counter()
+            price_index.source(lists[i % len(lists)])
+            return time.perf_counter() - begin
+
+        samples = sorted(afterCommit(i) for i in range(min(args.iterations, 50)))
+        results["after_commit"] = {"p50_ms": round(percentile(samples, 50) * 1000, 3),
+                                   "p95_ms": round(percentile(samples, 95) * 1000, 3)}
+
+    print(f"{results['products']} products under {results['names']} names, {args.lines} lines per list")
+    print(f"index load {results['index_load_ms']} ms")
+    for label in ("index", "after_commit", "query_per_line"):
+        print(f"{label:>16}: p50 {results[label]['p50_ms']} ms, p95 {results[label]['p95_ms']} ms")
+
+    if args.output:
+        write_results(args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+What the live stock stream costs per commit as subscribers are added,
+against the polling it replaces: every subscriber fetching GET /products
+once per --poll-interval seconds.
+
+    python -m benchmarks.stock_stream --subscribers 1 10 100 1000 --commits 50
+"""
+import argparse
+import sys
+import time
+from benchmarks.harness import use_scratch_database, percentile, write_results
+
+use_scratch_database()
+
+from app.models import db
+from app.hub import stock_hub
+from app.inventory import place_order
+from app.seed import SCALES, seed_marketplace
+from benchmarks.endpoints import app, authenticate
+
+
+def fan_out(subscribers, commits, size):
+    """Milliseconds per dispatch of one committed order to `subscribers` queues, each drained like a client would"""
+    stock_hub.max_subscribers = subscribers
+    stock_hub.queue_size = commits + 1
+    with app.test_request_context():
+        subscriptions = [stock_hub.subscribe()[0] for _ in range(subscribers)]
+
+    samples = []
+    for i in range(commits):
+        with app.app_context():
+            place_order(size["farmers"] + 1, [((i * 7) % size["products"] + 1, 1)])
+            db.session.commit()
+            begin = time.perf_counter()
+            stock_hub.dispatch()
+            samples.append(time.perf_counter() - begin)
+        for subscription in subscriptions:
+            subscription.frames.get_nowait()
+
+    for subscription in subscriptions:
+        stock_hub.unsubscribe(subscription)
+    samples.sort()
+    return {
+        "subscribers": subscribers,
+        "dispatch_p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "dispatch_p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "us_per_subscriber": round(percentile(samples, 50) * 1e6 / subscribers, 2)
+    }
+
+
+def polling_ms(iterations):
+    """Median milliseconds of the GET /products a polling client sends"""
+    client = app.test_client()
+    authenticate(client, 1)
+    samples = []
+    for _ in range(iterations):
+        begin = time.perf_counter()
+        client.get('/products').get_data()
+        samples.append(time.perf_counter() - begin)
+    samples.sort()
+    return percentile(samples, 50) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=SCALES, default='10k', help="order items to seed")
+    parser.add_argument('--subscribers', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--commits', type=int, default=50, help="orders committed per subscriber count")
+    parser.add_argument('--poll-interval', type=float, default=3, help="seconds between polls of a polling client")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        size = seed_marketplace(SCALES[args.scale])
+    stock_hub.poll_interval = 0
+
+    pollMs = polling_ms(50)
+    results = {"scale": args.scale, "poll_ms": round(pollMs, 3), "fan_out": []}
+    print(f"{'subscribers':>12}{'dispatch p50 ms':>17}{'p95 ms':>10}{'us/subscriber':>15}{'polling ms/s':>14}")
+    for subscribers in args.subscribers:
+        stats = fan_out(subscribers, args.commits, size)
+        # the server time the same clients would spend polling, per second
+        stats["polling_ms_per_s"] = round(subscribers / args.poll_interval * pollMs, 1)
+        results["fan_out"].append(stats)
+        print(f"{subscribers:>12}{stats['dispatch_p50_ms']:>17}{stats['dispatch_p95_ms']:>10}"
+              f"{stats['us_per_subscriber']:>15}{stats['polling_ms_per_s']:>14}")
+
+    if args.output:
+        write_results(args.output, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
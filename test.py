@@ -1,7 +1,28 @@
+import os
+import tempfile
 import pytest
-from app.app import app, db
-from app.models import User, Farmer, Grocer, Product, Order, OrderItem
-from flask_jwt_extended import create_access_token
+
+# the app reads its database and JWT settings from the environment at import time
+os.environ.setdefault('FLASK_CONFIG', 'development')
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///' + tempfile.mkstemp(suffix='.db')[1])
+os.environ.setdefault('JWT_SECRET_KEY', 'test-secret')
+os.environ.setdefault('REVOCATION_SYNC_INTERVAL', '600')
+os.environ.setdefault('ORDER_INTAKE_POLL_INTERVAL', '0')
+os.environ.setdefault('STOCK_STREAM_POLL_INTERVAL', '0')
+
+from sqlalchemy import event
+from app.app import create_app, init_migrations
+from app.models import db, User, Farmer, Grocer, Product, Order, OrderItem
+from app.cache import catalog_cache
+from app.revocation import revocation_store
+from app.identity import identity_cache
+from app.sourcing import price_index
+from app.idempotency import idempotency_store
+from app.admission import limiter, concurrency_caps
+from app.identifiers import login_identifiers
+from flask_jwt_extended import create_access_token, get_csrf_token
+
+app = create_app('development')
 
 @pytest.fixture
 def client():
@@ -11,6 +32,14 @@ def client():
 
     with app.app_context():
         db.create_all()
+        revocation_store.reset()
+        revocation_store.sync()
+    catalog_cache.clear()
+    identity_cache.clear()
+    price_index.clear()
+    idempotency_store.clear()
+    login_identifiers.clear()
+    limiter.reset()
 
     yield client
 
@@ -128,5 +157,1676 @@ def test_get_orders_grocer(client):
     assert response.status_code == 200
     assert isinstance(response.json, list)
 
+def make_user(name, email, phone_number, role, store_name=None):
+    with app.app_context():
+        user = User(name=name, email=email, phone_number=phone_number, role=role)
+        user.hash_password("secret")
+        db.session.add(user)
+        db.session.flush()
+        if role == 'farmer':
+            profile = Farmer(user_id=user.id)
+        else:
+            profile = Grocer(user_id=user.id, store_name=store_name or f"{name}'s Store")
+        db.session.add(profile)
+        db.session.commit()
+        return user.id, profile.id
+
+def login_as(client, user_id):
+    """Sets the JWT cookie on the client and returns the CSRF header needed for writes"""
+    with app.app_context():
+        access_token = create_access_token(identity=user_id)
+        csrf_token = get_csrf_token(access_token)
+    client.set_cookie('access_token_cookie', access_token)
+    return {'X-CSRF-TOKEN': csrf_token}
+
+def add_products(farmer_id, count, quantity=50, price=10):
+    with app.app_context():
+        db.session.add_all([
+            Product(farmer_id=farmer_id, name=f"Product {i}", description="Fresh",
+                    quantity_available=quantity, price_per_unit=price + i)
+            for i in range(count)
+        ])
+        db.session.commit()
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        with app.app_context():
+            self.engine = db.engine
+        event.listen(self.engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self)
+
+def test_catalog_query_count_is_constant(client):
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    login_as(client, farmerUserId)
+
+    add_products(farmerId, 3)
+    with QueryCounter() as small:
+        client.get('/products')
+
+    add_products(farmerId, 30)
+    with QueryCounter() as large:
+        response = client.get('/products')
+
+    assert len(response.json) == 33
+    assert response.json[0]["farmer"] == "Farmer Ann"
+    assert small.count == large.count == 1
+
+def test_catalog_keyset_pages(client):
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    login_as(client, farmerUserId)
+    add_products(farmerId, 25)
+
+    seen = []
+    after = None
+    while True:
+        query = {'limit': 10}
+        if after is not None:
+            query['after'] = after
+        response = client.get('/products', query_string=query)
+        seen.extend(product["id"] for product in response.json)
+        after = response.headers.get('X-Next-After')
+        if after is None:
+            break
+
+    assert seen == sorted(seen)
+    assert len(set(seen)) == 25
+
+def test_catalog_filters(client):
+    annUserId, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    _, bobId = make_user("Farmer Bob", "bob@example.com", "0700000002", "farmer")
+    login_as(client, annUserId)
+    add_products(annId, 5, quantity=5, price=10)
+    add_products(bobId, 5, quantity=100, price=10)
+
+    response = client.get('/products', query_string={'farmer_id': bobId})
+    assert {product["farmer"] for product in response.json} == {"Farmer Bob"}
+
+    response = client.get('/products', query_string={'min_price': 11, 'max_price': 12})
+    assert {product["price"] for product in response.json} == {11, 12}
+
+    response = client.get('/products', query_string={'min_quantity': 50})
+    assert len(response.json) == 5
+
+def add_order(grocer_id, items, order_date=None):
+    """items are (product_id, quantity) pairs"""
+    with app.app_context():
+        products = {product.id: product for product in Product.query.filter(Product.id.in_([pid for pid, _ in items]))}
+        orderItems = [
+            OrderItem(product_id=pid, quantity_ordered=quantity, price_per_unit=products[pid].price_per_unit,
+                      total_price=products[pid].price_per_unit * quantity)
+            for pid, quantity in items
+        ]
+        order = Order(grocer_id=grocer_id, total_amount=sum(item.total_price for item in orderItems),
+                      order_date=order_date, items=orderItems)
+        db.session.add(order)
+        db.session.commit()
+        return order.id
+
+def test_farmer_order_history(client):
+    from datetime import datetime
+    annUserId, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    _, bobId = make_user("Farmer Bob", "bob@example.com", "0700000002", "farmer")
+    _, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(annId, 2, price=10)
+    add_products(bobId, 1, price=100)
+    add_order(grocerId, [(1, 2), (2, 1), (3, 5)], order_date=datetime(2024, 1, 5))
+    add_order(grocerId, [(3, 1)], order_date=datetime(2024, 1, 6))
+    login_as(client, annUserId)
+
+    response = client.get('/orders')
+    assert response.status_code == 200
+    assert len(response.json) == 1
+    order = response.json[0]
+    assert order["grocer_name"] == "Grocer Joe"
+    assert order["total_amount"] == 2 * 10 + 11
+    assert order["products"] == [
+        {"product_name": "Product 0", "quantity_ordered": 2, "price_per_unit": 10},
+        {"product_name": "Product 1", "quantity_ordered": 1, "price_per_unit": 11}
+    ]
+    assert set(order) == {"order_id", "grocer_name", "products", "total_amount", "order_date"}
+
+def test_grocer_order_history_pages_and_dates(client):
+    from datetime import datetime
+    _, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(annId, 3)
+    for day in range(1, 11):
+        add_order(grocerId, [(1, 1), (2, day)], order_date=datetime(2024, 1, day))
+    login_as(client, grocerUserId)
+
+    response = client.get('/orders', query_string={'limit': 4})
+    assert [order["order_id"] for order in response.json] == [1, 2, 3, 4]
+    assert response.headers['X-Next-After'] == '4'
+    assert response.json[1]["products"][1] == {
+        "product_name": "Product 1", "farmer_name": "Farmer Ann",
+        "quantity_ordered": 2, "price_per_unit": 11, "total_price": 22
+    }
+
+    response = client.get('/orders', query_string={'since': '2024-01-03', 'until': '2024-01-05'})
+    assert [order["order_id"] for order in response.json] == [3, 4]
+    assert 'X-Next-After' not in response.headers
+
+    response = client.get('/orders', query_string={'since': 'yesterday'})
+    assert response.status_code == 400
+
+def test_order_history_query_count_is_constant(client):
+    annUserId, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(annId, 3)
+
+    counts = []
+    for orders in (2, 20):
+        for _ in range(orders):
+            add_order(grocerId, [(1, 1), (2, 1), (3, 1)])
+        for userId in (annUserId, grocerUserId):
+            login_as(client, userId)
+            client.get('/orders')
+            with QueryCounter() as counter:
+                client.get('/orders')
+            counts.append(counter.count)
+
+    assert counts[:2] == counts[2:]
+
+def test_order_rejected_as_a_whole(client):
+    _, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, _ = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(annId, 2, quantity=5)
+    headers = login_as(client, grocerUserId)
+
+    response = client.post('/orders', headers=headers, json={
+        "order_items": [{"product_id": 1, "quantity": 3}, {"product_id": 2, "quantity": 6}]
+    })
+    assert response.status_code == 400
+    assert b"there's only 5" in response.data
+
+    response = client.post('/orders', headers=headers, json={
+        "order_items": [{"product_id": 1, "quantity": 3}, {"product_id": 1, "quantity": 3}]
+    })
+    assert response.status_code == 400
+    for items in ([{"product_id": 1, "quantity": True}], [{"product_id": True, "quantity": 1}], ["kale"]):
+        response = client.post('/orders', headers=headers, json={"order_items": items})
+        assert (response.status_code, response.json["error"]) == \
+            (400, "each item needs a product_id and a positive whole quantity")
+
+    with app.app_context():
+        assert [product.quantity_available for product in Product.query.order_by(Product.id)] == [5, 5]
+        assert Order.query.count() == 0
+
+    response = client.post('/orders', headers=headers, json={
+        "order_items": [{"product_id": 1, "quantity": 3}, {"product_id": 2, "quantity": 5}]
+    })
+    assert response.status_code == 201
+    with app.app_context():
+        assert [product.quantity_available for product in Product.query.order_by(Product.id)] == [2, 0]
+        assert Order.query.one().total_amount == 3 * 10 + 5 * 11
+
+def test_concurrent_orders_never_oversell(client, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    # every order comes from one grocer at once, which admission control would otherwise turn away
+    monkeypatch.setitem(app.config, 'ORDER_RATE_LIMIT', '1000/minute')
+    monkeypatch.setattr(concurrency_caps, '_slots', {})
+    _, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, _ = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(annId, 1, quantity=100)
+
+    def placeOrder(_):
+        grocerClient = app.test_client()
+        headers = login_as(grocerClient, grocerUserId)
+        return grocerClient.post('/orders', headers=headers, json={
+            "order_items": [{"product_id": 1, "quantity": 1}]
+        }).status_code
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        statuses = list(pool.map(placeOrder, range(300)))
+
+    assert statuses.count(201) == 100
+    assert statuses.count(400) == 200
+    with app.app_context():
+        assert Product.query.one().quantity_available == 0
+        assert db.session.query(db.func.sum(OrderItem.quantity_ordered)).scalar() == 100
+
+def test_catalog_cache_hits_and_etag(client, monkeypatch):
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    login_as(client, farmerUserId)
+    add_products(farmerId, 3)
+    # signed in isn't enough for cache internals
+    assert client.get('/internal/catalog-cache').status_code == 404
+    monkeypatch.setitem(app.config, 'INTERNAL_TOKEN', 'ops-secret')
+    internal = {'X-Internal-Token': 'ops-secret'}
+    before = client.get('/internal/catalog-cache', headers=internal).json
+
+    first = client.get('/products')
+    with QueryCounter() as counter:
+        second = client.get('/products')
+    assert counter.count == 0
+    assert second.data == first.data
+    assert second.headers['ETag'] == first.headers['ETag']
+
+    notModified = client.get('/products', headers={'If-None-Match': first.headers['ETag']})
+    assert notModified.status_code == 304
+    assert notModified.data == b""
+
+    stats = client.get('/internal/catalog-cache', headers=internal).json
+    assert stats["hits"] - before["hits"] == 2
+    assert stats["misses"] - before["misses"] == 1
+
+def test_catalog_cache_invalidated_by_writes(client):
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, _ = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(farmerId, 1, quantity=10)
+
+    farmerHeaders = login_as(client, farmerUserId)
+    etag = client.get('/products').headers['ETag']
+    client.post('/products', headers=farmerHeaders, json={
+        "name": "Kale", "description": "Greens", "quantity_available": 4, "price_per_unit": 3
+    })
+    response = client.get('/products', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert len(response.json) == 2
+
+    etag = response.headers['ETag']
+    grocerHeaders = login_as(client, grocerUserId)
+    client.post('/orders', headers=grocerHeaders, json={"order_items": [{"product_id": 1, "quantity": 4}]})
+    response = client.get('/products', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json[0]["quantity"] == 6
+
+def read_ndjson(response):
+    import json
+    assert response.mimetype == 'application/x-ndjson'
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+def test_ndjson_matches_json_arrays(client):
+    from datetime import datetime
+    annUserId, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    _, bobId = make_user("Farmer Bob", "bob@example.com", "0700000002", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(annId, 3)
+    add_products(bobId, 2)
+    for day in range(1, 6):
+        add_order(grocerId, [(1, day), (4, 1), (2, 2)], order_date=datetime(2024, 1, day))
+    add_order(grocerId, [(5, 1)], order_date=datetime(2024, 1, 7))
+    with app.app_context():
+        db.session.add(Order(grocer_id=grocerId, total_amount=0, order_date=datetime(2024, 1, 8)))
+        db.session.commit()
+
+    login_as(client, annUserId)
+    response = client.get('/products', query_string={'format': 'ndjson', 'min_price': 11})
+    assert response.is_streamed
+    assert read_ndjson(response) == client.get('/products', query_string={'min_price': 11}).json
+
+    for userId in (annUserId, grocerUserId):
+        login_as(client, userId)
+        query = {'since': '2024-01-02', 'after': 2}
+        streamed = read_ndjson(client.get('/orders', query_string={**query, 'format': 'ndjson'}))
+        assert streamed == client.get('/orders', query_string=query).json
+        assert streamed
+
+def test_seed_marketplace_is_deterministic(client):
+    from app.seed import seed_marketplace, marketplace_size
+    snapshots = []
+    for _ in range(2):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            size = seed_marketplace(1000, seed=7)
+            assert size == marketplace_size(1000)
+            assert OrderItem.query.count() == 1000
+            assert Order.query.count() == size["orders"]
+            assert db.session.query(db.func.sum(Order.total_amount)).scalar() == \
+                db.session.query(db.func.sum(OrderItem.total_price)).scalar()
+            snapshots.append([(item.product_id, item.quantity_ordered) for item in OrderItem.query.order_by(OrderItem.id)])
+
+    assert snapshots[0] == snapshots[1]
+
+def test_benchmark_compare_flags_regressions():
+    from benchmarks.harness import compare
+    stats = {"p95_ms": 10.0, "statements_per_request": 2.0, "errors": 0}
+    baseline = {"scenarios": {"GET /products": stats, "POST /login": stats}}
+    results = {"scenarios": {"GET /products": {**stats, "p95_ms": 11.0, "statements_per_request": 3.0}}}
+
+    regressions = compare(results, baseline, tolerance=0.25)
+    assert regressions == ["GET /products: statements per request 2.0 -> 3.0", "POST /login: missing from this run"]
+
+def test_instrumentation_server_timing_and_metrics(client, monkeypatch, caplog):
+    from app.instrumentation import instrumentation
+    monkeypatch.setitem(app.config, 'INSTRUMENTATION_ENABLED', True)
+    monkeypatch.setitem(app.config, 'SLOW_QUERY_MS', 0)
+    instrumentation.reset()
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    add_products(farmerId, 2)
+
+    response = client.post('/login', json={"identifier": "ann@example.com", "password": "secret"})
+    timing = response.headers['Server-Timing']
+    assert 'db;dur=' in timing and 'hash;dur=' in timing and 'json;dur=' in timing and 'total;dur=' in timing
+
+    login_as(client, farmerUserId)
+    with caplog.at_level('WARNING', logger='evergreen.slow'):
+        response = client.get('/products', query_string={'after': 0})
+    assert '"1 queries"' in response.headers['Server-Timing']
+    assert 'jwt;dur=' in response.headers['Server-Timing']
+    assert any('slow query' in record.message and 'FROM products' in record.message for record in caplog.records)
+
+    assert client.get('/internal/metrics').status_code == 404
+    monkeypatch.setitem(app.config, 'INTERNAL_TOKEN', 'ops-secret')
+    assert client.get('/internal/metrics').status_code == 403
+    assert client.get('/internal/metrics', headers={'X-Internal-Token': 'wrong'}).status_code == 403
+    routes = client.get('/internal/metrics', headers={'X-Internal-Token': 'ops-secret'}).json["routes"]
+    assert routes["GET /products"]["count"] == 1
+    assert routes["GET /products"]["mean_statements"] == 1
+    assert routes["POST /login"]["count"] == 1
+
+    monkeypatch.setitem(app.config, 'INSTRUMENTATION_ENABLED', False)
+    assert 'Server-Timing' not in client.get('/products').headers
+
+def test_login_upgrades_outdated_hash(client):
+    from werkzeug.security import generate_password_hash
+    from app.hashing import password_hasher
+    userId, _ = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    with app.app_context():
+        user = db.session.get(User, userId)
+        user.password_hash = generate_password_hash("secret", method="pbkdf2:sha256:1000")
+        db.session.commit()
+
+    response = client.post('/login', json={"identifier": "ann@example.com", "password": "secret"})
+    assert response.status_code == 200
+    with app.app_context():
+        storedHash = db.session.get(User, userId).password_hash
+    assert storedHash.startswith(password_hasher.method + "$")
+    assert client.post('/login', json={"identifier": "ann@example.com", "password": "secret"}).status_code == 200
+
+def test_hashing_admission_control(client, monkeypatch):
+    from app.hashing import password_hasher
+    make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    monkeypatch.setitem(app.config, 'HASH_POOL_MAX_PENDING', 1)
+    monkeypatch.setitem(app.config, 'HASH_ADMISSION_TIMEOUT', 0)
+    password_hasher.init_app(app)
+    try:
+        # hold the only slot, as a login stuck in the KDF would
+        password_hasher._admission.acquire()
+        response = client.post('/login', json={"identifier": "ann@example.com", "password": "secret"})
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+
+        password_hasher._admission.release()
+        response = client.post('/login', json={"identifier": "ann@example.com", "password": "secret"})
+        assert response.status_code == 200
+    finally:
+        monkeypatch.undo()
+        password_hasher.init_app(app)
+
+def test_short_hash_method_does_not_rehash_every_login(client, monkeypatch):
+    from werkzeug.security import generate_password_hash
+    from app.hashing import password_hasher, stored_method
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', 'scrypt')
+    password_hasher.init_app(app)
+    try:
+        assert password_hasher.stored_method == 'scrypt:32768:8:1'
+        for method in ('scrypt:16384:8:1', 'pbkdf2', 'pbkdf2:sha512', 'pbkdf2:sha256:1000'):
+            assert stored_method(method) == generate_password_hash("secret", method).split('$', 1)[0]
+        userId, _ = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+        with app.app_context():
+            storedHash = db.session.get(User, userId).password_hash
+        assert not password_hasher.needs_rehash(storedHash)
+        assert client.post('/login', json={"identifier": "ann@example.com", "password": "secret"}).status_code == 200
+        with app.app_context():
+            assert db.session.get(User, userId).password_hash == storedHash
+    finally:
+        monkeypatch.undo()
+        password_hasher.init_app(app)
+
+def test_hashing_rebuilds_a_broken_pool(client, monkeypatch):
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+    from app.hashing import password_hasher
+
+    class Pool:
+        def __init__(self, broken):
+            self.broken = broken
+        def submit(self, fn, *args):
+            future = Future()
+            if self.broken:
+                future.set_exception(BrokenProcessPool("a worker died"))
+            else:
+                future.set_result(fn(*args))
+            return future
+
+    pools = []
+    brokenForever = False
+    def executor():
+        pools.append(Pool(broken=len(pools) == 0 or brokenForever))
+        password_hasher._pool = pools[-1]
+        return pools[-1]
+
+    monkeypatch.setattr(password_hasher, 'workers', 1)
+    monkeypatch.setattr(password_hasher, '_executor', executor)
+    assert password_hasher.verify(password_hasher.hash("secret"), "secret")
+    assert len(pools) == 3
+
+    brokenForever = True
+    with pytest.raises(BrokenProcessPool):
+        password_hasher.hash("secret")
+    assert password_hasher._pool is None
+    monkeypatch.undo()
+    password_hasher._pool = None
+
+def test_logout_revokes_token(client):
+    from app.models import LoginSession
+    make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    response = client.post('/login', json={"identifier": "ann@example.com", "password": "secret"})
+    access_token = response.json["access_token"]
+    with app.app_context():
+        csrf_token = get_csrf_token(access_token)
+    client.set_cookie('access_token_cookie', access_token)
+
+    assert client.get('/products').status_code == 200
+    response = client.post('/logout', headers={'X-CSRF-TOKEN': csrf_token})
+    assert response.status_code == 200
+    assert b"Logout successful" in response.data
+
+    with QueryCounter() as counter:
+        response = client.get('/products')
+    assert response.status_code == 401
+    assert counter.count == 0
+    with app.app_context():
+        assert LoginSession.query.one().logout_time is not None
+
+def test_revocation_store_overflow_uses_bloom_filter(client, monkeypatch):
+    import time
+    monkeypatch.setitem(app.config, 'REVOCATION_CACHE_SIZE', 10)
+    monkeypatch.setitem(app.config, 'REVOCATION_BLOOM_CAPACITY', 1000)
+    revocation_store.configure(app.config)
+    try:
+        expires = time.time() + 3600
+        with app.app_context():
+            for i in range(50):
+                revocation_store.revoke(f"revoked-{i}", expires + i)
+            db.session.commit()
+
+            with QueryCounter() as counter:
+                assert all(revocation_store.is_revoked(f"revoked-{i}") for i in range(50))
+                assert not any(revocation_store.is_revoked(f"valid-{i}") for i in range(200))
+            # only the evicted revocations and rare Bloom false positives reach the table
+            assert 40 <= counter.count < 50
+
+            revocation_store.revoke("expired", time.time() - 1)
+            db.session.commit()
+            revocation_store.purge()
+            assert revocation_store.is_revoked("revoked-0")
+            assert not revocation_store.is_revoked("expired")
+    finally:
+        monkeypatch.undo()
+        revocation_store.configure(app.config)
+
+def test_revocation_sync_catches_revocations_committed_out_of_order(client):
+    import time
+    from datetime import datetime, timedelta
+    from app.models import RevokedToken
+    expires = int(time.time()) + 3600
+    stamped = datetime(2026, 1, 1, 12, 0, 0)
+    with app.app_context():
+        revocation_store.reset()
+        db.session.add(RevokedToken(id=2, jti="committed-first", expires_at=expires, revoked_at=stamped))
+        db.session.commit()
+        revocation_store.sync()
+        # another worker's revocation got the lower id and an earlier stamp but committed after that sync
+        db.session.add(RevokedToken(id=1, jti="committed-late", expires_at=expires,
+                                    revoked_at=stamped - timedelta(seconds=5)))
+        db.session.commit()
+        revocation_store.sync()
+        revocation_store.sync()
+        with QueryCounter() as counter:
+            assert revocation_store.is_revoked("committed-late")
+            assert revocation_store.is_revoked("committed-first")
+        assert counter.count == 0
+        # rereading the overlap doesn't queue anything twice
+        assert len(revocation_store._expiry) == 2
+
+def test_login_claims_skip_identity_lookups(client):
+    make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    access_token = client.post('/login', json={"identifier": "ann@example.com", "password": "secret"}).json["access_token"]
+    with app.app_context():
+        csrf_token = get_csrf_token(access_token)
+    client.set_cookie('access_token_cookie', access_token)
+
+    # with no orders the history stops after its first statement
+    with QueryCounter() as counter:
+        response = client.get('/orders')
+    assert response.status_code == 200
+    assert counter.count == 1
+
+    with QueryCounter() as counter:
+        response = client.post('/products', headers={'X-CSRF-TOKEN': csrf_token}, json={
+            "name": "Kale", "description": "Greens", "quantity_available": 4, "price_per_unit": 3
+        })
+    assert response.status_code == 201
+    # the insert, then at commit the catalog version counter and stamping it on the row
+    assert counter.count == 3
+
+def test_identity_cache_invalidated_on_profile_change(client):
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    access_token = client.post('/login', json={"identifier": "ann@example.com", "password": "secret"}).json["access_token"]
+    with app.app_context():
+        csrf_token = get_csrf_token(access_token)
+    client.set_cookie('access_token_cookie', access_token)
+    product = {"name": "Kale", "description": "Greens", "quantity_available": 4, "price_per_unit": 3}
+
+    with app.app_context():
+        db.session.delete(db.session.get(Farmer, farmerId))
+        db.session.commit()
+
+    response = client.post('/products', headers={'X-CSRF-TOKEN': csrf_token}, json=product)
+    assert response.status_code == 403
+
+    # claimless tokens resolve through the cache after one lookup
+    headers = login_as(client, farmerUserId)
+    with app.app_context():
+        db.session.add(Farmer(user_id=farmerUserId))
+        db.session.commit()
+    assert client.post('/products', headers=headers, json=product).status_code == 201
+    with QueryCounter() as counter:
+        assert client.post('/products', headers=headers, json=product).status_code == 201
+    assert counter.count == 3
+
+def query_plan(query):
+    from sqlalchemy.dialects import sqlite
+    sql = str(query.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}))
+    return [row[3] for row in db.session.execute(db.text("EXPLAIN QUERY PLAN " + sql))]
+
+def test_hot_queries_use_indexes(client):
+    from app.seed import seed_marketplace
+    from app.catalog import catalog_query
+    from app.history import farmer_orders_query, farmer_items_query, grocer_orders_query, grocer_items_query
+    from app.models import LoginSession
+    with app.app_context():
+        seed_marketplace(1000)
+        queries = [
+            catalog_query(farmer_id=3, after=10).limit(101),
+            farmer_orders_query(3, after=5).limit(101),
+            farmer_items_query(3, [1, 2, 3]),
+            grocer_orders_query(3, after=5).limit(101),
+            grocer_items_query([1, 2, 3]),
+            db.select(LoginSession.id).where(LoginSession.session_token == 'abc'),
+            db.select(LoginSession.id).where(LoginSession.user_id == 3)
+        ]
+        for query in queries:
+            plan = query_plan(query)
+            assert not [step for step in plan if step.startswith('SCAN')], plan
+
+        assert any('COVERING INDEX ix_orderItems_product_id_order_id_total_price' in step
+                   for step in query_plan(farmer_orders_query(3)))
+
+def test_index_migration_round_trip(client):
+    from flask_migrate import upgrade, downgrade, stamp
+    directory = os.path.join(app.root_path, 'migrations')
+    init_migrations(app)
+    with app.app_context():
+        # create_all() builds the indexes, so a fresh database is already at head
+        stamp(directory=directory)
+        downgrade(directory=directory, revision='base')
+        assert 'ix_orders_grocer_id_id' not in {index['name'] for index in db.inspect(db.engine).get_indexes('orders')}
+        upgrade(directory=directory)
+        assert 'ix_orders_grocer_id_id' in {index['name'] for index in db.inspect(db.engine).get_indexes('orders')}
+        assert 'ix_loginSession_session_token' in {index['name'] for index in db.inspect(db.engine).get_indexes('loginSession')}
+        db.session.execute(db.text("DROP TABLE alembic_version"))
+        db.session.commit()
+
+def test_create_app_leaves_schema_to_the_cli(client):
+    with app.app_context():
+        db.drop_all()
+    fresh = create_app('development')
+    with fresh.test_client() as freshClient:
+        freshClient.get('/')
+    with app.app_context():
+        assert 'users' not in db.inspect(db.engine).get_table_names()
+
+    result = app.test_cli_runner().invoke(args=['create-db'])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        assert {'users', 'products', 'orders', 'orderItems'} <= set(db.inspect(db.engine).get_table_names())
+
+def test_bulk_import_csv_and_ndjson(client):
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    headers = login_as(client, farmerUserId)
+    app.config['PRODUCT_IMPORT_CHUNK_SIZE'] = 2
+    etag = client.get('/products').headers['ETag']
+
+    csvBody = ("name,description,quantity_available,price_per_unit\n"
+               "Kale,Greens,10,3\n"
+               "\"Onions, red\",,5,7\n"
+               ",no name,1,1\n"
+               "Maize,Dry,many,2\n"
+               "Beans,,0,4\n")
+    with QueryCounter() as counter:
+        response = client.post('/products/import', headers=headers, data=csvBody, content_type='text/csv')
+    assert response.status_code == 201
+    assert response.json["imported"] == 3
+    assert [error["row"] for error in response.json["errors"]] == [3, 4]
+    # the identity lookup, two bulk inserts of at most two rows each, then the catalog version and its stamp
+    assert counter.count == 5
+
+    ndjsonBody = ('{"name": "Spinach", "quantity_available": 2, "price_per_unit": 5}\n\nnot json\n[1]\n'
+                  '{"name": 5, "quantity_available": 2, "price_per_unit": 5}\n'
+                  '{"name": "Okra", "quantity_available": "\u00b2", "price_per_unit": 5}\n')
+    response = client.post('/products/import', headers=headers, data=ndjsonBody, content_type='application/x-ndjson')
+    assert response.status_code == 201
+    assert response.json["imported"] == 1
+    assert response.json["errors"] == [{"row": 3, "error": "not valid JSON"},
+                                       {"row": 4, "error": "each line must be a JSON object"},
+                                       {"row": 5, "error": "name must be text"},
+                                       {"row": 6, "error": "quantity_available must be a whole number of at least 0"}]
+
+    response = client.get('/products', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert [product["name"] for product in response.json] == ["Kale", "Onions, red", "Beans", "Spinach"]
+
+    response = client.post('/products/import', headers=headers, query_string={'on_error': 'abort'},
+                           data=ndjsonBody, content_type='application/x-ndjson')
+    assert response.status_code == 400
+    assert response.json["imported"] == 0
+    with app.app_context():
+        assert Product.query.count() == 4
+
+    assert client.post('/products/import', headers=headers, data='[]', content_type='application/json').status_code == 415
+    grocerUserId, _ = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    grocerHeaders = login_as(client, grocerUserId)
+    assert client.post('/products/import', headers=grocerHeaders, data=csvBody, content_type='text/csv').status_code == 403
+
+def test_bulk_import_reports_bounded_errors(client):
+    from app.importer import import_products, ndjson_records
+    import io
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    lines = b"".join(b'{"name": "Kale", "quantity_available": 1, "price_per_unit": %d}\n' % (i % 3)
+                     for i in range(3000))
+    with app.app_context():
+        report = import_products(farmerId, ndjson_records(io.BytesIO(lines)), chunk_size=500, max_errors=10)
+        db.session.commit()
+        assert report["imported"] == 2000
+        assert report["rejected"] == 1000
+        assert len(report["errors"]) == 10 and report["errors_truncated"]
+        assert Product.query.count() == 2000
+
+def test_async_order_intake(client):
+    from app.intake import order_intake
+    from app.models import OrderTicket
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer", "Joe's")
+    otherUserId, _ = make_user("Grocer Sue", "sue@example.com", "0700000004", "grocer", "Sue's")
+    add_products(farmerId, 2, quantity=5)
+    headers = login_as(client, grocerUserId)
+    app.config['ORDER_INTAKE_ASYNC'] = True
+    order_intake.batch_size = 2
+    try:
+        tickets = []
+        for items in ([{"product_id": 1, "quantity": 3}],
+                      [{"product_id": 1, "quantity": 3}, {"product_id": 2, "quantity": 1}],
+                      [{"product_id": 2, "quantity": 4}]):
+            response = client.post('/orders', headers=headers, json={"order_items": items})
+            assert response.status_code == 202
+            assert response.headers['Location'] == f"/orders/tickets/{response.json['ticket']}"
+            tickets.append(response.json["ticket"])
+        assert client.post('/orders', headers=headers, json={"order_items": [{"product_id": 1}]}).status_code == 400
+        assert client.get(f'/orders/tickets/{tickets[0]}').json["status"] == "queued"
+
+        with app.app_context():
+            assert order_intake.drain() == 2
+            assert order_intake.drain() == 1
+            assert order_intake.drain() == 0
+            assert Order.query.count() == 2
+            assert [product.quantity_available for product in Product.query.order_by(Product.id)] == [2, 1]
+            assert OrderTicket.query.filter_by(status='queued').count() == 0
+
+        placed, shorted, last = [client.get(f'/orders/tickets/{ticket}').json for ticket in tickets]
+        assert placed["status"] == "placed" and placed["order_id"] == 1
+        assert shorted["status"] == "rejected" and shorted["order_id"] is None and "only 2" in shorted["error"]
+        assert last["status"] == "placed" and last["order_id"] == 2
+
+        login_as(client, otherUserId)
+        assert client.get(f'/orders/tickets/{tickets[0]}').status_code == 404
+    finally:
+        app.config['ORDER_INTAKE_ASYNC'] = False
+        order_intake.batch_size = app.config['ORDER_INTAKE_BATCH_SIZE']
+
+def test_order_intake_rejects_a_poison_ticket_alone(client, caplog):
+    from app.intake import order_intake
+    from app.models import OrderTicket
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    _, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer", "Joe's")
+    add_products(farmerId, 1, quantity=5)
+    with app.app_context():
+        db.session.add_all([
+            OrderTicket(ticket="good-1", grocer_id=grocerId, lines='[[1, 1]]'),
+            OrderTicket(ticket="poison", grocer_id=grocerId, lines='"not a list of lines"'),
+            OrderTicket(ticket="good-2", grocer_id=grocerId, lines='[[1, 2]]'),
+        ])
+        db.session.commit()
+
+        # the batch fails as a whole, then every ticket is settled on its own
+        assert order_intake.drain() == 3
+        assert order_intake.drain() == 0
+        statuses = {row.ticket: (row.status, row.error) for row in OrderTicket.query}
+        assert statuses["good-1"] == ("placed", None) and statuses["good-2"] == ("placed", None)
+        assert statuses["poison"][0] == "rejected" and "could not be placed" in statuses["poison"][1]
+        assert db.session.get(Product, 1).quantity_available == 2
+    assert "order ticket 2 rejected" in caplog.text
+
+def test_sales_rollup_follows_orders_and_rebuilds(client):
+    from datetime import date, datetime, timezone
+    from app.analytics import rebuild_sales
+    from app.intake import order_intake
+    from app.models import ProductDailySales
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    otherUserId, otherId = make_user("Farmer Bob", "bob@example.com", "0700000002", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(farmerId, 2, quantity=20)
+    add_products(otherId, 1, quantity=20)
+    # history from before the rollup existed, only picked up by a rebuild
+    add_order(grocerId, [(1, 2), (2, 1)], order_date=datetime(2024, 1, 1, 9))
+    add_order(grocerId, [(1, 1), (3, 4)], order_date=datetime(2024, 1, 3, 18))
+
+    grocerHeaders = login_as(client, grocerUserId)
+    assert client.post('/orders', headers=grocerHeaders, json={
+        "order_items": [{"product_id": 1, "quantity": 3}, {"product_id": 3, "quantity": 1}]
+    }).status_code == 201
+    assert client.post('/orders', headers=grocerHeaders, json={
+        "order_items": [{"product_id": 2, "quantity": 1}, {"product_id": 3, "quantity": 99}]
+    }).status_code == 400
+    app.config['ORDER_INTAKE_ASYNC'] = True
+    try:
+        client.post('/orders', headers=grocerHeaders, json={"order_items": [{"product_id": 2, "quantity": 2}]})
+        with app.app_context():
+            order_intake.drain()
+    finally:
+        app.config['ORDER_INTAKE_ASYNC'] = False
+
+    today = datetime.now(timezone.utc).date()
+    with app.app_context():
+        assert {(row.farmer_id, row.product_id, row.day, row.units_sold, row.revenue)
+                for row in ProductDailySales.query} == {(farmerId, 1, today, 3, 30), (farmerId, 2, today, 2, 22),
+                                                        (otherId, 3, today, 1, 10)}
+
+        rebuild_sales(since=date(2024, 1, 2))
+        db.session.commit()
+        assert ProductDailySales.query.filter(ProductDailySales.day < date(2024, 1, 2)).count() == 0
+        assert rebuild_sales() == 7
+        db.session.commit()
+
+    login_as(client, farmerUserId)
+    sales = client.get('/analytics/sales').json
+    assert (sales["units_sold"], sales["revenue"]) == (9, 93)
+    assert sales["products"] == [{"product_id": 1, "name": "Product 0", "units_sold": 6, "revenue": 60},
+                                 {"product_id": 2, "name": "Product 1", "units_sold": 3, "revenue": 33}]
+
+    sales = client.get('/analytics/sales', query_string={'since': '2024-01-01', 'until': '2024-01-04'}).json
+    assert sales["days"] == [{"day": "2024-01-01", "units_sold": 3, "revenue": 31},
+                             {"day": "2024-01-03", "units_sold": 1, "revenue": 10}]
+    sales = client.get('/analytics/sales', query_string={'product_id': 2, 'until': '2024-01-02'}).json
+    assert (sales["units_sold"], sales["revenue"]) == (1, 11)
+    assert client.get('/analytics/sales', query_string={'since': 'soon'}).status_code == 400
+    login_as(client, grocerUserId)
+    assert client.get('/analytics/sales').status_code == 403
+
+def test_sqlite_pragmas_applied(client):
+    with app.app_context():
+        pragma = lambda name: db.session.execute(db.text(f"PRAGMA {name}")).scalar()
+        assert pragma('journal_mode') == 'wal'
+        assert pragma('synchronous') == 1
+        assert pragma('busy_timeout') == 5000
+        assert pragma('cache_size') == -20000
+
+def test_read_views_use_the_replica(client, monkeypatch):
+    import sqlite3
+    from app.config import DevelopmentConfig
+    replicaPath = tempfile.mkstemp(suffix='.db')[1]
+    monkeypatch.setattr(DevelopmentConfig, 'SQLALCHEMY_BINDS', {'replica': 'sqlite:///' + replicaPath})
+    routed = create_app('development')
+    try:
+
+        farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+        grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+        add_products(farmerId, 2)
+        add_order(grocerId, [(1, 1)])
+        # the replica is a snapshot that never catches up
+        with app.app_context():
+            primaryPath = db.engine.url.database
+        with sqlite3.connect(primaryPath) as primary, sqlite3.connect(replicaPath) as replica:
+            primary.backup(replica)
+        add_products(farmerId, 1)
+        add_order(grocerId, [(2, 1)])
+
+        routedClient = routed.test_client()
+        with routed.app_context():
+            access_token = create_access_token(identity=farmerUserId)
+            headers = {'X-CSRF-TOKEN': get_csrf_token(access_token)}
+        routedClient.set_cookie('access_token_cookie', access_token)
+
+        catalog_cache.clear()
+        assert len(routedClient.get('/products').json) == 2
+        assert len(read_ndjson(routedClient.get('/products', query_string={'format': 'ndjson'}))) == 2
+        assert len(routedClient.get('/orders').json) == 1
+
+        response = routedClient.post('/products', headers=headers, json={
+            "name": "Kale", "description": "Greens", "quantity_available": 4, "price_per_unit": 3
+        })
+        assert response.status_code == 201
+        with app.app_context():
+            assert Product.query.count() == 4
+        catalog_cache.clear()
+        assert len(routedClient.get('/products').json) == 2
+
+        login_as(client, farmerUserId)
+        catalog_cache.clear()
+        assert len(client.get('/products').json) == 4
+        assert len(client.get('/orders').json) == 2
+    finally:
+        # binds register their metadata on the shared db, which the other apps don't have
+        db.metadatas.pop('replica', None)
+
+def test_upserts_name_the_unsupported_database():
+    from types import SimpleNamespace
+    from app.database import upsert_insert
+    session = SimpleNamespace(get_bind=lambda: SimpleNamespace(dialect=SimpleNamespace(name='mysql')))
+    with pytest.raises(NotImplementedError, match="upserts need one of postgresql, sqlite, not mysql"):
+        upsert_insert(Product, session)
+
+def test_fast_json_provider_matches_default(client):
+    import uuid
+    from datetime import datetime, date, timezone, timedelta
+    from decimal import Decimal
+    from flask.json.provider import DefaultJSONProvider
+    from werkzeug.http import http_date as werkzeug_http_date
+    from app.serialization import FastJSONProvider, http_date
+
+    for value in (datetime(2024, 1, 5, 9, 30), datetime(1999, 12, 31, 23, 59, 59, 999999),
+                  datetime(2024, 2, 29, 6, tzinfo=timezone(timedelta(hours=3)))):
+        assert http_date(value) == werkzeug_http_date(value)
+
+    document = {"b": [1, 2.5, None, True], "a": {"z": datetime(2024, 1, 5, 9, 30), "d": date(2024, 2, 29)},
+                "u": uuid.UUID(int=5), "m": Decimal("1.5"), "t": (1, 2), "e": [], "ids": {3: "c", 1: "a"}}
+    for compact in (None, True, False):
+        fast, default = FastJSONProvider(app), DefaultJSONProvider(app)
+        fast.compact = default.compact = compact
+        assert fast.response(document).get_data() == default.response(document).get_data()
+    assert FastJSONProvider(app).loads('{"name": "Caf\\u00e9"}') == {"name": "Caf\u00e9"}
+
+def test_history_serializers_write_http_dates(client):
+    from datetime import datetime
+    annUserId, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(annId, 2)
+    add_order(grocerId, [(1, 1), (2, 3)], order_date=datetime(2024, 1, 5, 9, 30))
+
+    for userId in (annUserId, grocerUserId):
+        login_as(client, userId)
+        order = client.get('/orders').json[0]
+        assert order["order_date"] == "Fri, 05 Jan 2024 09:30:00 GMT"
+        assert [item["quantity_ordered"] for item in order["products"]] == [1, 3]
+        assert read_ndjson(client.get('/orders', query_string={'format': 'ndjson'})) == [order]
+
+def test_responses_compressed_when_accepted(client):
+    import gzip
+    import zlib
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    login_as(client, farmerUserId)
+    add_products(farmerId, 40)
+
+    plain = client.get('/products')
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.vary
+    assert len(plain.data) >= app.config['COMPRESS_MIN_SIZE']
+
+    zipped = client.get('/products', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert int(zipped.headers['Content-Length']) == len(zipped.data) < len(plain.data)
+    assert gzip.decompress(zipped.data) == plain.data
+    assert zipped.headers['ETag'] == 'W/' + plain.headers['ETag']
+
+    deflated = client.get('/products', headers={'Accept-Encoding': 'gzip;q=0.5, deflate'})
+    assert deflated.headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(deflated.data) == plain.data
+    assert 'Content-Encoding' not in client.get('/products', headers={'Accept-Encoding': 'br'}).headers
+
+    notModified = client.get('/products', headers={'Accept-Encoding': 'gzip', 'If-None-Match': zipped.headers['ETag']})
+    assert notModified.status_code == 304
+
+    small = client.get('/products', query_string={'limit': 1}, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+    streamed = client.get('/products', query_string={'format': 'ndjson'}, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in streamed.headers
+    assert len(read_ndjson(streamed)) == 40
+
+def test_catalog_changes_since_version(client):
+    from sqlalchemy import delete
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, _ = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(farmerId, 3)
+    login_as(client, farmerUserId)
+
+    everything = client.get('/products/changes').json
+    assert [product["id"] for product in everything["products"]] == [1, 2, 3]
+    assert everything["products"][0] == {"id": 1, "name": "Product 0", "description": "Fresh", "quantity": 50,
+                                         "price": 10, "farmer": "Farmer Ann", "version": 1}
+    assert everything["version"] == 1 and everything["deleted"] == [] and not everything["more"]
+
+    # a client in sync pays for one statement and gets nothing back
+    with QueryCounter() as counter:
+        inSync = client.get('/products/changes', query_string={'since': 1}).json
+    assert counter.count == 1
+    assert inSync == {"version": 1, "more": False, "products": [], "deleted": []}
+
+    grocerHeaders = login_as(client, grocerUserId)
+    client.post('/orders', headers=grocerHeaders, json={"order_items": [{"product_id": 2, "quantity": 5}]})
+    with app.app_context():
+        db.session.get(Product, 3).price_per_unit = 99
+        db.session.commit()
+        db.session.delete(db.session.get(Product, 1))
+        db.session.commit()
+        db.session.execute(delete(Product).where(Product.id == 3))
+        db.session.commit()
+
+    changes = client.get('/products/changes', query_string={'since': 1}).json
+    assert [(product["id"], product["quantity"], product["version"]) for product in changes["products"]] == [(2, 45, 2)]
+    assert changes["deleted"] == [1, 3]
+    assert changes["version"] == 5
+
+    assert client.get('/products/changes', query_string={'since': 'yesterday'}).status_code == 400
+
+def test_catalog_version_taken_only_at_commit(client):
+    from app.changes import current_version
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, _ = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(farmerId, 2, quantity=50)
+    grocerHeaders = login_as(client, grocerUserId)
+
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0:3])
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.post('/orders', headers=grocerHeaders, json={"order_items": [
+            {"product_id": 1, "quantity": 5}, {"product_id": 2, "quantity": 5}]})
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert response.status_code == 201
+
+    # the counter row is locked for the commit only, after the reservation and the order's rows
+    counter = next(i for i, words in enumerate(statements) if '"catalogVersion"' in words)
+    assert statements[counter + 1:] == [["UPDATE", "products", "SET"]]
+    assert any(words[:2] == ["INSERT", "INTO"] and words[2] == '"orderItems"' for words in statements[:counter])
+    with app.app_context():
+        assert [product.version for product in Product.query.order_by(Product.id)] == [2, 2]
+        assert current_version() == 2
+
+def test_catalog_changes_pages_end_on_whole_versions(client):
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    add_products(farmerId, 3)
+    add_products(farmerId, 1)
+    add_products(farmerId, 2)
+    login_as(client, farmerUserId)
+
+    pages = []
+    since = None
+    while True:
+        page = client.get('/products/changes', query_string={'since': since, 'limit': 2} if since else {'limit': 2}).json
+        pages.append([(product["id"], product["version"]) for product in page["products"]])
+        since = page["version"]
+        if not page["more"]:
+            break
+    assert pages == [[(1, 1), (2, 1), (3, 1)], [(4, 2)], [(5, 3), (6, 3)]]
+
+    with app.app_context():
+        from app.changes import changes_query
+        plan = query_plan(changes_query(since=3).limit(101))
+    assert not [step for step in plan if step.startswith('SCAN')], plan
+
+def read_event(frames):
+    import json
+    fields = dict(line.split(': ', 1) for line in next(frames).decode().strip().splitlines())
+    return int(fields["id"]), fields["event"], json.loads(fields["data"])
+
+def test_stock_stream_pushes_committed_changes(client, monkeypatch):
+    from app.hub import stock_hub
+    monkeypatch.setattr(stock_hub, 'heartbeat', 0.05)
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, _ = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(farmerId, 2, quantity=50, price=10)
+    grocerHeaders = login_as(client, grocerUserId)
+
+    response = client.get('/products/stream', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    frames = response.iter_encoded()
+    assert next(frames) == b"retry: 50\n\n"
+
+    client.post('/orders', headers=grocerHeaders, json={"order_items": [{"product_id": 1, "quantity": 5}]})
+    farmerHeaders = login_as(client, farmerUserId)
+    client.post('/products', headers=farmerHeaders, json={
+        "name": "Kale", "description": "Greens", "quantity_available": 4, "price_per_unit": 3
+    })
+    # both commits go out in one frame
+    with app.app_context():
+        assert stock_hub.dispatch() == 1
+    version, kind, data = read_event(frames)
+    assert (version, kind) == (3, "stock")
+    assert data["products"] == [{"id": 1, "name": "Product 0", "quantity": 45, "price": 10, "version": 2},
+                                {"id": 3, "name": "Kale", "quantity": 4, "price": 3, "version": 3}]
+    assert next(frames) == b": heartbeat\n\n"
+
+    # a reconnecting client catches up from its Last-Event-ID
+    again = client.get('/products/stream', headers={'Last-Event-ID': '2'}, buffered=False)
+    againFrames = again.iter_encoded()
+    next(againFrames)
+    assert read_event(againFrames)[0] == 3
+    assert stock_hub.stats()["subscribers"] == 2
+    again.close()
+    response.close()
+    assert stock_hub.stats()["subscribers"] == 0
+
+def test_stock_stream_drops_slow_subscribers(client, monkeypatch):
+    from app.hub import stock_hub
+    monkeypatch.setattr(stock_hub, 'heartbeat', 0.05)
+    monkeypatch.setattr(stock_hub, 'queue_size', 1)
+    farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    add_products(farmerId, 1)
+    login_as(client, farmerUserId)
+
+    slow = client.get('/products/stream', buffered=False)
+    frames = slow.iter_encoded()
+    next(frames)
+    before = stock_hub.stats()["dropped"]
+    for quantity in (40, 30):
+        with app.app_context():
+            db.session.get(Product, 1).quantity_available = quantity
+            db.session.commit()
+            stock_hub.dispatch()
+    assert stock_hub.stats()["dropped"] - before == 1
+    assert stock_hub.stats()["subscribers"] == 0
+    # the frame queued before it fell behind is still delivered, then the stream ends
+    assert read_event(frames)[2]["products"][0]["quantity"] == 40
+    assert list(frames) == []
+
+    monkeypatch.setattr(stock_hub, 'max_subscribers', 0)
+    response = client.get('/products/stream')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+
+def test_stock_stream_capped_by_the_worker_thread_budget(client, monkeypatch):
+    from app.config import Config
+    assert Config.ROUTE_CONCURRENCY["stream"] == Config.STOCK_STREAM_MAX_SUBSCRIBERS == Config.WORKER_THREADS // 2
+    monkeypatch.setitem(app.config, 'ROUTE_CONCURRENCY', {"stream": 1})
+    monkeypatch.setitem(app.config, 'ADMISSION_WAIT', 0)
+    concurrency_caps.init_app(app)
+    try:
+        farmerUserId, _ = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+        login_as(client, farmerUserId)
+        # an open stream holds its slot until the client goes away
+        first = client.get('/products/stream', buffered=False)
+        assert first.status_code == 200
+        busy = client.get('/products/stream')
+        assert busy.status_code == 503 and busy.headers['Retry-After'] == '1'
+        first.close()
+        again = client.get('/products/stream', buffered=False)
+        assert again.status_code == 200
+        again.close()
+        assert concurrency_caps.stats()["stream"] == {"cap": 1, "running": 0, "rejected": 1}
+    finally:
+        monkeypatch.undo()
+        concurrency_caps.init_app(app)
+
+def test_stock_stream_backlog_is_read_outside_the_dispatch_lock(client, monkeypatch):
+    from app.hub import stock_hub
+    monkeypatch.setattr(stock_hub, 'page_size', 1)
+    monkeypatch.setattr(stock_hub, 'poll_interval', 0)
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    add_products(farmerId, 4)
+    for productId in (2, 3, 4):
+        with app.app_context():
+            db.session.get(Product, productId).quantity_available = 20
+            db.session.commit()
+
+    with app.test_request_context():
+        with QueryCounter() as counter:
+            subscription, backlog = stock_hub.subscribe(0)
+        # only the current version is read while the dispatcher is held up
+        assert counter.count == 1 and subscription.version == 4
+        with app.app_context():
+            db.session.get(Product, 1).quantity_available = 10
+            db.session.commit()
+            assert stock_hub.dispatch() == 1
+    try:
+        # product 1 moved on to version 5 after subscribing, so it comes through the queue instead
+        assert [int(frame.split("\n", 1)[0][4:]) for frame in backlog] == [2, 3, 4]
+        assert subscription.frames.get_nowait()[0] == 5
+    finally:
+        stock_hub.unsubscribe(subscription)
+
+def add_offers(farmer_id, offers):
+    """offers are (name, quantity, price) triples"""
+    with app.app_context():
+        db.session.add_all([
+            Product(farmer_id=farmer_id, name=name, description="Fresh", quantity_available=quantity, price_per_unit=price)
+            for name, quantity, price in offers
+        ])
+        db.session.commit()
+
+def test_sourcing_splits_across_cheapest_farmers(client):
+    annUserId, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    _, bobId = make_user("Farmer Bob", "bob@example.com", "0700000002", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_offers(annId, [("Kale", 10, 3), ("Tomatoes", 0, 1)])
+    add_offers(bobId, [("kale ", 20, 2), ("Kale", 50, 5), ("Tomatoes", 30, 4)])
+    grocerHeaders = login_as(client, grocerUserId)
+
+    response = client.post('/sourcing', headers=grocerHeaders, json={"items": [
+        {"name": "KALE", "quantity": 25}, {"name": "Tomatoes", "quantity": 40}, {"name": "Okra", "quantity": 1}
+    ]})
+    assert response.status_code == 200
+    plan = response.json
+    kale, tomatoes, okra = plan["lines"]
+    assert [(item["product_id"], item["farmer"], item["quantity"]) for item in kale["sourced"]] == \
+        [(3, "Farmer Bob", 20), (1, "Farmer Ann", 5)]
+    assert (kale["total_price"], kale["missing"]) == (55, 0)
+    # the sold out offer is skipped and what stock there is gets taken
+    assert [(item["product_id"], item["quantity"]) for item in tomatoes["sourced"]] == [(5, 30)]
+    assert tomatoes["missing"] == 10 and okra == {"name": "Okra", "quantity": 1, "sourced": [], "total_price": 0,
+                                                 "missing": 1}
+    assert not plan["complete"] and plan["total_amount"] == 175
+
+    placed = client.post('/sourcing', headers=grocerHeaders, json={"items": [{"name": "kale", "quantity": 25}],
+                                                                   "place": True})
+    assert placed.status_code == 201
+    with app.app_context():
+        order = Order.query.filter_by(grocer_id=grocerId).one()
+        assert sorted((item.product_id, item.quantity_ordered) for item in order.items) == [(1, 5), (3, 20)]
+        assert order.total_amount == 55
+
+    # the committed order refreshed the index: Bob's cheap kale is gone
+    again = client.post('/sourcing', headers=grocerHeaders, json={"items": [{"name": "Kale", "quantity": 6}]}).json
+    assert [(item["product_id"], item["quantity"]) for item in again["lines"][0]["sourced"]] == [(1, 5), (4, 1)]
+
+    short = client.post('/sourcing', headers=grocerHeaders, json={"items": [{"name": "Okra", "quantity": 1}],
+                                                                  "place": True})
+    assert short.status_code == 409
+    assert client.post('/sourcing', headers=grocerHeaders, json={"items": [{"name": "Kale", "quantity": 0}]}).status_code == 400
+    assert client.post('/sourcing', headers=grocerHeaders, json={"items": [{"name": "Kale", "quantity": True}]}).status_code == 400
+    farmerHeaders = login_as(client, annUserId)
+    assert client.post('/sourcing', headers=farmerHeaders, json={"items": [{"name": "Kale", "quantity": 1}]}).status_code == 403
+
+def test_price_index_follows_catalog_changes(client, monkeypatch):
+    from sqlalchemy import update
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    add_offers(farmerId, [("Kale", 10, 3), ("Kale", 10, 4), ("Okra", 5, 2)])
+    monkeypatch.setattr(price_index, 'refresh_interval', 0)
+
+    with app.app_context():
+        assert [item["product_id"] for item in price_index.source([("kale", 15)])["lines"][0]["sourced"]] == [1, 2]
+        db.session.get(Product, 2).price_per_unit = 1
+        db.session.delete(db.session.get(Product, 3))
+        db.session.commit()
+        # another worker's write is only seen through the changes feed
+        db.session.execute(update(Product).where(Product.id == 1).values(name="Okra"))
+        db.session.commit()
+        with QueryCounter() as counter:
+            plan = price_index.source([("kale", 15), ("okra", 5)])
+        assert counter.count == 1
+        assert [[item["product_id"] for item in line["sourced"]] for line in plan["lines"]] == [[2], [1]]
+        assert price_index.stats() == {"products": 2, "names": 2, "version": 3}
+
+def test_price_index_load_is_all_or_nothing_and_unlocked(client, monkeypatch):
+    import app.sourcing as sourcing
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    add_offers(farmerId, [("Kale", 10, 3), ("Okra", 5, 2)])
+
+    streamRows = sourcing.stream_rows
+    def failingStreamRows(query):
+        rows = streamRows(query)
+        yield next(rows)
+        raise RuntimeError("connection lost")
+    monkeypatch.setattr(sourcing, 'stream_rows', failingStreamRows)
+    with app.app_context():
+        with pytest.raises(RuntimeError):
+            price_index.refresh()
+        # a half load is thrown away, so the next request loads everything again
+        assert price_index.stats() == {"products": 0, "names": 0, "version": None}
+
+        monkeypatch.setattr(sourcing, 'stream_rows', streamRows)
+        currentVersion = sourcing.current_version
+        def unlockedCurrentVersion():
+            assert not price_index._lock.locked()
+            return currentVersion()
+        monkeypatch.setattr(sourcing, 'current_version', unlockedCurrentVersion)
+        plan = price_index.source([("okra", 1)])
+        assert plan["complete"] and price_index.stats() == {"products": 2, "names": 2, "version": 1}
+
+def test_idempotency_key_replays_orders_and_signups(client):
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(farmerId, 1, quantity=50)
+    grocerHeaders = login_as(client, grocerUserId)
+    body = {"order_items": [{"product_id": 1, "quantity": 5}]}
+
+    first = client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': 'order-1'}, json=body)
+    assert first.status_code == 201
+    # the retry is answered from memory without touching the database
+    with QueryCounter() as counter:
+        retry = client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': 'order-1'}, json=body)
+    assert counter.count == 0
+    assert (retry.status_code, retry.json, retry.headers['Idempotent-Replayed']) == (201, first.json, 'true')
+
+    # a worker that didn't serve the first request finds it in the table
+    idempotency_store.clear()
+    with QueryCounter() as counter:
+        retry = client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': 'order-1'}, json=body)
+    assert retry.status_code == 201 and retry.headers['Idempotent-Replayed'] == 'true'
+    assert counter.count == 2
+    with app.app_context():
+        assert Order.query.filter_by(grocer_id=grocerId).count() == 1
+        assert db.session.get(Product, 1).quantity_available == 45
+
+    reused = client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': 'order-1'},
+                         json={"order_items": [{"product_id": 1, "quantity": 6}]})
+    assert reused.status_code == 422
+    # a failed order is replayed too, and requests without a key are untouched
+    short = {"order_items": [{"product_id": 1, "quantity": 500}]}
+    assert client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': 'order-2'}, json=short).status_code == 400
+    assert client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': 'order-2'},
+                       json=short).headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in client.post('/orders', headers=grocerHeaders, json=body).headers
+
+    signup = {"name": "Mary", "email": "mary@example.com", "phone_number": "0700000009", "password": "secret",
+              "role": "grocer", "store_name": "Mary's"}
+    assert client.post('/signup', headers={'Idempotency-Key': 'signup-1'}, json=signup).status_code == 201
+    again = client.post('/signup', headers={'Idempotency-Key': 'signup-1'}, json=signup)
+    assert again.status_code == 201 and again.headers['Idempotent-Replayed'] == 'true'
+    with app.app_context():
+        assert User.query.filter_by(email="mary@example.com").count() == 1
+
+def test_idempotency_key_duplicates_wait_for_the_first(client, monkeypatch):
+    import threading
+    import app.app as views
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(farmerId, 1, quantity=50)
+    grocerHeaders = {**login_as(client, grocerUserId), 'Idempotency-Key': 'order-1'}
+    token = client.get_cookie('access_token_cookie').value
+
+    entered, release = threading.Event(), threading.Event()
+    placeOrder = views.place_order
+    def slowPlaceOrder(*args):
+        entered.set()
+        release.wait(5)
+        return placeOrder(*args)
+    monkeypatch.setattr(views, 'place_order', slowPlaceOrder)
+
+    responses = []
+    def post():
+        other = app.test_client()
+        other.set_cookie('access_token_cookie', token)
+        responses.append(other.post('/orders', headers=grocerHeaders,
+                                    json={"order_items": [{"product_id": 1, "quantity": 5}]}))
+    first = threading.Thread(target=post)
+    first.start()
+    assert entered.wait(5)
+    entered.clear()
+    duplicate = threading.Thread(target=post)
+    duplicate.start()
+    duplicate.join(0.2)
+    # the duplicate is parked behind the first rather than placing its own order
+    assert duplicate.is_alive() and not entered.is_set()
+    release.set()
+    first.join(5)
+    duplicate.join(5)
+
+    assert sorted(response.status_code for response in responses) == [201, 201]
+    assert responses[1].headers['Idempotent-Replayed'] == 'true'
+    assert idempotency_store.stats()["waits"] >= 1
+    with app.app_context():
+        assert Order.query.filter_by(grocer_id=grocerId).count() == 1
+
+def test_idempotency_key_never_reruns_committed_work(client, monkeypatch):
+    import app.app as views
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(farmerId, 1, quantity=50)
+    grocerHeaders = login_as(client, grocerUserId)
+    body = {"order_items": [{"product_id": 1, "quantity": 5}]}
+
+    # the view fails after its order committed
+    submitOrder = views.submitOrder
+    def failingSubmitOrder(*args):
+        submitOrder(*args)
+        raise RuntimeError("lost after commit")
+    monkeypatch.setattr(views, 'submitOrder', failingSubmitOrder)
+    with pytest.raises(RuntimeError):
+        client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': 'order-1'}, json=body)
+    monkeypatch.undo()
+
+    # the worker dies between the view's commit and storing the response
+    def dying(now):
+        raise RuntimeError("worker died")
+    monkeypatch.setattr(idempotency_store, '_purge', dying)
+    with pytest.raises(RuntimeError):
+        client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': 'order-2'}, json=body)
+    monkeypatch.undo()
+
+    idempotency_store.clear()
+    for key in ('order-1', 'order-2'):
+        retry = client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': key}, json=body)
+        assert (retry.status_code, retry.headers['Idempotent-Replayed']) == (409, 'true')
+        assert "carried out" in retry.json["error"]
+    with app.app_context():
+        assert Order.query.filter_by(grocer_id=grocerId).count() == 2
+        assert db.session.get(Product, 1).quantity_available == 40
+
+    # a view that committed nothing still gives its key back
+    def brokenSubmitOrder(*args):
+        raise RuntimeError("before any write")
+    monkeypatch.setattr(views, 'submitOrder', brokenSubmitOrder)
+    with pytest.raises(RuntimeError):
+        client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': 'order-3'}, json=body)
+    monkeypatch.undo()
+    assert client.post('/orders', headers={**grocerHeaders, 'Idempotency-Key': 'order-3'}, json=body).status_code == 201
+
+def test_archive_moves_cold_history_and_history_reads_it_by_date(client):
+    from datetime import datetime
+    from sqlalchemy import update
+    from app.archive import history_archive
+    from app.analytics import rebuild_sales
+    from app.models import LoginSession, ArchivedOrder, ArchivedOrderItem, ArchivedLoginSession, ProductDailySales
+    annUserId, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    grocerUserId, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(annId, 2)
+    for day in (1, 2, 3):
+        add_order(grocerId, [(1, day), (2, 1)], order_date=datetime(2024, 1, day))
+    add_order(grocerId, [(1, 1)])
+    with app.app_context():
+        # the third old order was never delivered, so it stays
+        db.session.execute(update(Order).where(Order.id.in_([1, 2, 4])).values(delivery_date=datetime(2024, 2, 1)))
+        db.session.add_all([LoginSession(user_id=grocerUserId, session_token="closed", logout_time=datetime(2024, 1, 1)),
+                            LoginSession(user_id=grocerUserId, session_token="open")])
+        db.session.commit()
+        rebuild_sales()
+        db.session.commit()
+        rollup = db.session.execute(db.select(ProductDailySales.day, ProductDailySales.units_sold)
+                                    .order_by(ProductDailySales.day, ProductDailySales.product_id)).all()
+
+        history_archive.batch_size = 1
+        try:
+            with QueryCounter() as counter:
+                assert history_archive.archive_orders() == 2
+            # each batch is a lookup, the copy and delete of orders and items and the ticket purge, then the final
+            # empty lookup
+            assert counter.count == 2 * 6 + 1
+            assert history_archive.archive_sessions() == 1
+            # a rerun finds nothing left to move
+            assert history_archive.archive_orders() == 0
+        finally:
+            history_archive.batch_size = app.config['ARCHIVE_BATCH_SIZE']
+
+        assert [order.id for order in Order.query.order_by(Order.id)] == [3, 4]
+        assert [order.id for order in ArchivedOrder.query.order_by(ArchivedOrder.id)] == [1, 2]
+        assert ArchivedOrderItem.query.count() == 4 and OrderItem.query.count() == 3
+        assert [row.session_token for row in LoginSession.query] == ["open"]
+        assert [row.session_token for row in ArchivedLoginSession.query] == ["closed"]
+        assert history_archive.horizon() == datetime(2024, 1, 2)
+        # the rollup rebuilds to the same numbers from both tiers
+        rebuild_sales()
+        assert db.session.execute(db.select(ProductDailySales.day, ProductDailySales.units_sold)
+                                  .order_by(ProductDailySales.day, ProductDailySales.product_id)).all() == rollup
+
+    login_as(client, grocerUserId)
+    assert [order["order_id"] for order in client.get('/orders').json] == [3, 4]
+    assert [order["order_id"] for order in
+            client.get('/orders', query_string={'since': '2024-01-03'}).json] == [3, 4]
+    older = client.get('/orders', query_string={'since': '2024-01-01', 'limit': 2})
+    assert [order["order_id"] for order in older.json] == [1, 2]
+    assert older.headers['X-Next-After'] == '2'
+    assert [item["quantity_ordered"] for item in older.json[1]["products"]] == [2, 1]
+    assert [order["order_id"] for order in
+            client.get('/orders', query_string={'until': '2024-01-03'}).json] == [1, 2]
+    streamed = client.get('/orders', query_string={'since': '2024-01-01', 'format': 'ndjson'})
+    assert [(order["order_id"], len(order["products"])) for order in read_ndjson(streamed)] == \
+        [(1, 2), (2, 2), (3, 2), (4, 1)]
+
+    login_as(client, annUserId)
+    farmerOrders = client.get('/orders', query_string={'since': '2024-01-01'}).json
+    assert [(order["order_id"], order["total_amount"]) for order in farmerOrders] == \
+        [(1, 10 + 11), (2, 20 + 11), (3, 30 + 11), (4, 10)]
+    streamed = client.get('/orders', query_string={'since': '2024-01-01', 'format': 'ndjson'})
+    assert read_ndjson(streamed) == farmerOrders
+
+def test_archive_keeps_foreign_keys(client):
+    from datetime import datetime
+    from app.archive import history_archive
+    from app.models import OrderTicket, ArchivedOrder
+    _, annId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    _, grocerId = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    add_products(annId, 1)
+    add_order(grocerId, [(1, 1)], order_date=datetime(2024, 1, 1))
+    add_order(grocerId, [(1, 2)])
+    with app.app_context():
+        db.session.execute(db.update(Order).values(delivery_date=datetime(2024, 2, 1)))
+        # orders that came through the async intake are still pointed at by their tickets
+        db.session.add_all([OrderTicket(ticket="old", grocer_id=grocerId, lines="[]", status="placed", order_id=1),
+                            OrderTicket(ticket="new", grocer_id=grocerId, lines="[]", status="placed", order_id=2)])
+        db.session.commit()
+
+    # SQLite only checks foreign keys when asked, per connection, outside a transaction
+    def enforce(dbapiConnection, record, proxy):
+        dbapiConnection.execute("PRAGMA foreign_keys = ON")
+    def relax(dbapiConnection, record):
+        dbapiConnection.execute("PRAGMA foreign_keys = OFF")
+    with app.app_context():
+        event.listen(db.engine, 'checkout', enforce)
+        event.listen(db.engine, 'checkin', relax)
+        try:
+            db.session.close()
+            assert db.session.execute(db.text("PRAGMA foreign_keys")).scalar() == 1
+            assert history_archive.archive_orders() == 1
+        finally:
+            db.session.close()
+            event.remove(db.engine, 'checkout', enforce)
+            event.remove(db.engine, 'checkin', relax)
+
+        assert [order.id for order in ArchivedOrder.query] == [1]
+        assert [ticket.ticket for ticket in OrderTicket.query] == ["new"]
+
+def test_rate_limits_per_route_and_identity(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'LOGIN_RATE_LIMIT', '3/minute')
+    monkeypatch.setitem(app.config, 'LOGIN_ACCOUNT_RATE_LIMIT', '2/minute')
+    monkeypatch.setitem(app.config, 'ORDER_RATE_LIMIT', '2/minute')
+    _, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    joeUserId, _ = make_user("Grocer Joe", "joe@example.com", "0700000003", "grocer")
+    maryUserId, _ = make_user("Grocer Mary", "mary@example.com", "0700000004", "grocer")
+    add_products(farmerId, 1, quantity=50)
+
+    # failed attempts count against the account too, however its identifier is written
+    attempts = [client.post('/login', json={"identifier": identifier, "password": password})
+                for identifier, password in (("joe@example.com", "secret"), ("joe@example.com", "guess"),
+                                             (" JOE@example.com", "secret"))]
+    assert [response.status_code for response in attempts] == [200, 401, 429]
+    assert 0 < int(attempts[2].headers['Retry-After']) <= 60
+    assert "2 per 1 minute" in attempts[2].json["error"]
+    # another account still gets in, until the address runs out of its own allowance
+    assert client.post('/login', json={"identifier": "mary@example.com", "password": "secret"}).status_code == 200
+    assert client.post('/login', json={"identifier": "mary@example.com", "password": "secret"}).status_code == 429
+
+    body = {"order_items": [{"product_id": 1, "quantity": 1}]}
+    joeHeaders = login_as(client, joeUserId)
+    assert [client.post('/orders', headers=joeHeaders, json=body).status_code for _ in range(3)] == [201, 201, 429]
+    assert client.get('/orders').status_code == 200
+    maryHeaders = login_as(client, maryUserId)
+    assert client.post('/orders', headers=maryHeaders, json=body).status_code == 201
+
+def test_concurrency_caps_fail_fast(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'ROUTE_CONCURRENCY', {"catalog": 1})
+    monkeypatch.setitem(app.config, 'ADMISSION_WAIT', 0)
+    concurrency_caps.init_app(app)
+    try:
+        farmerUserId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+        add_products(farmerId, 2)
+        farmerHeaders = login_as(client, farmerUserId)
+
+        # a streamed catalog keeps its slot until the body is done
+        streamed = client.get('/products', query_string={'format': 'ndjson'}, buffered=False)
+        assert concurrency_caps.stats()["catalog"]["running"] == 1
+        busy = client.get('/products')
+        assert busy.status_code == 503
+        assert busy.headers['Retry-After'] == '1'
+        # writes to the same route aren't capped
+        assert client.post('/products', headers=farmerHeaders, json={
+            "name": "Kale", "description": "Greens", "quantity_available": 4, "price_per_unit": 3
+        }).status_code == 201
+        streamed.get_data()
+        streamed.close()
+
+        assert client.get('/products').status_code == 200
+        assert concurrency_caps.stats()["catalog"] == {"cap": 1, "running": 0, "rejected": 1}
+    finally:
+        monkeypatch.undo()
+        concurrency_caps.init_app(app)
+
+def test_product_search_ranks_filters_and_pages(client):
+    from sqlalchemy import update, text
+    userId, farmerId = make_user("Farmer Ann", "ann@example.com", "0700000001", "farmer")
+    add_offers(farmerId, [("Cherry Tomatoes", 10, 5), ("Kale", 10, 2), ("Tomatoes", 0, 3), ("Tomatillos", 40, 8),
+                          ("Onions", 20, 1)])
+    with app.app_context():
+        # the description only match ranks below the names
+        db.session.execute(update(Product).where(Product.name == "Kale").values(description="Goes with tomatoes"))
+        db.session.commit()
+    login_as(client, userId)
+
+    def search(**args):
+        response = client.get('/products/search', query_string=args)
+        assert response.status_code == 200
+        return [product["id"] for product in response.json], response.headers.get('X-Next-After')
+
+    assert search(q="tomat") == ([3, 4, 1, 2], None)
+    assert search(q="TOMAT cherr") == ([1], None)
+    assert search(q="tomat", min_quantity=1, max_price=6) == ([1, 2], None)
+    first, cursor = search(q="tomat", limit=2)
+    assert first == [3, 4]
+    assert search(q="tomat", limit=2, after=cursor) == ([1, 2], None)
+    assert search(q="tomat", sort="id", limit=3) == ([1, 2, 3], "3")
+    assert search(q="tomat", sort="id", after=3) == ([4], None)
+    body = client.get('/products/search', query_string={"q": "onion"}).json
+    assert body == [{"id": 5, "name": "Onions", "description": "Fresh", "quantity": 20, "price": 1,
+                     "farmer": "Farmer Ann"}]
+
+    # renames, bulk or not, new products and deletes reach the index through the triggers
+    with app.app_context():
+        db.session.execute(update(Product).where(Product.id == 4).values(name="Green Salsa"))
+        db.session.delete(db.session.get(Product, 3))
+        db.session.commit()
+    client.post('/products', headers=login_as(client, userId), json={
+        "name": "Plum Tomatoes", "description": "Fresh", "quantity_available": 4, "price_per_unit": 3
+    })
+    assert search(q="tomat") == ([1, 6, 2], None)
+    assert search(q="salsa") == ([4], None)
+
+    for bad in ({"q": "  *\""}, {"q": "kale", "after": "3"}, {"q": "kale", "sort": "price"}):
+        assert client.get('/products/search', query_string=bad).status_code == 400
+
+    # an index left behind by products written without the triggers is rebuilt from the table
+    with app.app_context():
+        db.session.execute(text("DELETE FROM productSearch"))
+        db.session.execute(text("INSERT INTO productSearch(productSearch) VALUES ('delete-all')"))
+        db.session.commit()
+    assert search(q="tomat") == ([], None)
+    result = app.test_cli_runner().invoke(args=['rebuild-search-index'])
+    assert result.exit_code == 0, result.output
+    assert search(q="tomat") == ([1, 6, 2], None)
+
+def test_login_identifiers_normalize_and_cache_unknown_ones(client):
+    from app.models import LoginIdentifier
+    client.post('/signup', json={"name": "Jane Doe", "email": "Jane@Example.com", "phone_number": "0700 000 002",
+                                 "password": "secret", "role": "grocer", "store_name": "Jane's Grocery"})
+    with app.app_context():
+        assert sorted((row.kind, row.identifier) for row in LoginIdentifier.query) == \
+            [("email", "jane@example.com"), ("phone", "0700000002")]
+
+    def login(identifier, password="secret"):
+        return client.post('/login', json={"identifier": identifier, "password": password}).status_code
+
+    assert [login(" jane@EXAMPLE.com"), login("0700-000-002"), login("jane@example.com", "guess")] == [200, 200, 401]
+    duplicate = client.post('/signup', json={"name": "Jane Again", "email": "JANE@example.com",
+                                             "phone_number": "0799999999", "password": "secret", "role": "farmer"})
+    assert duplicate.status_code == 400
+
+    # an unknown identifier costs one probe, then none until it signs up
+    with QueryCounter() as counter:
+        assert login("ghost@example.com") == 401
+    assert counter.count == 1
+    with QueryCounter() as counter:
+        assert [login("Ghost@example.com "), login("ghost@example.com")] == [401, 401]
+    assert counter.count == 0
+    assert login_identifiers.stats()["absent_hits"] == 2
+    client.post('/signup', json={"name": "Ghost", "email": "ghost@example.com", "phone_number": "0700000003",
+                                 "password": "secret", "role": "farmer"})
+    assert login("ghost@example.com") == 200
+
+    # a changed email moves with the user; users written around the ORM are picked up by a rebuild
+    with app.app_context():
+        user = User.query.filter_by(name="Ghost").one()
+        user.email = "casper@example.com"
+        db.session.execute(User.__table__.insert().values(name="Bulk", email="bulk@example.com",
+                                                          phone_number="0700000004", password_hash=user.password_hash,
+                                                          role="farmer"))
+        db.session.commit()
+    assert [login("casper@example.com"), login("ghost@example.com"), login("bulk@example.com")] == [200, 401, 401]
+    result = app.test_cli_runner().invoke(args=['rebuild-login-identifiers'])
+    assert result.exit_code == 0, result.output
+    assert "6 identifiers indexed" in result.output
+    assert login("0700000004") == 200
+
+    # a user whose email only differs in case from an earlier one is named, not silently dropped
+    with app.app_context():
+        clash = db.session.execute(User.__table__.insert().values(
+            name="Clash", email="BULK@example.com", phone_number="0700000005", password_hash="unused",
+            role="farmer")).inserted_primary_key[0]
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=['rebuild-login-identifiers'])
+    assert "1 users skipped" in result.output and f"skipped user ids, who can't log in until fixed: {clash}" in result.output
+
+def test_login_identifiers_filled_for_existing_users(client):
+    from flask_migrate import upgrade, stamp
+    from app.models import LoginIdentifier
+    userId, _ = make_user("Farmer Ann", "Ann@Example.com", "0700 000 001", "farmer")
+    with app.app_context():
+        LoginIdentifier.query.delete()
+        db.session.commit()
+    login_identifiers.clear()
+
+    def login(identifier):
+        return client.post('/login', json={"identifier": identifier, "password": "secret"}).status_code
+
+    # with the table empty, as create-db leaves it on an older database, logins use the users columns
+    assert [login("ghost@example.com"), login("Ann@Example.com"), login("0700 000 001")] == [401, 200, 200]
+    assert login_identifiers.stats()["absent_entries"] == 0
+
+    directory = os.path.join(app.root_path, 'migrations')
+    init_migrations(app)
+    with app.app_context():
+        stamp(directory=directory, revision='d5e8f1a3c927')
+        upgrade(directory=directory)
+        assert sorted((row.kind, row.identifier, row.user_id) for row in LoginIdentifier.query) == \
+            [("email", "ann@example.com", userId), ("phone", "0700000001", userId)]
+        db.session.execute(db.text("DROP TABLE alembic_version"))
+        db.session.commit()
+    login_identifiers.clear()
+    assert [login("ANN@example.com"), login("ghost@example.com")] == [200, 401]
+    assert login_identifiers.stats()["absent_entries"] == 1
+
 if __name__ == '__main__':
     pytest.main()
\ No newline at end of file